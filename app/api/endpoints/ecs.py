@@ -1,11 +1,15 @@
-from typing import List, Optional
-from fastapi import APIRouter, Depends, HTTPException
+import hmac
+from typing import Any, Dict, List, Optional, Union
+from fastapi import APIRouter, Body, Depends, Header, HTTPException
 from sqlalchemy.orm import Session
 
 from app import schemas
 from app.api import deps
-from app.crud.ecs import ecs_instance
+from app.core.config import settings
+from app.crud.ecs import ecs_instance, ecs_pool_instance
 from app.crud.guacamole import guacamole_connection
+from app.services.ecs_events import parse_instance_events
+from app.tasks.ecs_tasks import apply_instance_events
 router = APIRouter()
 
 
@@ -33,6 +37,35 @@ def get_active_instances(
     return ecs_instance.get_active_instances(db=db, skip=skip, limit=limit)
 
 
+@router.get("/pool-instances", response_model=List[schemas.ECSPoolInstance])
+def get_pool_instances(
+    *,
+    db: Session = Depends(deps.get_db),
+    current_admin: dict = Depends(deps.get_current_admin),
+    environment_id: Optional[int] = None
+):
+    """获取预热池中创建中与就绪的实例"""
+    return ecs_pool_instance.get_by_status(db=db, statuses=["Stopping", "Pending", "Ready"], environment_id=environment_id)
+
+
+@router.post("/events")
+def receive_instance_events(
+    *,
+    payload: Union[List[Dict[str, Any]], Dict[str, Any]] = Body(...),
+    x_ecs_event_token: Optional[str] = Header(None)
+):
+    """
+    接收ECS实例状态变更事件(单个或数组)，直接更新实例与学生任务状态
+
+    请求头 X-ECS-Event-Token 须与 ECS_EVENT_TOKEN 一致，未配置令牌时不接收事件
+    """
+    if not settings.ECS_EVENT_TOKEN:
+        raise HTTPException(status_code=404, detail="ECS event ingestion is disabled")
+    if not x_ecs_event_token or not hmac.compare_digest(x_ecs_event_token, settings.ECS_EVENT_TOKEN):
+        raise HTTPException(status_code=401, detail="Invalid event token")
+    return apply_instance_events(parse_instance_events(payload))
+
+
 @router.get("/instances/{instance_id}", response_model=schemas.ECSInstance)
 def get_ecs_instance(
     *,
@@ -1,19 +1,24 @@
 from fastapi import APIRouter, Depends, HTTPException, status, WebSocket, WebSocketDisconnect, Query, Request
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, PlainTextResponse
 from jose import jwt, JWTError
 from sqlalchemy.orm import Session
 import asyncio
+import datetime
 import json
 import logging
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 
-from app.api.deps import get_db, get_current_student
+from app.api.deps import get_db, get_current_student, get_current_admin
 from app.core.config import settings
+from app.core.security import ALGORITHM, create_access_token
 from app.core.templates import templates
 from app.schemas.task import StudentTask
 from app.crud.task import student_task as crud_student_task
 from app.services import ecs_service
 from app.services.guacamole import guacamole_service
+from app.services.guacamole_queue import FrameQueue
+from app.services.guacamole_registry import guacamole_registry
+from app.services.guacd_pool import guacd_pool
 from app.models.task import Task
 from app.models.task import StudentTask as StudentTaskDb, Task as TaskDb
 from app.crud.ecs import ecs_instance as crud_ecs_instance
@@ -85,17 +90,96 @@ async def guacamole_client(
         {
             "request": request,
             "student_task_id": student_task_id,
+            "token": token,
             "has_time_limit": has_time_limit,
             "remaining_time": remaining_time or 0
         }
     )
 
 
-@router.websocket("/ws/{student_task_id}/{width}/{height}")
-async def guacamole_ws(websocket: WebSocket, student_task_id: int, width=1280,height=720,db: Session = Depends(get_db)):
+def _verify_tunnel_token(token: Optional[str], student_task_id: int) -> bool:
+    """校验学生远程桌面的临时令牌是否对应该学生任务"""
+    if not token:
+        return False
+    try:
+        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=ALGORITHM)
+    except JWTError:
+        return False
+    return payload.get("sub") == f"st_{student_task_id}"
+
+
+async def _create_rdp_tunnel(
+        websocket: WebSocket, ecs_instance, student_task_id: int, width: int, height: int
+) -> Optional[Tuple[str, FrameQueue]]:
+    """
+    为学生任务的ECS实例创建新的RDP隧道并接入WebSocket，失败时关闭WebSocket
+
+    Returns:
+        Optional[Tuple[str, FrameQueue]]: (连接ID, 发送队列)，失败时返回None
     """
-    WebSocket连接处理Guacamole通信
+    # 创建与Guacamole服务器的连接
+    tunnel_result = await guacamole_service.create_rdp_tunnel(
+        ecs_instance.private_ip, ecs_instance.password, width, height, student_task_id, attach=True
+    )
+
+    if not tunnel_result["success"]:
+        error_msg = f"无法创建远程桌面连接: {tunnel_result.get('error')}"
+        logger.error(error_msg)
+        await websocket.close(code=1011, reason=error_msg)
+        return None
+
+    connection_id = tunnel_result["connection_id"]
+    logger.info(f"成功创建远程桌面连接，ID: {connection_id}")
+    return connection_id, tunnel_result["queue"]
+
+
+async def _forward_frames(websocket: WebSocket, queue, connection_id: str, record_sent: bool = False):
+    """
+    发送任务 - 从发送队列取帧并发送到WebSocket，慢客户端只会阻塞该任务
+
+    Args:
+        websocket: 目标WebSocket
+        queue: 该WebSocket的发送队列
+        connection_id: 连接标识符
+        record_sent: 是否计入会话画质统计(旁观者不计入)
     """
+    instruction_count = 0
+    frame_count = 0
+    try:
+        while True:
+            frame = await queue.get(max_bytes=settings.GUACAMOLE_FRAME_MAX_BYTES)
+            if frame is None:
+                # 隧道已关闭或被新的WebSocket接管
+                logger.info(f"发送队列已关闭: {connection_id}")
+                break
+
+            frame_count += 1
+            instruction_count += len(frame.instructions)
+            # 每100帧日志记录一次，避免日志过多
+            if frame_count % 100 == 0:
+                logger.debug(f"已转发 {frame_count} 帧 {instruction_count} 条指令, 队列: {queue.stats()}")
+
+            # 一个帧包含多条完整指令，整体作为一条WebSocket消息发送
+            await websocket.send_text(frame.text())
+            if record_sent:
+                guacamole_service.record_sent(connection_id, frame)
+    except asyncio.CancelledError:
+        logger.info(f"转发任务已取消，总共转发了 {instruction_count} 条指令")
+        raise
+    except Exception as e:
+        logger.exception(f"转发数据时出错: {e}")
+    finally:
+        # 隧道关闭、被接管或队列超限后关闭WebSocket，使接收循环退出
+        try:
+            if queue.overflowed:
+                await websocket.close(code=1013, reason="网络过慢，连接已断开")
+            else:
+                await websocket.close()
+        except Exception:
+            pass
+
+
+async def _accept_websocket(websocket: WebSocket):
     # 关键修改：接受WebSocket连接时指定子协议为"guacamole"
     if "guacamole" in websocket.headers.get("sec-websocket-protocol", "").split(", "):
         # 客户端请求了guacamole子协议
@@ -106,8 +190,26 @@ async def guacamole_ws(websocket: WebSocket, student_task_id: int, width=1280,he
         await websocket.accept()
         logger.info("接受WebSocket连接，无子协议")
 
+
+@router.websocket("/ws/{student_task_id}/{width}/{height}")
+async def guacamole_ws(websocket: WebSocket, student_task_id: int, width=1280,height=720,
+                       token: Optional[str] = Query(None), resume: Optional[str] = Query(None),
+                       db: Session = Depends(get_db)):
+    """
+    WebSocket连接处理Guacamole通信，需要与客户端页面相同的临时令牌(token)
+    客户端断线重连时带上原连接ID(resume)，可在保留期内重新接入原有的RDP会话，
+    原隧道在其他网关进程上时同样可以接管
+    """
+    await _accept_websocket(websocket)
+
+    # 接管或关闭学生已有的隧道之前先校验令牌
+    if not _verify_tunnel_token(token, student_task_id):
+        await websocket.close(code=1008, reason="令牌无效")
+        return
+
     tunnel_task = None
     connection_id = None
+    queue = None
 
     try:
         # 获取学生任务信息
@@ -124,74 +226,44 @@ async def guacamole_ws(websocket: WebSocket, student_task_id: int, width=1280,he
         #     await websocket.close(code=1008, reason="任务信息不存在")
         #     return
 
-        logger.info(f"创建RDP连接到 {ecs_instance.private_ip}:3389")
-
-        # 创建与Guacamole服务器的连接
-        tunnel_result = await guacamole_service.create_tunnel(
-            protocol="rdp",
-            hostname=ecs_instance.private_ip,
-            port=3389,
-            username="Administrator",
-            password=ecs_instance.password,
-            width=int(float(width)),
-            height=int(float(height)),
-            dpi=96,
-            security="any",
-            ignore_cert="true",
-            enable_wallpaper="false",
-            enable_theming="false",
-            enable_font_smoothing="false",
-            enable_full_window_drag="false",
-            enable_desktop_composition="false",
-            enable_menu_animations="false",
-            color_depth=16,
-            disable_audio="true",
-            framerate="15"
-        )
-
-        if not tunnel_result["success"]:
-            error_msg = f"无法创建远程桌面连接: {tunnel_result.get('error')}"
-            logger.error(error_msg)
-            await websocket.close(code=1011, reason=error_msg)
-            return
+        width = int(float(width))
+        height = int(float(height))
 
-        connection_id = tunnel_result["connection_id"]
-        logger.info(f"成功创建远程桌面连接，ID: {connection_id}")
-        await websocket.send_text(f"5.ready,{len(connection_id)+1}.${connection_id};")
+        # 优先接管断线前的隧道或预热的隧道(可能在其他网关节点上)
+        tunnel = await guacamole_service.resume(student_task_id, width, height, connection_id=resume)
+        if not tunnel and resume:
+            tunnel = await guacamole_service.resume(student_task_id, width, height)
+        if tunnel:
+            logger.info(f"重新接入Guacamole连接: {tunnel[0]}")
+        else:
+            # 关闭该学生任务遗留的隧道(可能在其他网关节点上)，避免同一实例上出现两个RDP会话
+            previous = await guacamole_registry.find_by_student_task(student_task_id)
+            if previous:
+                await guacamole_registry.request_close(previous["connection_id"])
+            tunnel = await _create_rdp_tunnel(websocket, ecs_instance, student_task_id, width, height)
+            if not tunnel:
+                return
+        connection_id, queue = tunnel
 
-        # 启动数据转发任务 - 从GuacamoleService获取数据并发送到WebSocket
-        async def tunnel_message_forwarder():
-            instruction_count = 0
-            try:
-                while True:
-                    # 从Guacamole服务器读取指令
-                    instruction = await guacamole_service.read_instruction(connection_id)
-                    if instruction:
-                        instruction_count += 1
-                        # 每100条日志记录一次，避免日志过多
-                        if instruction_count % 100 == 0:
-                            logger.debug(f"已转发 {instruction_count} 条指令")
-
-                        # 直接发送原始指令字符串给客户端
-                        await websocket.send_text(instruction)
-                    else:
-                        # 如果没有数据，短暂等待
-                        await asyncio.sleep(0.01)
-            except asyncio.CancelledError:
-                logger.info(f"转发任务已取消，总共转发了 {instruction_count} 条指令")
-                raise
-            except Exception as e:
-                logger.exception(f"转发数据时出错: {e}")
+        # 告知客户端隧道UUID(内部指令)，客户端重连时据此恢复会话
+        await websocket.send_text(
+            f"0.,{len(connection_id)}.{connection_id};5.ready,{len(connection_id)+1}.${connection_id};"
+        )
 
-        # 启动转发任务
-        tunnel_task = asyncio.create_task(tunnel_message_forwarder())
+        # 启动转发任务，guacd的读取由隧道自身的任务负责
+        tunnel_task = asyncio.create_task(_forward_frames(websocket, queue, connection_id, record_sent=True))
 
         # 处理从客户端发来的指令
         while True:
             message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
 
             if "text" in message:
                 text = message["text"]
+                # 客户端主动断开时只脱离隧道，不把disconnect转发给guacd，保留会话等待重连
+                if text == "10.disconnect;":
+                    break
                 # 直接将客户端指令发送到Guacamole服务器
                 await guacamole_service.send_instruction(connection_id, text)
             elif "bytes" in message:
@@ -220,10 +292,170 @@ async def guacamole_ws(websocket: WebSocket, student_task_id: int, width=1280,he
                 logger.debug("转发任务取消完成")
                 pass
 
-        # 关闭Guacamole连接
-        if connection_id:
+        # 脱离Guacamole隧道，隧道保留一段时间等待重连
+        if connection_id and queue is not None:
             try:
-                close_result = await guacamole_service.close_tunnel(connection_id)
-                logger.info(f"关闭Guacamole连接 {connection_id}: {close_result}")
+                await guacamole_service.detach(connection_id, queue)
             except Exception as e:
-                logger.error(f"关闭Guacamole连接时出错: {e}")
\ No newline at end of file
+                logger.error(f"脱离Guacamole连接时出错: {e}")
+
+
+@router.get("/admin/sessions", response_model=List[Dict])
+async def get_guacamole_sessions(
+        current_admin: dict = Depends(get_current_admin)
+):
+    """
+    管理员查看本进程内活跃Guacamole会话的发送队列指标
+    """
+    return guacamole_service.get_sessions_stats()
+
+
+@router.get("/admin/metrics", response_model=List[Dict])
+async def get_guacamole_metrics(
+        current_admin: dict = Depends(get_current_admin)
+):
+    """
+    管理员查看所有网关进程上各隧道的性能计数器: 上下行字节与指令数、帧大小分布、
+    sync往返延迟、握手耗时及首帧耗时
+    """
+    return await guacamole_service.get_metrics()
+
+
+@router.get("/metrics/prometheus", response_class=PlainTextResponse)
+async def scrape_guacamole_metrics(request: Request, token: Optional[str] = Query(None)):
+    """
+    Prometheus抓取所有网关进程汇总后的隧道指标
+    指标包含学生任务ID和实例IP，未配置GUACAMOLE_METRICS_TOKEN时接口不开放
+    """
+    if not settings.GUACAMOLE_METRICS_TOKEN:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    authorization = request.headers.get("authorization", "")
+    if token != settings.GUACAMOLE_METRICS_TOKEN \
+            and authorization != f"Bearer {settings.GUACAMOLE_METRICS_TOKEN}":
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+    return PlainTextResponse(await guacamole_service.render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+@router.get("/admin/guacd", response_model=List[Dict])
+def get_guacd_backends(
+        current_admin: dict = Depends(get_current_admin)
+):
+    """
+    管理员查看本进程的guacd后端健康状态与隧道数
+    """
+    return guacd_pool.stats()
+
+
+@router.get("/admin/tunnels", response_model=List[Dict])
+def get_guacamole_tunnels(
+        current_admin: dict = Depends(get_current_admin)
+):
+    """
+    管理员查看所有网关节点上登记的Guacamole隧道
+    """
+    return guacamole_registry.list_tunnels()
+
+
+@router.delete("/admin/tunnels/{connection_id}")
+async def close_guacamole_tunnel(
+        connection_id: str,
+        current_admin: dict = Depends(get_current_admin)
+):
+    """
+    管理员关闭任意网关节点上的Guacamole隧道
+    """
+    if not await guacamole_registry.request_close(connection_id):
+        raise HTTPException(status_code=404, detail="隧道不存在")
+    return {"message": "已请求关闭隧道"}
+
+
+def _verify_observe_token(token: str, student_task_id: int) -> bool:
+    """校验旁观令牌是否对应该学生任务"""
+    try:
+        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=ALGORITHM)
+    except JWTError:
+        return False
+    return payload.get("sub") == f"obs_{student_task_id}" and payload.get("role") == "admin"
+
+
+@router.get("/admin/observe/{student_task_id}/token", response_model=Dict[str, str])
+def generate_observe_token(
+        student_task_id: int,
+        current_admin: dict = Depends(get_current_admin)
+):
+    """
+    生成旁观学生远程桌面的临时令牌
+    """
+    token_data = {
+        "sub": f"obs_{student_task_id}",
+        "role": "admin"
+    }
+
+    # 生成临时令牌 (30分钟有效)
+    temp_token = create_access_token(token_data, expires_delta=datetime.timedelta(minutes=30))
+    return {"token": temp_token}
+
+
+@router.get("/observe/{student_task_id}", response_class=HTMLResponse)
+async def guacamole_observe_client(
+        student_task_id: int,
+        request: Request,
+        token: str = Query(...)
+):
+    """
+    获取只读旁观页面
+    """
+    if not _verify_observe_token(token, student_task_id):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid token"
+        )
+
+    return templates.TemplateResponse(
+        "guacamole/observe.html",
+        {
+            "request": request,
+            "student_task_id": student_task_id,
+            "token": token
+        }
+    )
+
+
+@router.websocket("/ws/observe/{student_task_id}")
+async def guacamole_observe_ws(websocket: WebSocket, student_task_id: int, token: str = Query(...)):
+    """
+    只读旁观WebSocket，以只读用户加入学生已有的guacd连接，不新建RDP会话
+    学生的隧道可以在任意网关节点上；旁观者发来的指令只转发sync回复与nop
+    """
+    await _accept_websocket(websocket)
+
+    if not _verify_observe_token(token, student_task_id):
+        await websocket.close(code=1008, reason="令牌无效")
+        return
+
+    observer = await guacamole_service.add_observer(student_task_id)
+    if observer is None:
+        await websocket.close(code=1013, reason="学生当前没有打开远程桌面")
+        return
+    observer_id, queue = observer
+
+    await websocket.send_text(f"0.,{len(observer_id)}.{observer_id};")
+    tunnel_task = asyncio.create_task(_forward_frames(websocket, queue, observer_id))
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            if "text" in message:
+                await guacamole_service.send_observer_instruction(observer_id, message["text"])
+    except WebSocketDisconnect:
+        logger.info(f"旁观WebSocket连接断开: {student_task_id}")
+    except Exception as e:
+        logger.exception(f"旁观WebSocket处理异常: {e}")
+    finally:
+        tunnel_task.cancel()
+        try:
+            await tunnel_task
+        except asyncio.CancelledError:
+            pass
+        await guacamole_service.remove_observer(observer_id)
@@ -1,6 +1,6 @@
 import datetime
-from typing import Dict, List, Any
-from fastapi import APIRouter, Depends, HTTPException
+from typing import Dict, List, Any, Optional
+from fastapi import APIRouter, Depends, Header, HTTPException
 from sqlalchemy.orm import Session
 from starlette import status
 
@@ -11,12 +11,17 @@ from app.core.security import create_access_token
 from app.services import ecs_service, jupyter_service
 from app.crud.task import student_task
 from app.crud.task import task
-from app.crud.ecs import ecs_instance
+from app.crud.ecs import ecs_instance, ecs_pool_instance
 from app.crud.guacamole import guacamole_connection
 from app.crud.jupyter import jupyter_container
 from app.crud.environment import environment_template
 from app.services.ali_cloud import ali_cloud_service
 from app.services.guacamole import guacamole_service
+from app.services.guacamole_registry import guacamole_registry
+from app.services.ecs_placement import launch_candidates
+from app.services.request_idempotency import request_idempotency
+from app.services.warm_pool import WarmPoolConfig
+from app.tasks.pool_tasks import adopt_pool_instance_task
 from fastapi import Response
 router = APIRouter()
 
@@ -42,49 +47,67 @@ async def start_experiment(
         db: Session = Depends(deps.get_db),
         current_student: Dict = Depends(deps.get_current_student),
         task_id: int,
+        idempotency_key: Optional[str] = Header(None)
 ):
     """
     开始实验
+
+    请求头 Idempotency-Key 相同的重复请求直接返回第一次的结果
     """
+    student_id = current_student["id"]
+    if not idempotency_key:
+        return await _start_experiment(db, student_id, task_id)
+
+    scope = f"start-experiment:{student_id}:{task_id}"
+    first, previous = request_idempotency.begin(scope, idempotency_key)
+    if not first:
+        if previous is None:
+            raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+        return previous
+    try:
+        result = await _start_experiment(db, student_id, task_id)
+    except Exception:
+        request_idempotency.abort(scope, idempotency_key)
+        raise
+    request_idempotency.finish(scope, idempotency_key, result)
+    return result
+
+
+async def _start_experiment(db: Session, student_id: int, task_id: int) -> Dict[str, Any]:
     # 获取任务信息
     task_data = task.get(db, id=task_id)
     if not task_data:
         raise HTTPException(status_code=404, detail="Task not found")
+    if task_data.task_type not in ("guacamole", "jupyter"):
+        raise HTTPException(status_code=400, detail=f"Unsupported task type: {task_data.task_type}")
 
-    # 检查学生是否有权限访问该任务
-    student_id = current_student["id"]
-
-    # 检查学生实验次数是否超限
-    latest_student_task = student_task.get_latest_for_student_task(db, student_id=student_id, task_id=task_id)
-    attempt_number = 1
-    if latest_student_task:
-        attempt_number = latest_student_task.attempt_number + 1
-        # 检查是否超过最大尝试次数
-        if attempt_number > task_data.max_attempts:
-            raise HTTPException(status_code=400, detail="You have reached the maximum allowed attempts for this task")
-
-    # 创建学生任务记录
-    new_student_task = student_task.create_student_task(
-        db,
-        student_id=student_id,
-        task_id=task_id,
-        task_type=task_data.task_type,
-        attempt_number=attempt_number
-    )
+    # 在学生行锁内检查实验次数并创建学生任务记录，重复点击不会创建两次实验
+    new_student_task, created = student_task.start_attempt(db, student_id=student_id, task_obj=task_data)
+    if not new_student_task:
+        raise HTTPException(status_code=400, detail="You have reached the maximum allowed attempts for this task")
+    if not created:
+        return {
+            "student_task_id": new_student_task.id,
+            "status": new_student_task.status,
+            "message": "Experiment already in progress"
+        }
 
     # 根据任务类型执行不同的实验启动流程
     result = {"student_task_id": new_student_task.id}
-
-    if task_data.task_type == "guacamole":
-        # 启动ECS实例
-        ecs_data = await start_ecs_instance(db, task_data, new_student_task.id)
-        result.update(ecs_data)
-    elif task_data.task_type == "jupyter":
-        # 启动Jupyter容器
-        jupyter_data = await start_jupyter_container(db, task_data, new_student_task.id)
-        result.update(jupyter_data)
-    else:
-        raise HTTPException(status_code=400, detail=f"Unsupported task type: {task_data.task_type}")
+    try:
+        if task_data.task_type == "guacamole":
+            # 启动ECS实例
+            ecs_data = await start_ecs_instance(db, task_data, new_student_task.id)
+            result.update(ecs_data)
+        else:
+            # 启动Jupyter容器
+            jupyter_data = await start_jupyter_container(db, task_data, new_student_task.id)
+            result.update(jupyter_data)
+    except Exception:
+        # 启动失败的学生任务不再视为进行中，允许重新开始
+        db.rollback()
+        student_task.update_status(db, student_task_id=new_student_task.id, status="Error")
+        raise
 
     return result
 
@@ -110,6 +133,11 @@ async def stop_experiment(
         ecs = ecs_instance.get_by_student_task_id(db, student_task_id=student_task_id)
         if ecs and ecs.instance_id:
             await ecs_service.stop_instance(ecs.instance_id)
+
+        # 关闭该任务在任意网关节点上的远程桌面隧道
+        tunnel = await guacamole_registry.find_by_student_task(student_task_id)
+        if tunnel:
+            await guacamole_registry.request_close(tunnel["connection_id"])
             #ecs_instance.update_status(db, instance_id=ecs.instance_id, status="Stopped")
 
     elif student_task_obj.task_type == "jupyter":
@@ -265,6 +293,15 @@ async def start_ecs_instance(db: Session, task_data, student_task_id: int):
     if not env:
         raise HTTPException(status_code=404, detail="Environment template not found")
     print("config:",env.resource_config)
+    # 配置了预热池的模板优先从池中领取已开机的实例(含其他模板回收的、镜像与规格/安全组/VSwitch相同的实例)
+    if WarmPoolConfig.from_resource_config(env.resource_config):
+        pool_instance = ecs_pool_instance.claim_ready(
+            db, environment_id=env.id, student_task_id=student_task_id,
+            image_id=env.image, launch_keys=launch_candidates(env.resource_config)
+        )
+        if pool_instance:
+            return assign_pool_instance(db, pool_instance, student_task_id)
+
     # 创建ECS实例
     instance_result = await ecs_service.create_instance(
         task_id=task_data.id,
@@ -300,6 +337,41 @@ async def start_ecs_instance(db: Session, task_data, student_task_id: int):
     }
 
 
+# 辅助函数: 把预热池中的实例分配给学生任务
+def assign_pool_instance(db: Session, pool_instance, student_task_id: int):
+    """为池实例创建ECS实例记录，实例已在运行，学生任务直接进入Running"""
+    ecs_instance.create(
+        db,
+        obj_in=schemas.ECSInstanceCreate(
+            student_task_id=student_task_id,
+            instance_id=pool_instance.instance_id,
+            instance_name=pool_instance.instance_name,
+            image_id=pool_instance.image_id,
+            instance_type=pool_instance.instance_type,
+            status="Running",
+            public_ip=pool_instance.public_ip,
+            private_ip=pool_instance.private_ip,
+            region_id=pool_instance.region_id,
+            security_group_id=pool_instance.security_group_id,
+            vswitch_id=pool_instance.vswitch_id,
+            spot_strategy=pool_instance.spot_strategy,
+            password=pool_instance.password
+        )
+    )
+    student_task.update_status(db, student_task_id=student_task_id, status="Running")
+
+    # 按任务时长修改自动释放时间，并预先建立RDP隧道
+    adopt_pool_instance_task.delay(pool_instance_id=pool_instance.id, student_task_id=student_task_id)
+    if settings.GUACAMOLE_PREWARM_ENABLED:
+        guacamole_registry.request_prewarm(student_task_id)
+
+    return {
+        "message": "ECS instance assigned from warm pool",
+        "instance_id": pool_instance.instance_id,
+        "instance_name": pool_instance.instance_name
+    }
+
+
 # 辅助函数: 启动Jupyter容器
 async def start_jupyter_container(db: Session, task_data, student_task_id: int):
     """启动Jupyter容器并创建相关记录"""
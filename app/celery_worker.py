@@ -7,7 +7,7 @@ celery_app = Celery(
     "worker",
     broker=settings.CELERY_BROKER_URL,
     backend=settings.CELERY_RESULT_BACKEND,
-    include=["app.tasks.ecs_tasks","app.tasks.jupyter_tasks", "app.tasks.cleanup_tasks"]
+    include=["app.tasks.ecs_tasks","app.tasks.jupyter_tasks", "app.tasks.cleanup_tasks", "app.tasks.pool_tasks"]
 )
 
 # 设置Celery配置
@@ -26,19 +26,29 @@ celery_app.conf.update(
 celery_app.autodiscover_tasks([
     "app.tasks.ecs_tasks",
     "app.tasks.jupyter_tasks",
-    "app.tasks.cleanup_tasks"
+    "app.tasks.cleanup_tasks",
+    "app.tasks.pool_tasks"
 
 ])
 
 # 设置定时任务
 celery_app.conf.beat_schedule = {
-    "check-instance-status-every-10-seconds": {
+    "check-instance-status": {
         "task": "app.tasks.ecs_tasks.check_instance_status",
-        "schedule": 10.0,  # 每10秒执行一次
+        # 每轮只检查到期的实例，见 app/services/ecs_poll_schedule.py
+        "schedule": float(settings.ECS_POLL_FAST_SECONDS),
     },
     "check-expire-task-every-60-seconds": {
         "task": "app.tasks.cleanup_tasks.cleanup_expired_tasks",
         "schedule": 60.0,  # 每60秒执行一次
+    },
+    "refill-warm-pools": {
+        "task": "app.tasks.pool_tasks.refill_warm_pools",
+        "schedule": float(settings.ECS_POOL_REFILL_INTERVAL),
+    },
+    "flush-ecs-teardown": {
+        "task": "app.tasks.ecs_tasks.flush_ecs_teardown_task",
+        "schedule": float(settings.ECS_TEARDOWN_FLUSH_SECONDS),
     }
 }
 
@@ -17,7 +17,75 @@ class Settings(BaseSettings):
     # 阿里云相关配置
     ALIYUN_ACCESS_KEY_ID: str
     ALIYUN_ACCESS_KEY_SECRET: str
+    # 未指定region的请求(如环境模板未配置region_id)使用的默认region
+    ALIYUN_REGION_ID: str = "cn-hangzhou"
+    # 阿里云API限速: 每个API在每个region每秒的调用次数(所有worker共享，存于Redis)，default用于未列出的API；
+    # 令牌不足时最长等待秒数
+    ALIYUN_RATE_LIMITS: Dict[str, float] = {
+        "RunInstances": 5,
+        "DeleteInstance": 10,
+        "DeleteInstances": 10,
+        "DescribeInstances": 20,
+        "default": 10,
+    }
+    ALIYUN_RATE_LIMIT_MAX_WAIT: float = 60
+    # 限流、服务端暂时不可用或网络错误时的重试次数与退避秒数(指数增长，带随机抖动)
+    ALIYUN_MAX_RETRIES: int = 5
+    ALIYUN_RETRY_BASE_DELAY: float = 1
+    ALIYUN_RETRY_MAX_DELAY: float = 30
+    # 压测用的模拟阿里云: 开启后所有ECS API请求由进程内的模拟后端处理(app/services/fake_aliyun.py)，不产生费用。
+    # 模拟参数: API延迟中位数毫秒与对数正态sigma、每个API每个region每秒允许的调用次数(超过返回限流)、
+    # 创建时遇到售罄的概率与售罄持续秒数、开机到Running的秒数中位数与sigma、停机秒数
+    ALIYUN_FAKE: bool = False
+    ALIYUN_FAKE_PROFILE: Dict[str, float] = {
+        "latency_ms": 120,
+        "latency_sigma": 0.4,
+        "qps": 20,
+        "no_stock_rate": 0.01,
+        "no_stock_seconds": 300,
+        "boot_seconds": 45,
+        "boot_sigma": 0.3,
+        "stop_seconds": 10,
+    }
+    # ECS批量创建: 同一环境模板在窗口秒数内的创建请求合并为一次RunInstances(Amount=N)，0表示逐个创建。
+    # 只合并配置了固定密码的环境模板(批内实例共用该密码)，未配置密码的模板逐个创建、各用随机密码
+    ECS_BATCH_WINDOW_SECONDS: float = 3
+    # 单次RunInstances创建的最大实例数(阿里云上限100)
+    ECS_BATCH_MAX_AMOUNT: int = 100
+    # 实例状态检查: 分片数(>1时每轮分发到多个Celery任务，按实例ID取模)、每页查询的实例数、
+    # 每个分片并发调用DescribeInstances的线程数
+    ECS_STATUS_SHARDS: int = 1
+    ECS_STATUS_PAGE_SIZE: int = 500
+    ECS_DESCRIBE_CONCURRENCY: int = 4
+    # 实例状态检查的自适应间隔: 创建中/状态变化的实例按最短间隔检查(也是定时任务的周期)，
+    # 稳定运行的实例每次无变化间隔翻倍，直到最长间隔
+    ECS_POLL_FAST_SECONDS: int = 5
+    ECS_POLL_MAX_SECONDS: int = 300
+    # 实例状态变更事件推送(阿里云事件总线的HTTP目标或本地回放)的共享令牌，请求头 X-ECS-Event-Token，为空时不接收事件；
+    # 接收事件时定时检查只作兜底，实例的最短检查间隔改为 ECS_EVENT_POLL_SECONDS
+    ECS_EVENT_TOKEN: str = ""
+    ECS_EVENT_POLL_SECONDS: int = 60
+    # 实例运行后先探测RDP端口(3389)可以连接，学生任务才改为Running: 单个连接的超时秒数、同时探测的连接数，
+    # 开机超过 ECS_RDP_PROBE_MAX_WAIT 秒仍连不上(如安全组未放通)时不再等待
+    ECS_RDP_PROBE_ENABLED: bool = True
+    ECS_RDP_PROBE_TIMEOUT: float = 1.0
+    ECS_RDP_PROBE_CONCURRENCY: int = 500
+    ECS_RDP_PROBE_MAX_WAIT: int = 600
+    # 预热池: 补充/回收任务的执行间隔秒数，池中实例的最长存活小时数(到期由阿里云自动释放)
+    ECS_POOL_REFILL_INTERVAL: int = 30
+    ECS_POOL_INSTANCE_MAX_HOURS: int = 24
+    # 到期实例批量释放的间隔秒数
+    ECS_TEARDOWN_FLUSH_SECONDS: int = 5
+    # 实例规格/VSwitch选择: 可用区库存(DescribeAvailableResource)的缓存秒数，
+    # 统计创建成功率的时间窗口秒数，库存不足后该可用区+规格暂停使用的秒数
+    ECS_PLACEMENT_STOCK_TTL: int = 60
+    ECS_PLACEMENT_STATS_WINDOW: int = 1800
+    ECS_PLACEMENT_NO_STOCK_SECONDS: int = 300
     
+    # 请求幂等: 带 Idempotency-Key 请求头的请求(如开始实验)结果保留的秒数，
+    # 期间同一幂等键的重复请求直接返回第一次的结果
+    IDEMPOTENCY_TTL_SECONDS: int = 600
+
     # Celery
     CELERY_BROKER_URL: str = "redis://localhost:6379/0"
     CELERY_RESULT_BACKEND: str = "redis://localhost:6379/0"
@@ -31,6 +99,45 @@ class Settings(BaseSettings):
     # Guacamole配置
     GUACAMOLE_HOST: str = "localhost"
     GUACAMOLE_PORT: int = 4822
+    # guacd后端池，如 ["guacd1:4822", "guacd2:4822"]，为空时只使用上面的单个guacd
+    # 多个后端时定期健康检查，连续失败达到次数的后端不再分配新隧道
+    GUACAMOLE_BACKENDS: List[str] = []
+    GUACAMOLE_HEALTH_CHECK_INTERVAL: int = 10
+    GUACAMOLE_HEALTH_CHECK_TIMEOUT: float = 3
+    GUACAMOLE_HEALTH_CHECK_FAILURES: int = 2
+    # 隧道发送帧的合并上限: 字节数与等待毫秒数
+    GUACAMOLE_FRAME_MAX_BYTES: int = 65536
+    GUACAMOLE_FRAME_MAX_DELAY_MS: float = 5
+    # 每个会话发送队列的上限，超限时按策略处理: drop / throttle / disconnect
+    GUACAMOLE_SEND_QUEUE_MAX_BYTES: int = 4 * 1024 * 1024
+    GUACAMOLE_SEND_QUEUE_MAX_FRAMES: int = 256
+    GUACAMOLE_BACKPRESSURE_POLICY: str = "drop"
+    # WebSocket断开后隧道保留等待重连的秒数(0表示立即关闭)
+    GUACAMOLE_RESUME_GRACE_SECONDS: int = 60
+    # 自适应画质: 初始档位(high/medium/low/minimal)、sync回复延迟的降档/升档阈值、
+    # 采样周期及两次切换档位之间的最小间隔秒数
+    GUACAMOLE_ADAPTIVE_QUALITY: bool = True
+    GUACAMOLE_QUALITY_DEFAULT: str = "medium"
+    GUACAMOLE_QUALITY_LAG_HIGH_MS: int = 500
+    GUACAMOLE_QUALITY_LAG_LOW_MS: int = 150
+    GUACAMOLE_QUALITY_SAMPLE_SECONDS: float = 2
+    GUACAMOLE_QUALITY_MIN_INTERVAL: int = 30
+    # 实例变为Running后预先建立RDP隧道: 预热使用的屏幕尺寸、未被接入时的保留秒数、重试次数与间隔
+    GUACAMOLE_PREWARM_ENABLED: bool = True
+    # 是否部署了独立的隧道网关(gateway.py)，是则API进程不处理预热
+    GUACAMOLE_STANDALONE_GATEWAY: bool = False
+    GUACAMOLE_PREWARM_WIDTH: int = 1280
+    GUACAMOLE_PREWARM_HEIGHT: int = 720
+    GUACAMOLE_PREWARM_TTL: int = 900
+    GUACAMOLE_PREWARM_RETRIES: int = 5
+    GUACAMOLE_PREWARM_RETRY_DELAY: int = 15
+    # Prometheus抓取隧道指标所需的令牌(Bearer或?token=)，为空时不开放抓取接口
+    GUACAMOLE_METRICS_TOKEN: Optional[str] = None
+    # 各网关进程把隧道指标快照写入Redis的间隔秒数，抓取接口汇总所有进程
+    GUACAMOLE_METRICS_PUBLISH_INTERVAL: int = 10
+    # 隧道网关节点ID(默认 主机名:进程号)及Redis隧道注册表的TTL秒数
+    GUACAMOLE_GATEWAY_NODE_ID: Optional[str] = None
+    GUACAMOLE_REGISTRY_TTL: int = 90
 
     model_config = {
         "case_sensitive": True,
@@ -0,0 +1,10 @@
+import redis
+
+from app.core.config import settings
+
+# 暂时与Celery共用Redis
+redis_client = redis.Redis.from_url(
+    settings.CELERY_BROKER_URL,
+    encoding="utf-8",
+    decode_responses=True
+)
@@ -1,8 +1,11 @@
-from typing import List, Optional, Dict, Any
-from datetime import datetime
+from typing import List, Optional, Dict, Any, Tuple
+from datetime import datetime, timedelta
+from sqlalchemy import and_, func, or_
 from sqlalchemy.orm import Session
 
-from app.models.ecs import ECSInstance
+from app.models.ecs import ECSInstance, ECSPoolInstance
+from app.models.task import StudentTask
+from app.services.ecs_reconciler import InstanceRow, ReconcileResult
 from app.schemas.ecs import ECSInstanceCreate, ECSInstanceUpdate
 from .base import CRUDBase
 
@@ -18,9 +21,10 @@ class CRUDECSInstance(CRUDBase[ECSInstance, ECSInstanceCreate, ECSInstanceUpdate
     def get_by_instance_id(
             self, db: Session, *, instance_id: str
     ) -> Optional[ECSInstance]:
+        # 回收复用的实例会先后对应多条记录，取最新的一条
         return db.query(ECSInstance).filter(
             ECSInstance.instance_id == instance_id
-        ).first()
+        ).order_by(ECSInstance.id.desc()).first()
 
     def update_status_by_instance_name(self, db: Session, *, instance_name: str, status: str, instance_id: str=None, password:str=None) -> ECSInstance:
         instance = db.query(ECSInstance).filter(
@@ -41,6 +45,23 @@ class CRUDECSInstance(CRUDBase[ECSInstance, ECSInstanceCreate, ECSInstanceUpdate
         db.refresh(instance)
         return instance
 
+    def assign_instance_ids(
+            self, db: Session, *, assignments: Dict[str, str], status: str, password: str = None
+    ) -> List[str]:
+        """按实例名称批量写入阿里云实例ID并一次提交，返回已找到记录的实例名称"""
+        instances = db.query(ECSInstance).filter(
+            ECSInstance.instance_name.in_(list(assignments.keys()))
+        ).all()
+        now = datetime.utcnow()
+        for instance in instances:
+            instance.instance_id = assignments[instance.instance_name]
+            instance.status = status
+            if password:
+                instance.password = password
+            instance.updated_at = now
+        db.commit()
+        return [instance.instance_name for instance in instances]
+
     def update_status(
             self, db: Session, *, instance_id: str, status: str,
             public_ip: str = None, private_ip: str = None
@@ -62,6 +83,93 @@ class CRUDECSInstance(CRUDBase[ECSInstance, ECSInstanceCreate, ECSInstanceUpdate
         db.refresh(instance)
         return instance
 
+    def get_reconcile_rows(
+            self, db: Session, *, created_before: datetime = None, after_id: int = 0, limit: int = None,
+            shard: int = 0, shards: int = 1, instance_ids: List[str] = None
+    ) -> List[InstanceRow]:
+        """
+        获取需要与阿里云对账的实例: 活跃、已有实例ID且创建超过一段时间
+
+        只查询对账需要的列，并带出学生任务的当前状态，便于只写入有变化的行。
+        按主键键集分页(id > after_id)，shards > 1 时只返回 id % shards == shard 的实例；
+        指定instance_ids时只返回这些实例(如收到状态变更事件的实例)
+        """
+        query = db.query(
+            ECSInstance.id, ECSInstance.instance_id, ECSInstance.region_id, ECSInstance.status,
+            ECSInstance.private_ip, ECSInstance.public_ip, ECSInstance.student_task_id, StudentTask.status
+        ).outerjoin(
+            StudentTask, StudentTask.id == ECSInstance.student_task_id
+        ).filter(
+            ECSInstance.status.notin_(["Stopped", "Error"]),
+            ECSInstance.instance_id.isnot(None),
+            ECSInstance.id > after_id
+        )
+        if created_before is not None:
+            query = query.filter(ECSInstance.created_at <= created_before)
+        if instance_ids is not None:
+            query = query.filter(ECSInstance.instance_id.in_(instance_ids))
+        if shards > 1:
+            query = query.filter(ECSInstance.id % shards == shard)
+        query = query.order_by(ECSInstance.id)
+        if limit:
+            query = query.limit(limit)
+        return [InstanceRow(*row) for row in query.all()]
+
+    def get_regions(self, db: Session, *, instance_ids: List[str]) -> Dict[str, Optional[str]]:
+        """实例ID -> region"""
+        if not instance_ids:
+            return {}
+        rows = db.query(ECSInstance.instance_id, ECSInstance.region_id).filter(
+            ECSInstance.instance_id.in_(instance_ids)
+        ).all()
+        return {instance_id: region_id for instance_id, region_id in rows}
+
+    def mark_released(self, db: Session, *, instance_ids: List[str]) -> List[int]:
+        """
+        实例已释放: 在一个事务中把实例改为Stopped，仍未停止的学生任务改为Stopped并记录结束时间
+
+        Returns:
+            更新的ECS实例主键
+        """
+        if not instance_ids:
+            return []
+        rows = db.query(ECSInstance.id, ECSInstance.student_task_id).filter(
+            ECSInstance.instance_id.in_(instance_ids)
+        ).all()
+        if not rows:
+            return []
+        now = datetime.utcnow()
+        try:
+            db.query(ECSInstance).filter(
+                ECSInstance.id.in_([row.id for row in rows])
+            ).update({ECSInstance.status: "Stopped", ECSInstance.updated_at: now}, synchronize_session=False)
+            db.query(StudentTask).filter(
+                StudentTask.id.in_([row.student_task_id for row in rows]),
+                StudentTask.status != "Stopped"
+            ).update({
+                StudentTask.status: "Stopped",
+                StudentTask.end_at: func.coalesce(StudentTask.end_at, now)
+            }, synchronize_session=False)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        return [row.id for row in rows]
+
+    def apply_reconcile(self, db: Session, *, result: ReconcileResult):
+        """在一个事务中批量写入对账结果"""
+        try:
+            if result.instance_updates:
+                db.bulk_update_mappings(ECSInstance, result.instance_updates)
+            for status, student_task_ids in result.student_task_updates.items():
+                db.query(StudentTask).filter(
+                    StudentTask.id.in_(student_task_ids)
+                ).update({StudentTask.status: status}, synchronize_session=False)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
     def get_active_instances(
             self, db: Session, *, skip: int = 0, limit: int = 100
     ) -> List[ECSInstance]:
@@ -71,4 +179,89 @@ class CRUDECSInstance(CRUDBase[ECSInstance, ECSInstanceCreate, ECSInstanceUpdate
         ).offset(skip).limit(limit).all()
 
 
-ecs_instance = CRUDECSInstance(ECSInstance)
\ No newline at end of file
+class CRUDECSPoolInstance(CRUDBase[ECSPoolInstance, ECSInstanceCreate, ECSInstanceUpdate]):
+    def get_by_status(
+            self, db: Session, *, statuses: List[str], environment_id: int = None
+    ) -> List[ECSPoolInstance]:
+        query = db.query(ECSPoolInstance).filter(ECSPoolInstance.status.in_(statuses))
+        if environment_id is not None:
+            query = query.filter(ECSPoolInstance.environment_id == environment_id)
+        return query.order_by(ECSPoolInstance.id).all()
+
+    def count_by_status(self, db: Session, *, environment_id: int) -> Dict[str, int]:
+        rows = db.query(ECSPoolInstance.status, func.count(ECSPoolInstance.id)).filter(
+            ECSPoolInstance.environment_id == environment_id,
+            ECSPoolInstance.status.in_(["Stopping", "Pending", "Ready"])
+        ).group_by(ECSPoolInstance.status).all()
+        return {status: count for status, count in rows}
+
+    def environment_ids(self, db: Session) -> List[int]:
+        """池中仍有未释放实例的环境模板"""
+        rows = db.query(ECSPoolInstance.environment_id).filter(
+            ECSPoolInstance.status.in_(["Stopping", "Pending", "Ready"])
+        ).distinct().all()
+        return [row[0] for row in rows]
+
+    def claim_ready(
+            self, db: Session, *, environment_id: int, student_task_id: int, min_remaining_minutes: int = 30,
+            image_id: str = None, launch_keys: List[Tuple[str, str, str]] = None
+    ) -> Optional[ECSPoolInstance]:
+        """
+        领取一个已就绪的实例
+
+        除本环境模板的池实例外，也可以领取其他模板回收的、镜像与
+        (实例规格, 安全组, VSwitch) 都相同的实例(launch_keys为本模板的候选配置)。
+        使用 SELECT ... FOR UPDATE SKIP LOCKED，并发领取的请求不会拿到同一台实例；
+        距自动释放不足min_remaining_minutes分钟的实例不再分配
+        """
+        now = datetime.utcnow()
+        match = ECSPoolInstance.environment_id == environment_id
+        if image_id and launch_keys:
+            match = or_(match, *[
+                and_(
+                    ECSPoolInstance.image_id == image_id,
+                    ECSPoolInstance.instance_type == instance_type,
+                    ECSPoolInstance.security_group_id == security_group_id,
+                    ECSPoolInstance.vswitch_id == vswitch_id
+                )
+                for instance_type, security_group_id, vswitch_id in launch_keys
+            ])
+        instance = db.query(ECSPoolInstance).filter(
+            match,
+            ECSPoolInstance.status == "Ready",
+            ECSPoolInstance.auto_release_time > now + timedelta(minutes=min_remaining_minutes)
+        ).order_by(ECSPoolInstance.ready_at).with_for_update(skip_locked=True).first()
+        if not instance:
+            db.rollback()
+            return None
+
+        instance.status = "Assigned"
+        instance.student_task_id = student_task_id
+        instance.assigned_at = now
+        db.commit()
+        db.refresh(instance)
+        return instance
+
+    def transition(self, db: Session, *, pool_instance_id: int, from_status: str, to_status: str) -> bool:
+        """条件更新状态，状态已被其他请求改变(如刚被领取)时返回False"""
+        count = db.query(ECSPoolInstance).filter(
+            ECSPoolInstance.id == pool_instance_id,
+            ECSPoolInstance.status == from_status
+        ).update({ECSPoolInstance.status: to_status, ECSPoolInstance.updated_at: datetime.utcnow()},
+                 synchronize_session=False)
+        db.commit()
+        return count == 1
+
+    def update_status(self, db: Session, *, pool_instance: ECSPoolInstance, status: str, **fields) -> ECSPoolInstance:
+        pool_instance.status = status
+        for key, value in fields.items():
+            setattr(pool_instance, key, value)
+        pool_instance.updated_at = datetime.utcnow()
+        db.add(pool_instance)
+        db.commit()
+        db.refresh(pool_instance)
+        return pool_instance
+
+
+ecs_instance = CRUDECSInstance(ECSInstance)
+ecs_pool_instance = CRUDECSPoolInstance(ECSPoolInstance)
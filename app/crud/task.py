@@ -1,4 +1,4 @@
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
 from sqlalchemy.orm import Session, joinedload
 import datetime
 from app.models.task import Task, TaskAttachment, TaskAssignment, StudentTask, CeleryTaskLog
@@ -14,6 +14,9 @@ from app.models.ecs import ECSInstance  # 添加导入
 from app.models.jupyter import JupyterContainer  # 添加导入
 from .base import CRUDBase
 
+# 实验还在进行中(创建中、开机中或运行中)的学生任务状态
+IN_PROGRESS_STATUSES = ("pending", "creating", "Starting", "Running")
+
 
 class CRUDTask(CRUDBase[Task, TaskCreate, TaskUpdate]):
     def create_with_admin(
@@ -142,6 +145,45 @@ class CRUDStudentTask(CRUDBase[StudentTask, StudentTaskCreate, StudentTaskCreate
         db.refresh(db_obj)
         return db_obj
 
+    def start_attempt(self, db: Session, *, student_id: int, task_obj: Task) -> Tuple[Optional[StudentTask], bool]:
+        """
+        分配实验次数并创建学生任务
+
+        先锁定学生行(SELECT ... FOR UPDATE)，同一学生的并发请求(重复点击、请求重试)依次执行；
+        最近一次实验仍在进行时不再创建，返回该学生任务
+
+        Returns:
+            (学生任务, 是否新创建)；已达到最大实验次数时学生任务为None
+        """
+        # 结束之前的事务，加锁后的查询读取最新提交的数据
+        db.commit()
+        try:
+            db.query(Student.id).filter(Student.id == student_id).with_for_update().first()
+            latest = self.get_latest_for_student_task(db, student_id=student_id, task_id=task_obj.id)
+            if latest and latest.status in IN_PROGRESS_STATUSES:
+                db.commit()
+                return latest, False
+            attempt_number = latest.attempt_number + 1 if latest else 1
+            if attempt_number > task_obj.max_attempts:
+                db.commit()
+                return None, False
+
+            db_obj = StudentTask(
+                student_id=student_id,
+                task_id=task_obj.id,
+                attempt_number=attempt_number,
+                task_type=task_obj.task_type,
+                status="pending",
+                start_at=datetime.datetime.utcnow()
+            )
+            db.add(db_obj)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        db.refresh(db_obj)
+        return db_obj, True
+
     def get_latest_for_student_task(
             self, db: Session, *, student_id: int, task_id: int
     ) -> Optional[StudentTask]:
@@ -182,6 +224,18 @@ class CRUDStudentTask(CRUDBase[StudentTask, StudentTaskCreate, StudentTaskCreate
         db.refresh(student_task)
         return student_task
 
+    def update_status_many(
+            self, db: Session, *, student_task_ids: List[int], status: str
+    ) -> int:
+        """批量更新学生任务状态，返回更新的行数"""
+        if not student_task_ids:
+            return 0
+        count = db.query(StudentTask).filter(
+            StudentTask.id.in_(student_task_ids)
+        ).update({StudentTask.status: status}, synchronize_session=False)
+        db.commit()
+        return count
+
     def update_heartbeat(
             self, db: Session, *, student_task_id: int
     ) -> StudentTask:
@@ -33,4 +33,31 @@ class ECSInstance(Base):
 
     # 关系
     student_task = relationship("StudentTask", back_populates="ecs_instance")
-    guacamole_connection = relationship("GuacamoleConnection", back_populates="ecs_instance", uselist=False)
\ No newline at end of file
+    guacamole_connection = relationship("GuacamoleConnection", back_populates="ecs_instance", uselist=False)
+
+class ECSPoolInstance(Base):
+    """预热池中已创建、尚未分配给学生任务的ECS实例"""
+    __tablename__ = "ecs_pool_instances"
+
+    id = Column(BigInteger, primary_key=True, index=True)
+    environment_id = Column(BigInteger, ForeignKey("environment_templates.id", ondelete="CASCADE"), nullable=False, index=True)
+    instance_id = Column(String(100), index=True)
+    instance_name = Column(String(200))
+    image_id = Column(String(100))
+    instance_type = Column(String(100))
+    region_id = Column(String(50))
+    security_group_id = Column(String(100))
+    vswitch_id = Column(String(100))
+    spot_strategy = Column(String(50))
+    password = Column(String(255))
+    public_ip = Column(String(50))
+    private_ip = Column(String(50))
+    # Pending(创建中) / Ready(已开机可领取) / Assigned(已分配) / Released(已释放) / Error
+    # 学生停止实验后回收复用的实例先为Stopping(停机中)，停机后重置系统盘并开机，进入Pending
+    status = Column(String(50), index=True)
+    student_task_id = Column(Integer, ForeignKey("student_tasks.id", ondelete="SET NULL"))
+    auto_release_time = Column(DateTime)
+    ready_at = Column(DateTime)
+    assigned_at = Column(DateTime)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -5,6 +5,6 @@ from .student import Student, StudentCreate, StudentUpdate
 from .task import Task, TaskCreate, TaskUpdate, TaskDetail
 from .task import StudentTask, StudentTaskCreate, StudentTaskDetail
 from .environment import EnvironmentTemplate, EnvironmentTemplateCreate, EnvironmentTemplateUpdate, EnvironmentTemplateDetail
-from .ecs import ECSInstance, ECSInstanceCreate, ECSInstanceUpdate
+from .ecs import ECSInstance, ECSInstanceCreate, ECSInstanceUpdate, ECSPoolInstance
 from .guacamole import GuacamoleConnection, GuacamoleConnectionCreate, GuacamoleCredentials
 from .jupyter import JupyterContainer, JupyterContainerCreate, JupyterAccessInfo
\ No newline at end of file
@@ -50,4 +50,24 @@ class ECSInstanceInDBBase(ECSInstanceBase):
 
 class ECSInstance(ECSInstanceInDBBase):
     """API响应中的ECS实例模型"""
-    pass
\ No newline at end of file
+    pass
+
+
+class ECSPoolInstance(BaseModel):
+    """预热池实例的响应模型"""
+    id: int
+    environment_id: int
+    instance_id: Optional[str] = None
+    instance_name: Optional[str] = None
+    instance_type: Optional[str] = None
+    region_id: Optional[str] = None
+    private_ip: Optional[str] = None
+    status: Optional[str] = None
+    student_task_id: Optional[int] = None
+    auto_release_time: Optional[datetime] = None
+    ready_at: Optional[datetime] = None
+    assigned_at: Optional[datetime] = None
+    created_at: datetime
+
+    class Config:
+        orm_mode = True
@@ -1,22 +1,89 @@
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple
 import json
 import datetime
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from aliyunsdkcore.client import AcsClient
 from aliyunsdkcore.acs_exception.exceptions import ClientException, ServerException
 from aliyunsdkecs.request.v20140526.RunInstancesRequest import RunInstancesRequest
 from aliyunsdkecs.request.v20140526.DescribeInstanceStatusRequest import DescribeInstanceStatusRequest
 from aliyunsdkecs.request.v20140526.DeleteInstanceRequest import DeleteInstanceRequest
+from aliyunsdkecs.request.v20140526.DeleteInstancesRequest import DeleteInstancesRequest
 from aliyunsdkecs.request.v20140526.DescribeInstancesRequest import DescribeInstancesRequest
+from aliyunsdkecs.request.v20140526.ModifyInstanceAutoReleaseTimeRequest import ModifyInstanceAutoReleaseTimeRequest
+from aliyunsdkecs.request.v20140526.DescribeAvailableResourceRequest import DescribeAvailableResourceRequest
+from aliyunsdkecs.request.v20140526.DescribeVSwitchesRequest import DescribeVSwitchesRequest
+from aliyunsdkecs.request.v20140526.StopInstanceRequest import StopInstanceRequest
+from aliyunsdkecs.request.v20140526.DescribeDisksRequest import DescribeDisksRequest
+from aliyunsdkecs.request.v20140526.ReInitDiskRequest import ReInitDiskRequest
 
 from app.core.config import settings
+from app.services.aliyun_rate_limit import aliyun_rate_limiter, is_retryable, retry_delay
+from app.services.fake_aliyun import fake_aliyun
+
+logger = logging.getLogger(__name__)
 
 
 class AliCloudService:
     def __init__(self):
-        self.client = AcsClient(
-            settings.ALIYUN_ACCESS_KEY_ID,
-            settings.ALIYUN_ACCESS_KEY_SECRET
+        # 按region缓存的AcsClient，各region的请求发往对应的接入点
+        self._clients: Dict[str, AcsClient] = {}
+        self._lock = threading.Lock()
+        # 跨region并发查询使用的线程池
+        self._executor = ThreadPoolExecutor(
+            max_workers=settings.ECS_DESCRIBE_CONCURRENCY, thread_name_prefix="aliyun"
         )
+
+    def get_client(self, region_id: Optional[str] = None) -> AcsClient:
+        """获取region对应的AcsClient，未指定region时使用ALIYUN_REGION_ID"""
+        region_id = region_id or settings.ALIYUN_REGION_ID
+        if settings.ALIYUN_FAKE:
+            # 压测: 请求由进程内的模拟后端处理，不调用阿里云
+            return fake_aliyun.client(region_id)
+        client = self._clients.get(region_id)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(region_id)
+                if client is None:
+                    # 重试由 _do_action 统一处理(限速、抖动退避)，关闭SDK自带的重试
+                    client = AcsClient(
+                        settings.ALIYUN_ACCESS_KEY_ID,
+                        settings.ALIYUN_ACCESS_KEY_SECRET,
+                        region_id,
+                        auto_retry=False
+                    )
+                    self._clients[region_id] = client
+        return client
+
+    @property
+    def client(self) -> AcsClient:
+        return self.get_client()
+
+    def _do_action(self, request, region_id: Optional[str] = None) -> bytes:
+        """
+        发送请求: 先按API和region限速，遇到限流、服务端暂时不可用或网络错误时
+        按指数退避加抖动重试，其余错误直接抛出
+        """
+        region_id = region_id or settings.ALIYUN_REGION_ID
+        action = request.get_action_name()
+        client = self.get_client(region_id)
+        attempt = 0
+        while True:
+            aliyun_rate_limiter.acquire(action, region_id)
+            try:
+                return client.do_action_with_exception(request)
+            except (ServerException, ClientException) as e:
+                if attempt >= settings.ALIYUN_MAX_RETRIES or not is_retryable(e):
+                    raise
+                delay = retry_delay(attempt)
+                attempt += 1
+                logger.warning(
+                    f"{action}({region_id}) 失败，{delay:.1f} 秒后第 {attempt} 次重试: {e.get_error_code()}"
+                )
+                time.sleep(delay)
     
     def create_ecs_instance(
         self,
@@ -29,10 +96,15 @@ class AliCloudService:
         spot_strategy: str = None,
         password: str = None,
         auto_release_time: Optional[datetime.datetime] = None,
-        custom_params: Dict[str, Any] = None
+        custom_params: Dict[str, Any] = None,
+        amount: int = 1,
+        min_amount: Optional[int] = None,
+        client_token: Optional[str] = None
     ) -> Dict[str, Any]:
         request = RunInstancesRequest()
         request.set_accept_format('json')
+        # 幂等令牌: 超时等情况重试时不会重复创建实例
+        request.set_ClientToken(client_token or str(uuid.uuid4()))
         
         # 必须参数
         request.set_ImageId(image_id)
@@ -40,6 +112,11 @@ class AliCloudService:
         request.set_SecurityGroupId(security_group_id)
         request.set_VSwitchId(vswitch_id)
         request.set_InternetMaxBandwidthOut(internet_max_bandwidth_out)
+        # 批量创建: 库存不足amount台时至少创建min_amount台，否则全部失败
+        if amount > 1:
+            request.set_Amount(amount)
+            if min_amount:
+                request.set_MinAmount(min_amount)
         if spot_strategy:
             request.set_SpotStrategy(spot_strategy)
         if password:
@@ -60,20 +137,21 @@ class AliCloudService:
                     method(value)
         
         try:
-            response = self.client.do_action_with_exception(request)
+            response = self._do_action(request, region_id)
             result = json.loads(response)
             return {"success": True, "instance_ids": result.get("InstanceIdSets", {}).get("InstanceIdSet", [])}
         except (ServerException, ClientException) as e:
-            return {"success": False, "error": str(e)}
+            # error_code用于判断是否库存不足，可换可用区/规格重试
+            return {"success": False, "error": str(e), "error_code": e.get_error_code()}
 
-    def describe_instance_status(self, instance_ids: List[str]) -> Dict[str, Any]:
+    def describe_instance_status(self, instance_ids: List[str], region_id: Optional[str] = None) -> Dict[str, Any]:
         request = DescribeInstanceStatusRequest()
         request.set_accept_format('json')
 
         request.set_InstanceIds(instance_ids)
         
         try:
-            response = self.client.do_action_with_exception(request)
+            response = self._do_action(request, region_id)
             result = json.loads(response)
             return {
                 "success": True, 
@@ -82,14 +160,14 @@ class AliCloudService:
         except (ServerException, ClientException) as e:
             return {"success": False, "error": str(e)}
 
-    def describe_instance(self, instance_ids: List[str]) -> Dict[str, Any]:
+    def describe_instance(self, instance_ids: List[str], region_id: Optional[str] = None) -> Dict[str, Any]:
         request = DescribeInstancesRequest()
         request.set_accept_format('json')
         request.set_InstanceIds(instance_ids)
         request.set_PageSize(100)
 
         try:
-            response = self.client.do_action_with_exception(request)
+            response = self._do_action(request, region_id)
             result = json.loads(response)
             return {
                 "success": True,
@@ -97,7 +175,124 @@ class AliCloudService:
             }
         except (ServerException, ClientException) as e:
             return {"success": False, "error": str(e)}
-    
+
+    def describe_instances_concurrently(
+            self, batches: List[Tuple[Optional[str], List[str]]]
+    ) -> List[Dict[str, Any]]:
+        """
+        并发查询多批实例
+
+        Args:
+            batches: (region, 实例ID列表) 列表，每批不超过100个实例
+
+        Returns:
+            与batches顺序一致的describe_instance结果
+        """
+        if len(batches) <= 1:
+            return [self.describe_instance(instance_ids, region_id) for region_id, instance_ids in batches]
+        futures = [
+            self._executor.submit(self.describe_instance, instance_ids, region_id)
+            for region_id, instance_ids in batches
+        ]
+        return [future.result() for future in futures]
+
+    def modify_auto_release_time(
+            self, instance_id: str, auto_release_time: datetime.datetime, region_id: Optional[str] = None
+    ) -> Dict[str, Any]:
+        request = ModifyInstanceAutoReleaseTimeRequest()
+        request.set_accept_format('json')
+        request.set_InstanceId(instance_id)
+        request.set_AutoReleaseTime(auto_release_time.strftime('%Y-%m-%dT%H:%M:%SZ'))
+
+        try:
+            response = self._do_action(request, region_id)
+            return {"success": True, "result": json.loads(response)}
+        except (ServerException, ClientException) as e:
+            return {"success": False, "error": str(e)}
+
+    def describe_available_resource(self, region_id: str, spot_strategy: Optional[str] = None) -> Dict[str, Any]:
+        """
+        查询region内各可用区的实例规格库存
+
+        Returns:
+            zones: 可用区ID -> {实例规格: 库存状态(Available/SoldOut)}
+        """
+        request = DescribeAvailableResourceRequest()
+        request.set_accept_format('json')
+        request.set_DestinationResource("InstanceType")
+        request.set_InstanceChargeType("PostPaid")
+        if spot_strategy:
+            request.set_SpotStrategy(spot_strategy)
+
+        try:
+            response = self._do_action(request, region_id)
+            result = json.loads(response)
+            zones = {}
+            for zone in result.get("AvailableZones", {}).get("AvailableZone", []):
+                types = zones.setdefault(zone["ZoneId"], {})
+                for resource in zone.get("AvailableResources", {}).get("AvailableResource", []):
+                    for supported in resource.get("SupportedResources", {}).get("SupportedResource", []):
+                        types[supported["Value"]] = supported.get("Status")
+            return {"success": True, "zones": zones}
+        except (ServerException, ClientException) as e:
+            return {"success": False, "error": str(e)}
+
+    def describe_vswitch_zone(self, region_id: str, vswitch_id: str) -> Dict[str, Any]:
+        """查询VSwitch所在的可用区"""
+        request = DescribeVSwitchesRequest()
+        request.set_accept_format('json')
+        request.set_VSwitchId(vswitch_id)
+
+        try:
+            response = self._do_action(request, region_id)
+            vswitches = json.loads(response).get("VSwitches", {}).get("VSwitch", [])
+            if not vswitches:
+                return {"success": False, "error": f"VSwitch {vswitch_id} not found"}
+            return {"success": True, "zone_id": vswitches[0]["ZoneId"]}
+        except (ServerException, ClientException) as e:
+            return {"success": False, "error": str(e)}
+
+    def stop_instance(self, region_id: str, instance_id: str, force: bool = True) -> Dict[str, Any]:
+        """停止实例，停机后继续保留计算资源(KeepCharging)，重新启动时不会因库存不足失败"""
+        request = StopInstanceRequest()
+        request.set_accept_format('json')
+        request.set_InstanceId(instance_id)
+        request.set_ForceStop(force)
+        request.set_StoppedMode("KeepCharging")
+
+        try:
+            response = self._do_action(request, region_id)
+            return {"success": True, "result": json.loads(response)}
+        except (ServerException, ClientException) as e:
+            return {"success": False, "error": str(e), "error_code": e.get_error_code()}
+
+    def reinit_system_disk(self, region_id: str, instance_id: str, password: str = None) -> Dict[str, Any]:
+        """
+        把已停止实例的系统盘重新初始化为创建时的镜像，完成后自动开机
+
+        数据盘不受影响，系统盘上的改动全部丢失
+        """
+        disks_request = DescribeDisksRequest()
+        disks_request.set_accept_format('json')
+        disks_request.set_InstanceId(instance_id)
+        disks_request.set_DiskType("system")
+
+        try:
+            disks = json.loads(self._do_action(disks_request, region_id)).get("Disks", {}).get("Disk", [])
+            if not disks:
+                return {"success": False, "error": f"System disk of {instance_id} not found"}
+
+            request = ReInitDiskRequest()
+            request.set_accept_format('json')
+            request.set_DiskId(disks[0]["DiskId"])
+            request.set_AutoStartInstance(True)
+            if password:
+                request.set_Password(password)
+            response = self._do_action(request, region_id)
+            return {"success": True, "result": json.loads(response)}
+        except (ServerException, ClientException) as e:
+            return {"success": False, "error": str(e), "error_code": e.get_error_code()}
+
     def delete_instance(self, region_id: str, instance_id: str, force: bool = True) -> Dict[str, Any]:
         request = DeleteInstanceRequest()
         request.set_accept_format('json')
@@ -105,11 +300,26 @@ class AliCloudService:
         request.set_Force(force)
         
         try:
-            response = self.client.do_action_with_exception(request)
+            response = self._do_action(request, region_id)
             result = json.loads(response)
             return {"success": True, "result": result}
         except (ServerException, ClientException) as e:
-            return {"success": False, "error": str(e)}
+            return {"success": False, "error": str(e), "error_code": e.get_error_code()}
+
+    def delete_instances(self, region_id: str, instance_ids: List[str], force: bool = True) -> Dict[str, Any]:
+        """一次释放同一region的多个实例(最多100个)"""
+        request = DeleteInstancesRequest()
+        request.set_accept_format('json')
+        request.set_InstanceIds(instance_ids)
+        request.set_Force(force)
+        # 幂等令牌: 超时重试时不会重复提交
+        request.set_ClientToken(str(uuid.uuid4()))
+
+        try:
+            response = self._do_action(request, region_id)
+            return {"success": True, "result": json.loads(response)}
+        except (ServerException, ClientException) as e:
+            return {"success": False, "error": str(e), "error_code": e.get_error_code()}
 
 
-ali_cloud_service = AliCloudService()
\ No newline at end of file
+ali_cloud_service = AliCloudService()
@@ -0,0 +1,109 @@
+import logging
+import random
+import time
+from typing import Optional
+
+from app.core.config import settings
+from app.core.redis_client import redis_client
+
+logger = logging.getLogger(__name__)
+
+BUCKET_KEY = "aliyun:ratelimit:{}:{}"  # 每个 API+region 的令牌桶 (hash: tokens, ts)
+
+# 令牌桶: 按经过的时间补充令牌，足够时扣除一个并返回0，否则返回需要等待的毫秒数
+_TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1])
+local ts = tonumber(bucket[2])
+if tokens == nil then
+    tokens = capacity
+    ts = now
+end
+tokens = math.min(capacity, tokens + (now - ts) * rate / 1000)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = math.ceil((1 - tokens) * 1000 / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity * 1000 / rate) + 1000)
+return wait
+"""
+
+# 被限流或服务端暂时不可用的错误码，可以重试
+RETRYABLE_ERROR_CODES = {
+    "Throttling", "Throttling.User", "Throttling.Api", "Throttling.Resource",
+    "ServiceUnavailable", "InternalError", "UnknownError",
+}
+# SDK网络错误
+RETRYABLE_CLIENT_ERROR_CODES = {"SDK.HttpError", "SDK.ServerUnreachable"}
+
+
+class AliyunRateLimiter:
+    """
+    阿里云API调用限速
+
+    每个API和region一个令牌桶，存放在Redis中，所有Celery worker共享同一限额；
+    令牌不足时等待而不是失败，使开课时的突发创建请求平滑排队。Redis不可用时不限速。
+    """
+
+    def __init__(self):
+        self._script = None
+
+    def rate(self, action: str) -> float:
+        limits = settings.ALIYUN_RATE_LIMITS
+        return float(limits.get(action, limits.get("default", 10)))
+
+    def acquire(self, action: str, region_id: str, max_wait: Optional[float] = None) -> float:
+        """
+        获取一个令牌，返回等待的秒数
+
+        超过max_wait仍未获取到时不再等待，直接放行，由限流重试兜底
+        """
+        rate = self.rate(action)
+        if rate <= 0:
+            return 0
+        max_wait = settings.ALIYUN_RATE_LIMIT_MAX_WAIT if max_wait is None else max_wait
+        key = BUCKET_KEY.format(action, region_id)
+        started = time.monotonic()
+        while True:
+            try:
+                if self._script is None:
+                    self._script = redis_client.register_script(_TOKEN_BUCKET_SCRIPT)
+                wait_ms = self._script(keys=[key], args=[rate, max(rate, 1), int(time.time() * 1000)])
+            except Exception as e:
+                logger.warning(f"阿里云API限速不可用，直接调用: {e}")
+                return time.monotonic() - started
+            waited = time.monotonic() - started
+            if not wait_ms:
+                return waited
+            if waited >= max_wait:
+                logger.warning(f"等待 {action}({region_id}) 调用配额超过 {max_wait} 秒，直接调用")
+                return waited
+            # 加入少量抖动，避免多个worker在同一时刻醒来再次争抢
+            time.sleep(min(wait_ms / 1000 * random.uniform(1, 1.5), max_wait - waited))
+
+
+def is_retryable(error: Exception) -> bool:
+    """是否为限流、服务端暂时不可用或网络错误"""
+    get_error_code = getattr(error, "get_error_code", None)
+    code = get_error_code() if get_error_code else None
+    if code in RETRYABLE_ERROR_CODES or code in RETRYABLE_CLIENT_ERROR_CODES:
+        return True
+    get_http_status = getattr(error, "get_http_status", None)
+    status = get_http_status() if get_http_status else None
+    return bool(status and status >= 500)
+
+
+def retry_delay(attempt: int) -> float:
+    """第attempt次重试前等待的秒数: 指数退避，在上限的一半到上限之间随机取值"""
+    cap = min(settings.ALIYUN_RETRY_MAX_DELAY, settings.ALIYUN_RETRY_BASE_DELAY * (2 ** attempt))
+    return random.uniform(cap / 2, cap)
+
+
+# 单例实例
+aliyun_rate_limiter = AliyunRateLimiter()
@@ -0,0 +1,87 @@
+import json
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.core.config import settings
+from app.core.redis_client import redis_client
+
+logger = logging.getLogger(__name__)
+
+QUEUE_KEY = "ecs:provision:queue:{}"  # 等待合并创建的请求 (list)
+FLUSH_KEY = "ecs:provision:flush:{}"  # 已安排合并创建任务的标记 (string)
+BATCH_KEY = "ecs:provision:batch:{}"  # 已提交的批次: ClientToken -> 批内请求 (JSON)
+LAUNCH_KEY = "ecs:provision:launch:{}"  # 实例名称 -> 所在批次的ClientToken (string)
+
+# 批次记录保留的秒数，覆盖worker重启后任务重新投递的时间
+BATCH_RECORD_TTL = 24 * 3600
+
+
+class ProvisionCoalescer:
+    """
+    ECS创建请求合并器
+
+    同一环境模板的创建请求先进入Redis队列，窗口期内第一个请求负责安排一次延迟执行的
+    合并创建任务，该任务把队列中的请求用一次RunInstances(Amount=N)创建。
+    多个worker并发入队、取出都通过Redis完成，不会重复创建。
+    每个批次在调用RunInstances之前按实例名称记录，同一实例名称的请求重复入队时按原批次
+    重新提交(相同的ClientToken)，不会因为进入另一个批次而再创建一台。
+    """
+
+    def enqueue(self, environment_id: int, entry: Dict[str, Any]) -> bool:
+        """
+        加入等待队列
+
+        Returns:
+            是否为窗口期内的第一个请求，是则由调用方安排合并创建任务
+        """
+        # 标记的过期时间留出余量，worker积压导致任务未按时执行时，下一个请求会重新安排
+        ttl = int(settings.ECS_BATCH_WINDOW_SECONDS) + 60
+        pipe = redis_client.pipeline()
+        pipe.rpush(QUEUE_KEY.format(environment_id), json.dumps(entry))
+        pipe.set(FLUSH_KEY.format(environment_id), 1, nx=True, ex=ttl)
+        _, scheduled = pipe.execute()
+        return bool(scheduled)
+
+    def release(self, environment_id: int):
+        """合并创建任务开始执行，之后到达的请求进入下一个窗口"""
+        redis_client.delete(FLUSH_KEY.format(environment_id))
+
+    def take(self, environment_id: int, limit: int) -> List[Dict[str, Any]]:
+        """原子地取出最多limit个等待中的请求"""
+        key = QUEUE_KEY.format(environment_id)
+        pipe = redis_client.pipeline()
+        pipe.lrange(key, 0, limit - 1)
+        pipe.ltrim(key, limit, -1)
+        items, _ = pipe.execute()
+        entries = []
+        for item in items:
+            try:
+                entries.append(json.loads(item))
+            except ValueError:
+                logger.error(f"无法解析的ECS创建请求: {item}")
+        return entries
+
+    def record_batch(self, client_token: str, entries: List[Dict[str, Any]]):
+        """调用RunInstances之前记录批次及其中的实例名称"""
+        pipe = redis_client.pipeline()
+        pipe.set(BATCH_KEY.format(client_token), json.dumps(entries), ex=BATCH_RECORD_TTL)
+        for entry in entries:
+            pipe.set(LAUNCH_KEY.format(entry["instance_name"]), client_token, ex=BATCH_RECORD_TTL)
+        pipe.execute()
+
+    def find_batch(self, instance_name: str) -> Optional[Tuple[str, List[Dict[str, Any]]]]:
+        """实例名称已提交过的批次: (ClientToken, 批内请求)，没有时返回None"""
+        client_token = redis_client.get(LAUNCH_KEY.format(instance_name))
+        if not client_token:
+            return None
+        value = redis_client.get(BATCH_KEY.format(client_token))
+        if not value:
+            return None
+        return client_token, json.loads(value)
+
+    def pending(self, environment_id: int) -> int:
+        return redis_client.llen(QUEUE_KEY.format(environment_id))
+
+
+# 单例实例
+provision_coalescer = ProvisionCoalescer()
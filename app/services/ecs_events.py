@@ -0,0 +1,71 @@
+import logging
+from typing import Any, Dict, List, Optional, Union
+
+from app.services.ecs_reconciler import InstanceRow
+
+logger = logging.getLogger(__name__)
+
+# 实例已释放的事件状态，按查不到实例处理
+RELEASED_STATES = {"Deleted", "Released"}
+
+
+def _event_body(event: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    取出事件中包含实例ID与状态的部分
+
+    兼容几种格式:
+        事件总线(CloudEvents):  {"type": "ecs:Instance:StateChange", "data": {"resourceId": "i-xxx", "state": "Running"}}
+        云监控系统事件:          {"content": {"resourceId": "i-xxx", "state": "Running"}, ...}
+        简化格式(本地回放):      {"instance_id": "i-xxx", "state": "Running"}
+    """
+    for key in ("data", "content"):
+        body = event.get(key)
+        if isinstance(body, dict):
+            return body
+    return event
+
+
+def _instance_id(body: Dict[str, Any]) -> Optional[str]:
+    instance_id = body.get("instanceId") or body.get("instance_id") or body.get("resourceId")
+    if not instance_id:
+        return None
+    # 资源ARN形式: acs:ecs:cn-hangzhou:123:instance/i-xxx
+    return str(instance_id).rsplit("/", 1)[-1]
+
+
+def parse_instance_events(payload: Union[Dict[str, Any], List[Dict[str, Any]]]) -> Dict[str, str]:
+    """
+    解析一个或一批实例状态变更事件
+
+    Returns:
+        实例ID -> 最新状态，同一实例的多个事件以后出现的为准；无法识别的事件忽略
+    """
+    events = payload if isinstance(payload, list) else [payload]
+    states = {}
+    for event in events:
+        if not isinstance(event, dict):
+            continue
+        body = _event_body(event)
+        instance_id = _instance_id(body)
+        state = body.get("state") or body.get("status")
+        if not instance_id or not state:
+            logger.warning(f"无法识别的ECS事件: {event}")
+            continue
+        states[instance_id] = state
+    return states
+
+
+def event_instance_info(row: InstanceRow, state: str) -> Optional[Dict[str, Any]]:
+    """
+    把事件转换为与DescribeInstances返回相同结构的实例信息，供对账使用
+
+    事件不包含IP，沿用数据库中的值；实例已释放时返回None
+    """
+    if state in RELEASED_STATES:
+        return None
+    return {
+        "InstanceId": row.instance_id,
+        "Status": state,
+        "VpcAttributes": {"PrivateIpAddress": {"IpAddress": [row.private_ip] if row.private_ip else []}},
+        "PublicIpAddress": {"IpAddress": [row.public_ip] if row.public_ip else []},
+    }
@@ -0,0 +1,206 @@
+import json
+import logging
+import random
+import time
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from app.core.config import settings
+from app.core.redis_client import redis_client
+from app.services.ali_cloud import ali_cloud_service
+
+logger = logging.getLogger(__name__)
+
+STOCK_KEY = "ecs:placement:stock:{}:{}"  # region内各可用区的规格库存 (JSON, 按spot策略区分)
+VSWITCH_ZONE_KEY = "ecs:placement:vswitch_zone"  # VSwitch -> 可用区 (hash)
+STATS_KEY = "ecs:placement:stats:{}:{}:{}:{}"  # 可用区+规格在一个时间窗口内的创建结果 (hash: success, failure)
+NO_STOCK_KEY = "ecs:placement:nostock:{}:{}:{}"  # 可用区+规格刚报过库存不足
+
+# 库存不足、换可用区或规格可能成功的错误码
+NO_STOCK_ERROR_CODES = {"OperationDenied.NoStock", "Zone.NotOnSale"}
+# 相同ClientToken已用不同参数创建过实例
+IDEMPOTENT_MISMATCH_ERROR_CODE = "IdempotentParameterMismatch"
+
+
+class LaunchCandidate(NamedTuple):
+    """一组可用于创建实例的配置: 实例规格、安全组与VSwitch(决定可用区)"""
+    instance_type: str
+    security_group_id: str
+    vswitch_id: str
+
+
+def launch_candidates(resource_config: Dict[str, Any]) -> List[LaunchCandidate]:
+    """
+    从环境模板的资源配置中解析候选配置
+
+    instance_type/security_group_id/vswitch_id 可以是逗号分隔的多组，按位置一一对应；
+    只配置了一个值的项用于所有组。配置缺失时返回空列表
+    """
+    fields = [
+        [value.strip() for value in str(resource_config.get(key) or "").split(",") if value.strip()]
+        for key in ("instance_type", "security_group_id", "vswitch_id")
+    ]
+    if not all(fields):
+        return []
+    count = min(len(values) for values in fields if len(values) > 1) if any(len(v) > 1 for v in fields) else 1
+    return [
+        LaunchCandidate(*[values[i] if len(values) > 1 else values[0] for values in fields])
+        for i in range(count)
+    ]
+
+
+class PlacementEngine:
+    """
+    按库存与近期成功率选择创建实例的可用区和规格
+
+    候选配置的得分为近期创建成功率(平滑处理，无记录时为0.5)，缓存的库存显示售罄或
+    刚报过库存不足的排在最后；得分相同时随机，使请求分散到各可用区。
+    创建时依次尝试，库存不足换下一组，直到全部创建或候选用尽
+    """
+
+    def __init__(self):
+        self._vswitch_zones: Dict[str, str] = {}
+
+    def zone_of(self, region_id: str, vswitch_id: str) -> Optional[str]:
+        """VSwitch所在的可用区，查询失败时返回None"""
+        zone_id = self._vswitch_zones.get(vswitch_id) or redis_client.hget(VSWITCH_ZONE_KEY, vswitch_id)
+        if not zone_id:
+            result = ali_cloud_service.describe_vswitch_zone(region_id, vswitch_id)
+            if not result["success"]:
+                logger.warning(f"查询VSwitch {vswitch_id} 的可用区失败: {result['error']}")
+                return None
+            zone_id = result["zone_id"]
+            redis_client.hset(VSWITCH_ZONE_KEY, vswitch_id, zone_id)
+        self._vswitch_zones[vswitch_id] = zone_id
+        return zone_id
+
+    def stock(self, region_id: str, spot_strategy: Optional[str] = None) -> Dict[str, Dict[str, str]]:
+        """各可用区的规格库存，缓存 ECS_PLACEMENT_STOCK_TTL 秒，查询失败时返回空"""
+        key = STOCK_KEY.format(region_id, spot_strategy or "")
+        cached = redis_client.get(key)
+        if cached is not None:
+            return json.loads(cached)
+        result = ali_cloud_service.describe_available_resource(region_id, spot_strategy=spot_strategy)
+        if not result["success"]:
+            logger.warning(f"查询 {region_id} 可用资源失败: {result['error']}")
+            return {}
+        redis_client.set(key, json.dumps(result["zones"]), ex=settings.ECS_PLACEMENT_STOCK_TTL)
+        return result["zones"]
+
+    def _placement_key(self, region_id: str, candidate: LaunchCandidate) -> str:
+        # 查不到可用区时按VSwitch统计(一个VSwitch只属于一个可用区)
+        return self.zone_of(region_id, candidate.vswitch_id) or candidate.vswitch_id
+
+    def rank(
+            self, region_id: str, candidates: List[LaunchCandidate], spot_strategy: Optional[str] = None
+    ) -> List[LaunchCandidate]:
+        """按成功可能性从高到低排列候选配置，Redis不可用时随机排列"""
+        if len(candidates) <= 1:
+            return list(candidates)
+        try:
+            stock = self.stock(region_id, spot_strategy)
+            window = int(time.time() // settings.ECS_PLACEMENT_STATS_WINDOW)
+            zones = [self._placement_key(region_id, candidate) for candidate in candidates]
+            pipe = redis_client.pipeline(transaction=False)
+            for candidate, zone in zip(candidates, zones):
+                for w in (window - 1, window):
+                    pipe.hmget(STATS_KEY.format(region_id, zone, candidate.instance_type, w), "success", "failure")
+                pipe.exists(NO_STOCK_KEY.format(region_id, zone, candidate.instance_type))
+            replies = pipe.execute()
+        except Exception as e:
+            logger.warning(f"读取实例规格/可用区统计失败，随机选择: {e}")
+            return random.sample(candidates, len(candidates))
+
+        scored = []
+        for i, (candidate, zone) in enumerate(zip(candidates, zones)):
+            previous, current, no_stock = replies[i * 3:i * 3 + 3]
+            success = sum(int(value or 0) for value in (previous[0], current[0]))
+            failure = sum(int(value or 0) for value in (previous[1], current[1]))
+            score = (success + 1) / (success + failure + 2)
+            if no_stock or stock.get(zone, {}).get(candidate.instance_type) == "SoldOut":
+                score -= 1
+            scored.append((score, random.random(), candidate))
+        scored.sort(reverse=True)
+        return [candidate for _, _, candidate in scored]
+
+    def record(self, region_id: str, candidate: LaunchCandidate, success: bool, error_code: Optional[str] = None):
+        """记录一次创建结果；库存不足时该可用区+规格暂停使用一段时间"""
+        try:
+            zone = self._placement_key(region_id, candidate)
+            window = int(time.time() // settings.ECS_PLACEMENT_STATS_WINDOW)
+            key = STATS_KEY.format(region_id, zone, candidate.instance_type, window)
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.hincrby(key, "success" if success else "failure", 1)
+            pipe.expire(key, settings.ECS_PLACEMENT_STATS_WINDOW * 2)
+            if error_code in NO_STOCK_ERROR_CODES:
+                pipe.set(
+                    NO_STOCK_KEY.format(region_id, zone, candidate.instance_type), 1,
+                    ex=settings.ECS_PLACEMENT_NO_STOCK_SECONDS
+                )
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"记录实例创建结果失败: {e}")
+
+    def run_instances(
+            self, region_id: str, candidates: List[LaunchCandidate], amount: int = 1,
+            spot_strategy: Optional[str] = None, client_token: Optional[str] = None, **create_params
+    ) -> Dict[str, Any]:
+        """
+        按排序依次尝试候选配置创建amount台实例
+
+        某组配置库存不足(报错或只创建了部分实例)时换下一组创建剩余的实例，
+        其他错误直接返回。
+        指定client_token时第k次成功创建使用 "{client_token}-{k}" 作为ClientToken，与选中的配置无关。
+        同一请求重试(如Celery任务重新执行)时排序可能不同: 该步骤已用另一组配置创建过时阿里云返回
+        IdempotentParameterMismatch，换下一组配置，直到遇到原来的配置返回已创建的实例，不会重复创建
+
+        Returns:
+            success: 是否至少创建了一台
+            launches: [(候选配置, 实例ID列表)]，按创建顺序
+            error: 未全部创建时最后一次失败的原因
+        """
+        launches = []
+        remaining = amount
+        error = "No launch candidates"
+        pending = self.rank(region_id, candidates, spot_strategy)
+        mismatched = []
+        while pending and remaining > 0:
+            candidate = pending.pop(0)
+            result = ali_cloud_service.create_ecs_instance(
+                region_id=region_id,
+                instance_type=candidate.instance_type,
+                security_group_id=candidate.security_group_id,
+                vswitch_id=candidate.vswitch_id,
+                spot_strategy=spot_strategy,
+                amount=remaining,
+                min_amount=1,
+                client_token=f"{client_token}-{len(launches)}" if client_token else None,
+                **create_params
+            )
+            if not result["success"]:
+                error = result["error"]
+                if result.get("error_code") == IDEMPOTENT_MISMATCH_ERROR_CODE:
+                    # 该步骤之前已用另一组配置创建，这组配置可能对应后面的步骤
+                    mismatched.append(candidate)
+                    continue
+                self.record(region_id, candidate, success=False, error_code=result.get("error_code"))
+                if result.get("error_code") not in NO_STOCK_ERROR_CODES:
+                    break
+                logger.warning(f"{candidate.instance_type}/{candidate.vswitch_id} 库存不足，尝试下一组配置")
+                continue
+
+            instance_ids = result["instance_ids"]
+            launches.append((candidate, instance_ids))
+            remaining -= len(instance_ids)
+            pending = mismatched + pending
+            mismatched = []
+            if remaining <= 0:
+                self.record(region_id, candidate, success=True)
+                break
+            # 只创建了部分实例，说明库存不够
+            self.record(region_id, candidate, success=False, error_code="OperationDenied.NoStock")
+            error = f"Only {amount - remaining} of {amount} instances were created"
+        return {"success": bool(launches), "launches": launches, "error": error if remaining > 0 else None}
+
+
+# 单例实例
+placement_engine = PlacementEngine()
@@ -0,0 +1,113 @@
+import logging
+import time
+from typing import Iterable, List, Set
+
+from app.core.config import settings
+from app.core.redis_client import redis_client
+
+logger = logging.getLogger(__name__)
+
+DUE_KEY = "ecs:poll:due"  # 实例下次检查的时间 (sorted set, 成员为ECS实例主键, 分数为时间戳)
+INTERVAL_KEY = "ecs:poll:interval"  # 实例当前的检查间隔秒数 (hash)
+
+# 超过该时间仍未被检查的记录视为实例已不再活跃(已停止或删除)，定期清理
+STALE_SECONDS = 3600
+
+
+class PollScheduler:
+    """
+    实例状态检查的自适应调度
+
+    创建中、状态刚变化的实例每 ECS_POLL_FAST_SECONDS 检查一次；
+    稳定运行的实例每次检查无变化时间隔翻倍，直到 ECS_POLL_MAX_SECONDS。
+    数据库仍是活跃实例的来源，调度表只决定哪些实例本轮需要调用DescribeInstances，
+    不在调度表中的实例(新创建或记录已被清理)立即检查。
+    接收实例状态变更事件(配置了ECS_EVENT_TOKEN)时，状态变化由事件及时写入，
+    定时检查只作兜底，最短间隔改为 ECS_EVENT_POLL_SECONDS。
+    """
+
+    @staticmethod
+    def fast_interval() -> float:
+        if settings.ECS_EVENT_TOKEN:
+            return max(settings.ECS_EVENT_POLL_SECONDS, settings.ECS_POLL_FAST_SECONDS)
+        return settings.ECS_POLL_FAST_SECONDS
+
+    def filter_due(self, instance_pks: List[int], now: float = None) -> Set[int]:
+        """返回本轮需要检查的实例，Redis不可用时全部检查"""
+        if not instance_pks:
+            return set()
+        now = now or time.time()
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            for pk in instance_pks:
+                pipe.zscore(DUE_KEY, pk)
+            scores = pipe.execute()
+        except Exception as e:
+            logger.warning(f"读取实例检查调度失败，本轮检查全部实例: {e}")
+            return set(instance_pks)
+        return {pk for pk, score in zip(instance_pks, scores) if score is None or score <= now}
+
+    def reschedule(
+            self, stable: Iterable[int] = (), active: Iterable[int] = (), gone: Iterable[int] = (),
+            now: float = None
+    ):
+        """
+        根据本轮检查结果安排下次检查
+
+        Args:
+            stable: 本轮无变化的实例(稳定运行或持续查不到)，间隔翻倍
+            active: 创建中、状态有变化或查询失败的实例，使用最短间隔
+            gone: 已释放的实例，移出调度表
+        """
+        now = now or time.time()
+        stable, active, gone = list(stable), list(active), list(gone)
+        fast = self.fast_interval()
+        try:
+            previous = redis_client.hmget(INTERVAL_KEY, stable) if stable else []
+            intervals = {pk: fast for pk in active}
+            for pk, interval in zip(stable, previous):
+                intervals[pk] = min(float(interval or fast) * 2, settings.ECS_POLL_MAX_SECONDS)
+
+            pipe = redis_client.pipeline(transaction=False)
+            if intervals:
+                pipe.zadd(DUE_KEY, {pk: now + interval for pk, interval in intervals.items()})
+                pipe.hset(INTERVAL_KEY, mapping=intervals)
+            if gone:
+                pipe.zrem(DUE_KEY, *gone)
+                pipe.hdel(INTERVAL_KEY, *gone)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"更新实例检查调度失败: {e}")
+
+    def poke(self, instance_pks: Iterable[int]):
+        """要求下一轮立即检查这些实例(如收到状态变更通知)，并恢复最短间隔"""
+        instance_pks = list(instance_pks)
+        if not instance_pks:
+            return
+        now = time.time()
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.zadd(DUE_KEY, {pk: now for pk in instance_pks})
+            pipe.hdel(INTERVAL_KEY, *instance_pks)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"更新实例检查调度失败: {e}")
+
+    def trim(self, now: float = None) -> int:
+        """清理长时间未被检查的记录"""
+        now = now or time.time()
+        try:
+            stale = redis_client.zrangebyscore(DUE_KEY, "-inf", now - STALE_SECONDS)
+            if stale:
+                pipe = redis_client.pipeline(transaction=False)
+                pipe.zrem(DUE_KEY, *stale)
+                pipe.hdel(INTERVAL_KEY, *stale)
+                pipe.execute()
+            return len(stale)
+        except Exception as e:
+            logger.warning(f"清理实例检查调度失败: {e}")
+            return 0
+
+
+# 单例实例
+poll_scheduler = PollScheduler()
@@ -0,0 +1,134 @@
+import datetime
+from typing import Any, Dict, List, NamedTuple, Optional, Set
+
+
+class InstanceRow(NamedTuple):
+    """对账需要的实例与学生任务字段，只查询这些列，不加载ORM对象"""
+    id: int
+    instance_id: str
+    region_id: Optional[str]
+    status: Optional[str]
+    private_ip: Optional[str]
+    public_ip: Optional[str]
+    student_task_id: int
+    student_task_status: Optional[str]
+
+
+def _first_ip(addresses: Dict[str, Any]) -> Optional[str]:
+    ips = (addresses or {}).get("IpAddress") or []
+    return ips[0] if ips else None
+
+
+def private_ip_of(info: Dict[str, Any]) -> Optional[str]:
+    return _first_ip(info.get("VpcAttributes", {}).get("PrivateIpAddress"))
+
+
+def started_at(info: Dict[str, Any]) -> Optional[datetime.datetime]:
+    """实例最近一次开机的时间(UTC)，DescribeInstances返回的格式如 2025-03-07T08:44Z"""
+    value = info.get("StartTime") or info.get("CreationTime")
+    for fmt in ("%Y-%m-%dT%H:%MZ", "%Y-%m-%dT%H:%M:%SZ"):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+class ReconcileResult:
+    """一轮对账得出的变更: 只包含与数据库不一致的行"""
+
+    def __init__(self):
+        # ECS实例的UPDATE参数(含主键id)，用于 bulk_update_mappings
+        self.instance_updates: List[Dict[str, Any]] = []
+        # 学生任务目标状态 -> 学生任务ID列表
+        self.student_task_updates: Dict[str, List[int]] = {}
+        # 刚变为Running、需要预热隧道的学生任务
+        self.became_running: List[int] = []
+        # 实例已运行、RDP端口还连不上的实例(ECS实例主键)，需要尽快再次探测
+        self.awaiting_rdp: List[int] = []
+        # 按实例当前的生命周期状态分类(ECS实例主键)，决定下次检查的时间:
+        # stable 稳定运行或查不到且无变化; active 创建中、状态刚变化等; gone 已释放，不再检查
+        self.stable: List[int] = []
+        self.active: List[int] = []
+        self.gone: List[int] = []
+        self.checked = 0
+        self.missing = 0
+
+    def set_student_task_status(self, row: InstanceRow, status: str):
+        if row.student_task_status != status:
+            self.student_task_updates.setdefault(status, []).append(row.student_task_id)
+
+    @property
+    def changed(self) -> int:
+        return len(self.instance_updates) + sum(len(ids) for ids in self.student_task_updates.values())
+
+
+def reconcile(
+        rows: List[InstanceRow], cloud_instances: Dict[str, Dict[str, Any]], now: datetime.datetime = None,
+        result: ReconcileResult = None, rdp_ready: Optional[Set[str]] = None
+) -> ReconcileResult:
+    """
+    比较阿里云返回的实例信息与数据库状态
+
+    Args:
+        rows: 本批查询的实例(均已调用DescribeInstances)
+        cloud_instances: 实例ID -> DescribeInstances返回的实例信息
+        result: 在已有结果上累加，多批对账最后一次写入
+        rdp_ready: RDP端口已可连接的实例ID；为None时不按RDP就绪判断
+
+    规则与原先逐个更新时相同: 查到的实例同步状态与IP，学生任务为Running；
+    查不到的实例原为Running时改为Stopped，学生任务为Stopped。
+    指定rdp_ready时，学生任务只在实例已运行且RDP可连接后才改为Running，此时通知预热隧道
+    """
+    result = result or ReconcileResult()
+    now = now or datetime.datetime.utcnow()
+    for row in rows:
+        result.checked += 1
+        info = cloud_instances.get(row.instance_id)
+        if info is None:
+            result.missing += 1
+            if row.status == "Running":
+                result.instance_updates.append({"id": row.id, "status": "Stopped", "updated_at": now})
+                result.gone.append(row.id)
+            elif row.student_task_status == "Stopped":
+                result.stable.append(row.id)
+            else:
+                result.active.append(row.id)
+            result.set_student_task_status(row, "Stopped")
+            continue
+
+        status = info["Status"]
+        private_ip = private_ip_of(info)
+        public_ip = _first_ip(info.get("PublicIpAddress"))
+        changes = {}
+        if status != row.status:
+            changes["status"] = status
+        # 与原逻辑一致，IP为空时不覆盖已有的值
+        if private_ip and private_ip != row.private_ip:
+            changes["private_ip"] = private_ip
+        if public_ip and public_ip != row.public_ip:
+            changes["public_ip"] = public_ip
+        if changes:
+            changes.update({"id": row.id, "updated_at": now})
+            result.instance_updates.append(changes)
+        if rdp_ready is not None and row.student_task_status != "Running":
+            # 学生任务等待RDP就绪，未就绪时保持原状态，尽快再次探测
+            if status == "Running" and row.instance_id in rdp_ready:
+                result.set_student_task_status(row, "Running")
+                result.became_running.append(row.student_task_id)
+                result.active.append(row.id)
+            else:
+                if status == "Running":
+                    result.awaiting_rdp.append(row.id)
+                result.active.append(row.id)
+            continue
+
+        if status == "Running" and not changes:
+            result.stable.append(row.id)
+        else:
+            result.active.append(row.id)
+
+        result.set_student_task_status(row, "Running")
+        if status == "Running" and row.status != "Running" and private_ip:
+            result.became_running.append(row.student_task_id)
+    return result
@@ -0,0 +1,36 @@
+import logging
+from typing import Iterable, List
+
+from app.core.redis_client import redis_client
+
+logger = logging.getLogger(__name__)
+
+PENDING_KEY = "ecs:teardown:pending"  # 等待释放的阿里云实例ID (set)
+
+
+class TeardownQueue:
+    """
+    ECS实例批量释放队列
+
+    到期的实例ID先写入Redis集合，由定时任务每隔几秒取出，按region分组用
+    DeleteInstances(每次最多100个)释放，避免下课时逐个调用DeleteInstance。
+    集合去重，同一实例被重复提交只释放一次。
+    """
+
+    def enqueue(self, instance_ids: Iterable[str]) -> int:
+        """加入释放队列，返回新加入的实例数"""
+        instance_ids = [instance_id for instance_id in instance_ids if instance_id]
+        if not instance_ids:
+            return 0
+        return redis_client.sadd(PENDING_KEY, *instance_ids)
+
+    def take(self, limit: int) -> List[str]:
+        """原子地取出最多limit个等待释放的实例ID"""
+        return redis_client.spop(PENDING_KEY, limit) or []
+
+    def pending(self) -> int:
+        return redis_client.scard(PENDING_KEY)
+
+
+# 单例实例
+teardown_queue = TeardownQueue()
@@ -0,0 +1,371 @@
+import datetime
+import json
+import math
+import random
+import threading
+import time
+import uuid
+import zlib
+from collections import Counter, deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from aliyunsdkcore.acs_exception.exceptions import ServerException
+
+from app.core.config import settings
+
+# 模拟的可用区后缀，VSwitch按ID哈希固定落在其中一个可用区
+_ZONE_SUFFIXES = "hij"
+# 实例创建后多久从Pending变为Starting
+_PENDING_SECONDS = 2.0
+# RunInstances幂等比较的参数，相同ClientToken下这些参数不同时返回IdempotentParameterMismatch
+_RUN_INSTANCES_IDEMPOTENT_PARAMS = ("InstanceType", "VSwitchId", "SecurityGroupId", "ImageId", "Amount", "Password")
+
+
+def _now() -> float:
+    return time.time()
+
+
+def _iso(timestamp: float, seconds: bool = False) -> str:
+    fmt = "%Y-%m-%dT%H:%M:%SZ" if seconds else "%Y-%m-%dT%H:%MZ"
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime(fmt)
+
+
+def _parse_time(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    for fmt in ("%Y-%m-%dT%H:%M:%SZ", "%Y-%m-%dT%H:%MZ"):
+        try:
+            return datetime.datetime.strptime(value, fmt).replace(tzinfo=datetime.timezone.utc).timestamp()
+        except ValueError:
+            continue
+    return None
+
+
+def _list_param(params: Dict[str, Any], name: str) -> Optional[List[str]]:
+    """读取列表参数: InstanceIds(JSON字符串或列表) 或 InstanceId.1、InstanceId.2 ... 形式"""
+    value = params.get(name + "s")
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    if isinstance(value, str):
+        try:
+            return list(json.loads(value))
+        except ValueError:
+            return [item.strip(" '\"") for item in value.strip("[]").split(",") if item.strip()]
+    items = [value for key, value in params.items() if key.startswith(name + ".")]
+    return items or None
+
+
+def _error(code: str, message: str, http_status: int = 400) -> ServerException:
+    return ServerException(code, message, http_status, uuid.uuid4().hex.upper())
+
+
+class FakeAliyunCloud:
+    """
+    进程内模拟的阿里云ECS，ALIYUN_FAKE开启时代替AcsClient处理请求，用于压测创建/检查/释放流程
+
+    请求仍经过AliCloudService的参数组装、限速与重试，只有发送请求这一步由本类处理。
+    按 ALIYUN_FAKE_PROFILE 模拟:
+    - API延迟: 对数正态分布
+    - 限流: 每个API在每个region每秒超过qps次调用时返回Throttling.User
+    - 库存: RunInstances按no_stock_rate的概率遇到可用区+规格售罄(OperationDenied.NoStock)，
+      售罄持续no_stock_seconds秒，期间DescribeAvailableResource返回SoldOut
+    - 开机耗时: 对数正态分布，实例依次经过 Pending -> Starting -> Running
+    同一ClientToken的RunInstances返回第一次创建的实例，参数不同时返回IdempotentParameterMismatch，
+    与阿里云的幂等行为一致。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._random = random.Random()
+        self._instances: Dict[str, Dict[str, Any]] = {}
+        self._client_tokens: Dict[str, Tuple[Tuple[Any, ...], List[str]]] = {}
+        self._sold_out: Dict[Tuple[str, str], float] = {}
+        self._launched: set = set()
+        self._calls: Dict[Tuple[str, str], Deque[float]] = {}
+        self._next_ip = 0
+        self.stats: Counter = Counter()
+        self._handlers: Dict[str, Callable[[str, Dict[str, Any]], Dict[str, Any]]] = {
+            "RunInstances": self._run_instances,
+            "DescribeInstances": self._describe_instances,
+            "DescribeInstanceStatus": self._describe_instance_status,
+            "ModifyInstanceAutoReleaseTime": self._modify_auto_release_time,
+            "DescribeAvailableResource": self._describe_available_resource,
+            "DescribeVSwitches": self._describe_vswitches,
+            "StopInstance": self._stop_instance,
+            "DescribeDisks": self._describe_disks,
+            "ReInitDisk": self._reinit_disk,
+            "DeleteInstance": self._delete_instance,
+            "DeleteInstances": self._delete_instances,
+        }
+
+    @property
+    def profile(self) -> Dict[str, float]:
+        return settings.ALIYUN_FAKE_PROFILE
+
+    def client(self, region_id: str) -> "FakeAcsClient":
+        return FakeAcsClient(self, region_id)
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats = Counter()
+
+    def instance_count(self, statuses: List[str] = None) -> int:
+        """当前未释放的实例数"""
+        now = _now()
+        with self._lock:
+            self._expire(now)
+            return sum(
+                1 for instance in self._instances.values()
+                if statuses is None or self._status(instance, now) in statuses
+            )
+
+    def handle(self, region_id: str, request) -> bytes:
+        action = request.get_action_name()
+        params = request.get_query_params() or {}
+        handler = self._handlers.get(action)
+        latency = self._random.lognormvariate(
+            math.log(max(self.profile.get("latency_ms", 100), 1) / 1000.0), self.profile.get("latency_sigma", 0.4)
+        )
+        time.sleep(latency)
+        with self._lock:
+            self.stats[action] += 1
+            if self._throttled(action, region_id):
+                self.stats["Throttling"] += 1
+                raise _error("Throttling.User", "Request was denied due to user flow control.")
+            if handler is None:
+                raise _error("InvalidAction.NotFound", f"Specified api {action} is not supported by the fake backend.")
+            now = _now()
+            self._expire(now)
+            return json.dumps(dict(handler(region_id, params), RequestId=uuid.uuid4().hex.upper())).encode()
+
+    def _throttled(self, action: str, region_id: str) -> bool:
+        """最近1秒内同一API、region的调用次数超过qps时限流"""
+        qps = self.profile.get("qps", 20)
+        if not qps:
+            return False
+        now = _now()
+        calls = self._calls.setdefault((action, region_id), deque())
+        while calls and calls[0] <= now - 1:
+            calls.popleft()
+        if len(calls) >= qps:
+            return True
+        calls.append(now)
+        return False
+
+    def _expire(self, now: float):
+        """自动释放时间已到的实例直接删除"""
+        expired = [
+            instance_id for instance_id, instance in self._instances.items()
+            if instance["auto_release_at"] and instance["auto_release_at"] <= now
+        ]
+        for instance_id in expired:
+            del self._instances[instance_id]
+
+    def _boot_seconds(self) -> float:
+        return self._random.lognormvariate(
+            math.log(max(self.profile.get("boot_seconds", 45), 1)), self.profile.get("boot_sigma", 0.3)
+        )
+
+    @staticmethod
+    def _status(instance: Dict[str, Any], now: float) -> str:
+        if instance["stopped_at"] is not None:
+            return "Stopped" if now >= instance["stopped_at"] else "Stopping"
+        if now >= instance["running_at"]:
+            return "Running"
+        if now >= instance["started_at"] + _PENDING_SECONDS:
+            return "Starting"
+        return "Pending"
+
+    def _instance(self, region_id: str, instance_id: str) -> Dict[str, Any]:
+        instance = self._instances.get(instance_id)
+        if instance is None or instance["region_id"] != region_id:
+            raise _error("InvalidInstanceId.NotFound", f"The specified InstanceId {instance_id} does not exist.", 404)
+        return instance
+
+    @staticmethod
+    def _zone_of(region_id: str, vswitch_id: str) -> str:
+        return f"{region_id}-{_ZONE_SUFFIXES[zlib.crc32(vswitch_id.encode()) % len(_ZONE_SUFFIXES)]}"
+
+    def _run_instances(self, region_id: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        client_token = params.get("ClientToken")
+        signature = tuple(params.get(key) for key in _RUN_INSTANCES_IDEMPOTENT_PARAMS)
+        if client_token and client_token in self._client_tokens:
+            previous, instance_ids = self._client_tokens[client_token]
+            if previous != signature:
+                raise _error(
+                    "IdempotentParameterMismatch",
+                    "The specified parameters are different from before using the same ClientToken."
+                )
+            return {"InstanceIdSets": {"InstanceIdSet": instance_ids}}
+
+        now = _now()
+        instance_type = params.get("InstanceType")
+        vswitch_id = params.get("VSwitchId") or ""
+        zone_id = self._zone_of(region_id, vswitch_id)
+        key = (zone_id, instance_type)
+        self._launched.add(key)
+        if self._sold_out.get(key, 0) <= now and self._random.random() < self.profile.get("no_stock_rate", 0):
+            self._sold_out[key] = now + self.profile.get("no_stock_seconds", 300)
+        if self._sold_out.get(key, 0) > now:
+            raise _error(
+                "OperationDenied.NoStock",
+                f"The requested resource is sold out in the specified zone {zone_id}; try other types of resources."
+            )
+
+        instance_ids = []
+        for _ in range(int(params.get("Amount") or 1)):
+            instance_id = "i-fake" + uuid.uuid4().hex[:14]
+            self._next_ip += 1
+            self._instances[instance_id] = {
+                "region_id": region_id,
+                "zone_id": zone_id,
+                "instance_type": instance_type,
+                "image_id": params.get("ImageId"),
+                "vswitch_id": vswitch_id,
+                "security_group_id": params.get("SecurityGroupId"),
+                "private_ip": f"172.16.{self._next_ip // 250 % 250}.{self._next_ip % 250 + 1}",
+                "public_ip": (
+                    f"198.18.{self._next_ip // 250 % 250}.{self._next_ip % 250 + 1}"
+                    if int(params.get("InternetMaxBandwidthOut") or 0) > 0 else None
+                ),
+                "created_at": now,
+                "started_at": now,
+                "running_at": now + self._boot_seconds(),
+                "stopped_at": None,
+                "auto_release_at": _parse_time(params.get("AutoReleaseTime")),
+            }
+            instance_ids.append(instance_id)
+        if client_token:
+            self._client_tokens[client_token] = (signature, instance_ids)
+        return {"InstanceIdSets": {"InstanceIdSet": instance_ids}}
+
+    def _describe(self, region_id: str, params: Dict[str, Any]) -> List[Tuple[str, Dict[str, Any]]]:
+        instance_ids = _list_param(params, "InstanceId")
+        if instance_ids is None:
+            instance_ids = list(self._instances)
+        page_size = int(params.get("PageSize") or 100)
+        found = [
+            (instance_id, self._instances[instance_id]) for instance_id in instance_ids
+            if instance_id in self._instances and self._instances[instance_id]["region_id"] == region_id
+        ]
+        return found[:page_size]
+
+    def _describe_instances(self, region_id: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        now = _now()
+        instances = []
+        for instance_id, instance in self._describe(region_id, params):
+            status = self._status(instance, now)
+            booted = status in ("Running", "Stopping", "Stopped")
+            instances.append({
+                "InstanceId": instance_id,
+                "RegionId": region_id,
+                "ZoneId": instance["zone_id"],
+                "InstanceType": instance["instance_type"],
+                "ImageId": instance["image_id"],
+                "Status": status,
+                "CreationTime": _iso(instance["created_at"]),
+                "StartTime": _iso(instance["started_at"]),
+                "AutoReleaseTime": _iso(instance["auto_release_at"], seconds=True) if instance["auto_release_at"] else "",
+                "VpcAttributes": {
+                    "VSwitchId": instance["vswitch_id"],
+                    "PrivateIpAddress": {"IpAddress": [instance["private_ip"]] if booted else []},
+                },
+                "PublicIpAddress": {"IpAddress": [instance["public_ip"]] if booted and instance["public_ip"] else []},
+                "SecurityGroupIds": {"SecurityGroupId": [instance["security_group_id"]]},
+            })
+        return {"Instances": {"Instance": instances}, "TotalCount": len(instances)}
+
+    def _describe_instance_status(self, region_id: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        now = _now()
+        return {"InstanceStatuses": {"InstanceStatus": [
+            {"InstanceId": instance_id, "Status": self._status(instance, now)}
+            for instance_id, instance in self._describe(region_id, params)
+        ]}}
+
+    def _modify_auto_release_time(self, region_id: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        instance = self._instance(region_id, params.get("InstanceId"))
+        instance["auto_release_at"] = _parse_time(params.get("AutoReleaseTime"))
+        return {}
+
+    def _describe_available_resource(self, region_id: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        now = _now()
+        zones: Dict[str, List[Dict[str, str]]] = {}
+        for zone_id, instance_type in self._launched:
+            if not zone_id.startswith(region_id + "-"):
+                continue
+            status = "SoldOut" if self._sold_out.get((zone_id, instance_type), 0) > now else "Available"
+            zones.setdefault(zone_id, []).append({"Value": instance_type, "Status": status})
+        return {"AvailableZones": {"AvailableZone": [
+            {
+                "ZoneId": zone_id,
+                "AvailableResources": {"AvailableResource": [
+                    {"Type": "InstanceType", "SupportedResources": {"SupportedResource": supported}}
+                ]},
+            }
+            for zone_id, supported in zones.items()
+        ]}}
+
+    def _describe_vswitches(self, region_id: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        vswitch_id = params.get("VSwitchId")
+        return {"VSwitches": {"VSwitch": [{"VSwitchId": vswitch_id, "ZoneId": self._zone_of(region_id, vswitch_id)}]}}
+
+    def _stop_instance(self, region_id: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        instance = self._instance(region_id, params.get("InstanceId"))
+        if instance["stopped_at"] is None:
+            instance["stopped_at"] = _now() + self.profile.get("stop_seconds", 10)
+        return {}
+
+    def _describe_disks(self, region_id: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        instance_id = params.get("InstanceId")
+        if instance_id not in self._instances:
+            return {"Disks": {"Disk": []}}
+        return {"Disks": {"Disk": [{"DiskId": "d-" + instance_id[2:], "InstanceId": instance_id, "Type": "system"}]}}
+
+    def _reinit_disk(self, region_id: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        instance = self._instance(region_id, "i-" + (params.get("DiskId") or "")[2:])
+        now = _now()
+        if self._status(instance, now) != "Stopped":
+            raise _error("IncorrectInstanceStatus", "The current status of the resource does not support this operation.", 403)
+        if params.get("AutoStartInstance"):
+            instance["stopped_at"] = None
+            instance["started_at"] = now
+            instance["running_at"] = now + self._boot_seconds()
+        return {}
+
+    def _check_deletable(self, region_id: str, instance_id: str, force: bool):
+        instance = self._instance(region_id, instance_id)
+        if not force and self._status(instance, _now()) != "Stopped":
+            raise _error("IncorrectInstanceStatus", "The current status of the resource does not support this operation.", 403)
+
+    def _delete_instance(self, region_id: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        instance_id = params.get("InstanceId")
+        self._check_deletable(region_id, instance_id, bool(params.get("Force")))
+        del self._instances[instance_id]
+        return {}
+
+    def _delete_instances(self, region_id: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        # 与阿里云相同: 任一实例不存在或状态不允许时整批失败
+        instance_ids = _list_param(params, "InstanceId") or []
+        for instance_id in instance_ids:
+            self._check_deletable(region_id, instance_id, bool(params.get("Force")))
+        for instance_id in instance_ids:
+            del self._instances[instance_id]
+        return {}
+
+
+class FakeAcsClient:
+    """与AcsClient相同的调用方式，请求交给FakeAliyunCloud处理"""
+
+    def __init__(self, cloud: FakeAliyunCloud, region_id: str):
+        self._cloud = cloud
+        self._region_id = region_id
+
+    def get_region_id(self) -> str:
+        return self._region_id
+
+    def do_action_with_exception(self, request) -> bytes:
+        return self._cloud.handle(self._region_id, request)
+
+
+# 单例实例
+fake_aliyun = FakeAliyunCloud()
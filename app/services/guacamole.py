@@ -1,29 +1,60 @@
-import logging
 import asyncio
+import logging
+import re
+import time
 import uuid
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional, Tuple
 
-from guacamole.client import GuacamoleClient
 from app.core.config import settings
+from app.crud.ecs import ecs_instance as crud_ecs_instance
+from app.db.session import SessionLocal
+from app.services.guacamole_metrics import TunnelMetrics, render_prometheus
+from app.services.guacamole_protocol import FrameCoalescer, GuacamoleFrame
+from app.services.guacamole_quality import QUALITY_PROFILES, QualityController, handshake_params, profile_index
+from app.services.guacamole_queue import FrameQueue, POLICY_DISCONNECT
+from app.services.guacamole_registry import guacamole_registry
+from app.services.guacd_client import GuacdClient, encode_instruction
+from app.services.guacd_pool import GuacdBackend, guacd_pool
 
 logger = logging.getLogger(__name__)
 
+# 旁观者检查学生隧道是否仍然存在的间隔秒数
+OBSERVER_CHECK_INTERVAL = 5
+
+# 旁观者客户端发来的指令中需要转发给guacd的sync回复与nop
+_CLIENT_KEEPALIVE = re.compile(r"4\.sync,\d+\.\d+;|3\.nop;")
+
 
 class GuacamoleService:
     """
-    使用 pyguacamole 库实现的 Guacamole 服务
+    基于asyncio guacd客户端实现的 Guacamole 服务
     专注于握手后的忠实数据转发
     """
 
     def __init__(self):
-        self.host = settings.GUACAMOLE_HOST
-        self.port = settings.GUACAMOLE_PORT
         self.connections = {}  # 存储活跃连接
         self.tasks = {}  # 存储维护连接的任务
+        self.observers = {}  # 只读旁观者: 旁观者ID -> 旁观者的guacd连接及发送队列
+        self.closed_tunnels = 0  # 已关闭的隧道数
+        self._metrics_task: Optional[asyncio.Task] = None  # 定期发布指标快照的任务
+
+    def start(self, gateway: bool = False):
+        """
+        在事件循环中启动guacd健康检查及隧道注册表(关闭与预热广播的订阅)，可重复调用
+
+        Args:
+            gateway: 是否为独立网关进程；设置了GUACAMOLE_STANDALONE_GATEWAY时只有网关进程订阅预热广播
+        """
+        guacd_pool.start()
+        if self._metrics_task is None:
+            self._metrics_task = asyncio.get_running_loop().create_task(self._publish_metrics())
+        prewarm = settings.GUACAMOLE_PREWARM_ENABLED and (gateway or not settings.GUACAMOLE_STANDALONE_GATEWAY)
+        guacamole_registry.start(self.close_tunnel, self.prewarm if prewarm else None)
 
     async def create_tunnel(
             self, protocol: str, hostname: str, port: int, username: str, password: str,
-            width: int = 1024, height: int = 768, dpi: int = 96, **kwargs
+            width: int = 1024, height: int = 768, dpi: int = 96, student_task_id: int = None,
+            attach: bool = False, **kwargs
     ) -> Dict[str, Any]:
         """
         创建与 guacd 的连接隧道并完成握手
@@ -37,18 +68,25 @@ class GuacamoleService:
             width: 屏幕宽度
             height: 屏幕高度
             dpi: 屏幕DPI
+            student_task_id: 所属学生任务ID，用于在隧道注册表中登记
+            attach: 是否同时为发起请求的WebSocket接入隧道(返回的queue)，否则由隧道代替客户端回复sync
             **kwargs: 其他协议特定参数
 
         Returns:
             Dict: 包含连接信息的字典
         """
         try:
-            logger.info(f"尝试连接 guacd 服务器 {self.host}:{self.port} -> {hostname}:{port} (协议: {protocol})")
-
             # 生成唯一连接ID
             connection_id = str(uuid.uuid4())
+            metrics = TunnelMetrics()
+
+            quality = QualityController(
+                level=profile_index(settings.GUACAMOLE_QUALITY_DEFAULT),
+                lag_high=settings.GUACAMOLE_QUALITY_LAG_HIGH_MS / 1000,
+                lag_low=settings.GUACAMOLE_QUALITY_LAG_LOW_MS / 1000
+            )
 
-            # 创建参数字典
+            # 创建参数字典，色深和图片格式由画质档位决定
             connection_params = {
                 "hostname": hostname,
                 "port": port,
@@ -57,72 +95,303 @@ class GuacamoleService:
                 "width": width,
                 "height": height,
                 "dpi": dpi,
-                "image": ["image/png","image/jpeg"],
                 "audio": ["audio/ogg", "audio/mp3", "audio/aac"]
                 # "video": ["video/h264", "video/webm"]
 
             }
+            connection_params.update(handshake_params(quality.level))
 
             # 添加其他参数
             connection_params.update(kwargs)
 
-            # 创建 GuacamoleClient 实例
-            client = GuacamoleClient(self.host, self.port, timeout=10)
+            # 选择连接最少的guacd完成握手，guacd不可达时换下一个后端
+            client, backend = await self._handshake(protocol, connection_params)
+            if client is None:
+                return {"success": False, "error": f"连接或握手失败: {backend}"}
+            metrics.on_handshake()
+            logger.info(f"Guacamole握手成功: {connection_id}, guacd: {backend.address} -> {hostname}:{port}")
 
-            # 在单独的线程中执行连接和握手
-            def connect_and_handshake():
-                try:
-
-                    # 执行协议握手
-                    handshake_result = client.handshake(
-                        protocol=protocol,
-                        **connection_params
-                    )
-
-                    logger.info(f"Guacamole握手成功: {connection_id}")
-                    return True, handshake_result
-                except Exception as e:
-                    logger.exception(f"Guacamole连接或握手失败: {e}")
-                    try:
-                        client.close()
-                    except:
-                        pass
-                    return False, str(e)
-
-            # 在事件循环中执行阻塞操作
-            loop = asyncio.get_event_loop()
-            success, result = await loop.run_in_executor(None, connect_and_handshake)
-
-            if not success:
-                return {"success": False, "error": f"连接或握手失败: {result}"}
-
-            # 存储客户端对象和参数
-            self.connections[connection_id] = {
-                "client": client,
-                "protocol": protocol,
-                "params": connection_params,
-                "active": True
-            }
+            queue = self._add_connection(
+                connection_id, client, backend, protocol, connection_params, quality, metrics,
+                student_task_id, attach=attach
+            )
 
             logger.info(f"成功创建 Guacamole 连接: {connection_id}, 协议: {protocol}")
             return {
                 "success": True,
-                "connection_id": connection_id
+                "connection_id": connection_id,
+                "queue": queue
             }
 
         except Exception as e:
             logger.exception(f"创建 Guacamole 连接失败: {e}")
             return {"success": False, "error": str(e)}
 
-    async def read_instruction(self, connection_id: str) -> Optional[str]:
+    def _add_connection(
+            self, connection_id: str, client: GuacdClient, backend: GuacdBackend, protocol: str,
+            params: Dict[str, Any], quality: QualityController, metrics: TunnelMetrics,
+            student_task_id: Optional[int], attach: bool = False
+    ) -> Optional[FrameQueue]:
+        """
+        登记握手完成的guacd连接并开始读取
+
+        需要接入WebSocket时在开始读取前创建发送队列，guacd握手后立即发出的画面不会丢失
+
+        Returns:
+            Optional[FrameQueue]: attach为True时返回WebSocket的发送队列
+        """
+        guacd_pool.acquire(backend)
+        self.connections[connection_id] = {
+            "client": client,
+            "backend": backend,
+            "coalescer": self._create_coalescer(client, quality),
+            # 当前接入的WebSocket的发送队列，断线期间为None
+            "queue": None,
+            "student_task_id": student_task_id,
+            # 断线后延迟关闭的定时器
+            "close_handle": None,
+            # 画质控制器及上次切换档位的时间
+            "quality": quality,
+            "quality_changed_at": time.monotonic(),
+            "quality_task": None,
+            # 性能计数器
+            "metrics": metrics,
+            "protocol": protocol,
+            "params": params,
+            "active": True
+        }
+
+        # 登记到Redis隧道注册表，供其他节点查询、加入或关闭
+        self.start()
+        guacamole_registry.register(
+            connection_id,
+            student_task_id=student_task_id,
+            protocol=protocol,
+            hostname=params.get("hostname"),
+            guacd=backend.address,
+            guacd_id=client.guacd_id,
+            width=params.get("width"),
+            height=params.get("height"),
+            quality=quality.profile["name"]
+        )
+        queue = self.attach(connection_id) if attach else None
+
+        # 隧道独立于WebSocket持续读取guacd，断线期间也保持RDP会话
+        self.tasks[connection_id] = asyncio.create_task(self._pump(connection_id))
+        if settings.GUACAMOLE_ADAPTIVE_QUALITY:
+            self.connections[connection_id]["quality_task"] = asyncio.create_task(
+                self._adapt_quality(connection_id)
+            )
+        return queue
+
+    async def resume(
+            self, student_task_id: int, width: int, height: int, connection_id: str = None
+    ) -> Optional[Tuple[str, FrameQueue]]:
+        """
+        接管学生任务已有的隧道(断线前的隧道或预热的隧道)，隧道可以在任意网关节点上
+
+        以 select <guacd连接ID> 作为新用户加入guacd上仍在运行的连接，guacd会向新用户
+        发送完整的当前画面；加入成功后再关闭原持有者的guacd用户，RDP会话不中断。
+        接管后的隧道使用新的连接ID登记在本进程。
+
+        Args:
+            student_task_id: 学生任务ID
+            width: 新连接请求的屏幕宽度，与原隧道不同时通知guacd调整分辨率
+            height: 新连接请求的屏幕高度
+            connection_id: 客户端提供的原连接ID，未提供时按学生任务查找
+
+        Returns:
+            Optional[Tuple[str, FrameQueue]]: (新的连接ID, WebSocket的发送队列)，没有可接管的隧道时返回None
+        """
+        if connection_id:
+            record = await guacamole_registry.find_tunnel(connection_id)
+        else:
+            record = await guacamole_registry.find_by_student_task(student_task_id)
+        if not record or str(record.get("student_task_id")) != str(student_task_id) \
+                or not record.get("guacd_id"):
+            return None
+        backend = guacd_pool.find(record.get("guacd"))
+        if backend is None:
+            logger.warning(f"隧道 {record['connection_id']} 所在的guacd不在本节点的后端池中: {record.get('guacd')}")
+            return None
+
+        metrics = TunnelMetrics()
+        quality = QualityController(
+            level=profile_index(record.get("quality") or settings.GUACAMOLE_QUALITY_DEFAULT),
+            lag_high=settings.GUACAMOLE_QUALITY_LAG_HIGH_MS / 1000,
+            lag_low=settings.GUACAMOLE_QUALITY_LAG_LOW_MS / 1000
+        )
+        # 加入已有连接时guacd只采用新用户的屏幕、音频与图片格式参数，远程主机与登录参数沿用原连接
+        params = {
+            "hostname": record.get("hostname"),
+            "width": width,
+            "height": height,
+            "dpi": 96,
+            "audio": ["audio/ogg", "audio/mp3", "audio/aac"]
+        }
+        params.update(handshake_params(quality.level))
+        client, error = await self._handshake(record["guacd_id"], params, backend=backend)
+        if client is None:
+            logger.info(f"无法加入隧道 {record['connection_id']} 的guacd连接: {error}")
+            return None
+        metrics.on_handshake()
+
+        new_connection_id = str(uuid.uuid4())
+        queue = self._add_connection(
+            new_connection_id, client, backend, record.get("protocol") or "rdp", params, quality, metrics,
+            student_task_id, attach=True
+        )
+        if record.get("width") != str(width) or record.get("height") != str(height):
+            await self.send_instruction(new_connection_id, encode_instruction("size", width, height))
+
+        # 新用户已加入，guacd连接至少还有一个用户，此时关闭原持有者
+        await guacamole_registry.request_close(record["connection_id"])
+        logger.info(f"学生任务 {student_task_id} 接管隧道 {record['connection_id']} -> {new_connection_id}")
+        return new_connection_id, queue
+
+    @staticmethod
+    async def _handshake(protocol: str, params: Dict[str, Any], backend: GuacdBackend = None):
+        """
+        创建异步guacd客户端并完成握手，全程不占用线程池
+
+        Args:
+            protocol: 远程桌面协议
+            params: 握手参数
+            backend: 指定的guacd后端，为空时按最少连接选择，连接失败时依次尝试其他后端
+
+        Returns:
+            (GuacdClient, GuacdBackend)，失败时为 (None, 错误信息)
+        """
+        tried = []
+        error = "没有可用的guacd"
+        while True:
+            if backend is not None:
+                candidate = None if tried else backend
+            else:
+                candidate = guacd_pool.choose(exclude=tried)
+            if candidate is None:
+                return None, error
+            tried.append(candidate)
+
+            client = GuacdClient(candidate.host, candidate.port, timeout=10)
+            try:
+                await client.handshake(protocol=protocol, **params)
+                guacd_pool.mark_success(candidate)
+                return client, candidate
+            except (OSError, asyncio.TimeoutError) as e:
+                # guacd不可达或无响应，计入后端失败
+                error = f"{candidate.address}: {str(e) or type(e).__name__}"
+                logger.warning(f"guacd连接失败: {error}")
+                guacd_pool.mark_failure(candidate, error)
+                await client.close()
+            except Exception as e:
+                logger.exception(f"Guacamole连接或握手失败: {e}")
+                await client.close()
+                return None, e
+
+    async def create_rdp_tunnel(
+            self, hostname: str, password: str, width: int, height: int, student_task_id: int,
+            attach: bool = False
+    ) -> Dict[str, Any]:
+        """
+        使用平台统一的RDP参数为学生任务的ECS实例创建隧道
+
+        Returns:
+            Dict: 同create_tunnel
+        """
+        logger.info(f"创建RDP连接到 {hostname}:3389")
+        return await self.create_tunnel(
+            protocol="rdp",
+            hostname=hostname,
+            port=3389,
+            username="Administrator",
+            password=password,
+            width=width,
+            height=height,
+            dpi=96,
+            security="any",
+            ignore_cert="true",
+            # 允许在会话中调整分辨率，预热的隧道接入时按浏览器尺寸调整
+            resize_method="display-update",
+            enable_wallpaper="false",
+            enable_theming="false",
+            enable_font_smoothing="false",
+            enable_full_window_drag="false",
+            enable_desktop_composition="false",
+            enable_menu_animations="false",
+            disable_audio="true",
+            student_task_id=student_task_id,
+            attach=attach
+        )
+
+    async def prewarm(self, student_task_id: int):
+        """
+        实例变为Running后预先建立RDP隧道并完成Windows登录，学生打开页面时由处理请求的网关进程接管
+
+        Windows刚启动时RDP服务可能尚未就绪，隧道很快被guacd关闭，此时按
+        GUACAMOLE_PREWARM_RETRY_DELAY间隔重试。未被接入的隧道在GUACAMOLE_PREWARM_TTL后关闭。
+        没有留下隧道时释放预热认领标记，之后的预热广播可以重新处理。
+        """
+        try:
+            for attempt in range(settings.GUACAMOLE_PREWARM_RETRIES):
+                if attempt:
+                    await asyncio.sleep(settings.GUACAMOLE_PREWARM_RETRY_DELAY)
+                # 学生已经接入(可能已被其他节点接管)或预热隧道仍然存活
+                if await guacamole_registry.find_by_student_task(student_task_id):
+                    return
+
+                db = SessionLocal()
+                try:
+                    ecs = crud_ecs_instance.get_by_student_task_id(db=db, student_task_id=student_task_id)
+                finally:
+                    db.close()
+                if not ecs or not ecs.private_ip or ecs.status != "Running":
+                    logger.info(f"学生任务 {student_task_id} 的实例未就绪，跳过预热")
+                    return
+
+                result = await self.create_rdp_tunnel(
+                    ecs.private_ip, ecs.password,
+                    settings.GUACAMOLE_PREWARM_WIDTH, settings.GUACAMOLE_PREWARM_HEIGHT,
+                    student_task_id
+                )
+                if not result["success"]:
+                    continue
+
+                connection_id = result["connection_id"]
+                conn_data = self.connections.get(connection_id)
+                if not conn_data:
+                    continue
+                guacamole_registry.update(connection_id, prewarmed=1)
+                loop = asyncio.get_running_loop()
+                conn_data["close_handle"] = loop.call_later(
+                    settings.GUACAMOLE_PREWARM_TTL, lambda: loop.create_task(self.close_tunnel(connection_id))
+                )
+                logger.info(f"已为学生任务 {student_task_id} 预热隧道: {connection_id} (第{attempt + 1}次)")
+        finally:
+            if not await guacamole_registry.find_by_student_task(student_task_id):
+                guacamole_registry.release_prewarm(student_task_id)
+
+    @staticmethod
+    def _create_coalescer(client: GuacdClient, quality: QualityController) -> FrameCoalescer:
+        """按画质档位创建帧合并器，未启用自适应画质时使用全局配置的等待时间"""
+        if settings.GUACAMOLE_ADAPTIVE_QUALITY:
+            max_delay = quality.profile["frame_delay"] / 1000
+        else:
+            max_delay = settings.GUACAMOLE_FRAME_MAX_DELAY_MS / 1000
+        return FrameCoalescer(client.parser, max_bytes=settings.GUACAMOLE_FRAME_MAX_BYTES, max_delay=max_delay)
+
+    async def read_frame(self, connection_id: str) -> Optional[GuacamoleFrame]:
         """
-        从Guacamole服务器读取指令数据，返回原始字符串
+        从Guacamole服务器读取一个合并后的帧
+
+        帧由若干条完整指令组成，按GUACAMOLE_FRAME_MAX_BYTES和
+        GUACAMOLE_FRAME_MAX_DELAY_MS限定大小与等待时间
 
         Args:
             connection_id: 连接标识符
 
         Returns:
-            Optional[str]: 接收到的原始指令字符串，或者None表示无数据或出错
+            Optional[GuacamoleFrame]: 待发送的帧，或者None表示连接已关闭或出错
         """
         if connection_id not in self.connections:
             return None
@@ -132,30 +401,374 @@ class GuacamoleService:
             return None
 
         client = conn_data["client"]
-        loop = asyncio.get_event_loop()
 
         try:
-            # 在线程池中非阻塞地接收数据
-            def receive_data():
-                try:
-                    # 直接返回原始指令字符串
-                    return client.receive()
-                except Exception as e:
-                    if "timed out" in str(e).lower():
-                        # 超时是正常的，返回None
-                        return None
-                    # 其他错误记录并返回None
-                    logger.debug(f"接收数据时出错: {e}")
-                    return None
-
-            # 执行接收操作
-            instruction = await loop.run_in_executor(None, receive_data)
-            return instruction
-
+            # 直接在事件循环中等待数据，连接关闭时返回None
+            return await client.receive_frame(conn_data["coalescer"])
         except Exception as e:
             logger.error(f"读取指令时出错: {e}")
             return None
 
+    async def _pump(self, connection_id: str):
+        """
+        持续从guacd读取帧，放入当前接入的发送队列；
+        没有WebSocket接入时代替客户端回复sync，避免guacd判定客户端无响应。
+        guacd断开时关闭隧道。
+        """
+        conn_data = self.connections.get(connection_id)
+        if not conn_data:
+            return
+
+        last_sync = 0.0
+        try:
+            while True:
+                frame = await self.read_frame(connection_id)
+                if frame is None:
+                    break
+
+                queue = conn_data["queue"]
+                if queue is not None:
+                    # 队列超限(disconnect策略)时由发送端断开WebSocket，隧道保留等待重连
+                    await queue.put(frame)
+                else:
+                    await self._ack_syncs(conn_data, frame)
+
+                # 按画质档位限制出帧间隔: 暂停读取guacd，guacd收到的sync回复随之变慢并降低出帧频率
+                if b"sync" in frame.opcodes:
+                    interval = conn_data["quality"].profile["frame_interval"] / 1000
+                    now = time.monotonic()
+                    if interval and settings.GUACAMOLE_ADAPTIVE_QUALITY and now - last_sync < interval:
+                        await asyncio.sleep(interval - (now - last_sync))
+                    last_sync = time.monotonic()
+        except asyncio.CancelledError:
+            raise
+        except ConnectionError as e:
+            # 客户端已发出disconnect或guacd重启，属正常断开
+            logger.info(f"guacd连接已断开: {connection_id}, {e}")
+        except Exception as e:
+            logger.exception(f"读取guacd数据时出错: {e}")
+
+        logger.info(f"guacd连接已关闭: {connection_id}")
+        await self.close_tunnel(connection_id)
+
+    async def _ack_syncs(self, conn_data: Dict[str, Any], frame: GuacamoleFrame):
+        """代替断线的客户端回复帧内的sync指令"""
+        for index, opcode in enumerate(frame.opcodes):
+            if opcode == b"sync":
+                timestamp = frame.arguments(index, 1)[0].decode()
+                await conn_data["client"].send(encode_instruction("sync", timestamp))
+
+    def attach(self, connection_id: str) -> Optional[FrameQueue]:
+        """
+        为新的WebSocket接入隧道，已有WebSocket接入时由新连接接管
+        只能在新建或刚加入的guacd连接开始读取前调用，客户端由此收到完整画面
+
+        Returns:
+            Optional[FrameQueue]: 新WebSocket的发送队列，隧道不存在时返回None
+        """
+        conn_data = self.connections.get(connection_id)
+        if not conn_data or not conn_data.get("active", False):
+            return None
+
+        if conn_data["close_handle"]:
+            conn_data["close_handle"].cancel()
+            conn_data["close_handle"] = None
+        if conn_data["queue"] is not None:
+            logger.info(f"新的WebSocket接管连接: {connection_id}")
+            conn_data["queue"].close()
+
+        queue = FrameQueue(
+            max_bytes=settings.GUACAMOLE_SEND_QUEUE_MAX_BYTES,
+            max_frames=settings.GUACAMOLE_SEND_QUEUE_MAX_FRAMES,
+            policy=settings.GUACAMOLE_BACKPRESSURE_POLICY
+        )
+        conn_data["queue"] = queue
+        conn_data["quality"].reset()
+        guacamole_registry.update(connection_id, attached=1)
+        return queue
+
+    async def add_observer(self, student_task_id: int) -> Optional[Tuple[str, FrameQueue]]:
+        """
+        为只读旁观者(如教师)接入学生的隧道，学生的隧道可以在任意网关节点上
+
+        以 select <guacd连接ID> 并带 read-only 参数加入guacd上的连接，不会新建RDP会话；
+        guacd向旁观者发送完整的当前画面，之后与学生收到相同的实时更新，旁观者的键鼠输入被guacd忽略。
+
+        Returns:
+            Optional[Tuple[str, FrameQueue]]: (旁观者ID, 发送队列)，学生没有打开远程桌面时返回None
+        """
+        record = await guacamole_registry.find_by_student_task(student_task_id)
+        if not record or not record.get("guacd_id"):
+            return None
+        backend = guacd_pool.find(record.get("guacd"))
+        if backend is None:
+            logger.warning(f"隧道 {record['connection_id']} 所在的guacd不在本节点的后端池中: {record.get('guacd')}")
+            return None
+
+        params = {
+            "width": record.get("width") or settings.GUACAMOLE_PREWARM_WIDTH,
+            "height": record.get("height") or settings.GUACAMOLE_PREWARM_HEIGHT,
+            "dpi": 96,
+            "read_only": "true",
+        }
+        params.update(handshake_params(profile_index(record.get("quality") or settings.GUACAMOLE_QUALITY_DEFAULT)))
+        client, error = await self._handshake(record["guacd_id"], params, backend=backend)
+        if client is None:
+            logger.info(f"旁观者无法加入隧道 {record['connection_id']} 的guacd连接: {error}")
+            return None
+
+        observer_id = str(uuid.uuid4())
+        # 旁观者队列超限时直接断开
+        queue = FrameQueue(
+            max_bytes=settings.GUACAMOLE_SEND_QUEUE_MAX_BYTES,
+            max_frames=settings.GUACAMOLE_SEND_QUEUE_MAX_FRAMES,
+            policy=POLICY_DISCONNECT
+        )
+        guacd_pool.acquire(backend)
+        self.observers[observer_id] = {
+            "client": client,
+            "backend": backend,
+            "queue": queue,
+            "student_task_id": student_task_id,
+            "guacd_id": client.guacd_id,
+            "tasks": [],
+        }
+        self.observers[observer_id]["tasks"] = [
+            asyncio.create_task(self._pump_observer(observer_id)),
+            asyncio.create_task(self._watch_observer(observer_id)),
+        ]
+        logger.info(f"旁观者 {observer_id} 只读加入学生任务 {student_task_id} 的隧道 {record['connection_id']}")
+        return observer_id, queue
+
+    async def _pump_observer(self, observer_id: str):
+        """把旁观者guacd用户收到的帧放入其发送队列，guacd断开或队列超限时结束旁观"""
+        observer = self.observers.get(observer_id)
+        if not observer:
+            return
+        coalescer = FrameCoalescer(
+            observer["client"].parser, max_bytes=settings.GUACAMOLE_FRAME_MAX_BYTES,
+            max_delay=settings.GUACAMOLE_FRAME_MAX_DELAY_MS / 1000
+        )
+        try:
+            while True:
+                frame = await observer["client"].receive_frame(coalescer)
+                if frame is None or not await observer["queue"].put(frame):
+                    break
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.info(f"旁观者 {observer_id} 的guacd连接已断开: {e}")
+        await self.remove_observer(observer_id)
+
+    async def _watch_observer(self, observer_id: str):
+        """
+        学生的隧道关闭后结束旁观，避免只剩旁观者时guacd连接和RDP会话一直保持
+        隧道被其他节点接管时guacd连接ID不变，旁观继续
+        """
+        while True:
+            await asyncio.sleep(OBSERVER_CHECK_INTERVAL)
+            observer = self.observers.get(observer_id)
+            if not observer:
+                return
+            record = await guacamole_registry.find_by_student_task(observer["student_task_id"])
+            if not record or record.get("guacd_id") != observer["guacd_id"]:
+                logger.info(f"学生任务 {observer['student_task_id']} 的隧道已关闭，结束旁观 {observer_id}")
+                await self.remove_observer(observer_id)
+                return
+
+    async def send_observer_instruction(self, observer_id: str, text: str):
+        """
+        转发旁观者客户端发来的sync回复与nop，其余指令一律丢弃
+        guacd按各用户的sync回复估算处理延迟，旁观者不回复会拖慢学生的画面
+        """
+        observer = self.observers.get(observer_id)
+        if not observer:
+            return
+        instructions = "".join(_CLIENT_KEEPALIVE.findall(text))
+        if not instructions:
+            return
+        try:
+            await observer["client"].send(instructions)
+        except Exception as e:
+            logger.info(f"转发旁观者指令失败: {observer_id}, {e}")
+
+    async def remove_observer(self, observer_id: str):
+        """旁观者断开，退出guacd连接"""
+        observer = self.observers.pop(observer_id, None)
+        if not observer:
+            return
+        observer["queue"].close()
+        for task in observer["tasks"]:
+            if task is not asyncio.current_task():
+                task.cancel()
+        guacd_pool.release(observer["backend"])
+        try:
+            await observer["client"].close()
+        except Exception as e:
+            logger.warning(f"关闭旁观者guacd连接时出错: {e}")
+        logger.info(f"旁观者 {observer_id} 已断开")
+
+    async def detach(self, connection_id: str, queue: FrameQueue):
+        """
+        WebSocket断开后脱离隧道，隧道在GUACAMOLE_RESUME_GRACE_SECONDS内保留等待重连
+
+        Args:
+            connection_id: 连接标识符
+            queue: 断开的WebSocket的发送队列，已被新连接接管时不做处理
+        """
+        queue.close()
+        conn_data = self.connections.get(connection_id)
+        if not conn_data or conn_data["queue"] is not queue:
+            return
+
+        conn_data["queue"] = None
+        grace = settings.GUACAMOLE_RESUME_GRACE_SECONDS
+        if grace <= 0:
+            await self.close_tunnel(connection_id)
+            return
+
+        logger.info(f"WebSocket已脱离连接 {connection_id}，保留 {grace} 秒等待重连")
+        guacamole_registry.update(connection_id, attached=0)
+        loop = asyncio.get_running_loop()
+        conn_data["close_handle"] = loop.call_later(
+            grace, lambda: loop.create_task(self.close_tunnel(connection_id))
+        )
+
+    def record_sent(self, connection_id: str, frame: GuacamoleFrame):
+        """记录已发送给客户端的帧，供画质控制器统计"""
+        conn_data = self.connections.get(connection_id)
+        if conn_data:
+            conn_data["quality"].on_frame_sent(frame)
+            conn_data["metrics"].on_frame_sent(frame)
+
+    async def _adapt_quality(self, connection_id: str):
+        """
+        定期评估会话画质，需要切换档位时调整本进程内的帧合并与出帧间隔
+        两次切换之间至少间隔GUACAMOLE_QUALITY_MIN_INTERVAL秒，避免档位来回抖动
+        """
+        while True:
+            await asyncio.sleep(settings.GUACAMOLE_QUALITY_SAMPLE_SECONDS)
+            conn_data = self.connections.get(connection_id)
+            if not conn_data or not conn_data.get("active", False):
+                return
+            queue = conn_data["queue"]
+            if queue is None:
+                # 没有客户端接入时无法测量
+                continue
+
+            level = conn_data["quality"].sample(queue.congestion_events)
+            if level is None:
+                continue
+            if time.monotonic() - conn_data["quality_changed_at"] < settings.GUACAMOLE_QUALITY_MIN_INTERVAL:
+                continue
+            self._set_quality(connection_id, level)
+
+    def _set_quality(self, connection_id: str, level: int):
+        """
+        切换画质档位，只调整不需要重新连接guacd的设置(帧合并等待与出帧间隔)，
+        画面不中断；色深与图片格式在该学生下次新建或接管隧道时按新档位握手
+        """
+        conn_data = self.connections[connection_id]
+        quality = conn_data["quality"]
+        logger.info(f"连接 {connection_id} 画质调整: {quality.profile['name']} -> {QUALITY_PROFILES[level]['name']}")
+        quality.set_level(level)
+        conn_data["quality_changed_at"] = time.monotonic()
+        if settings.GUACAMOLE_ADAPTIVE_QUALITY:
+            conn_data["coalescer"].max_delay = quality.profile["frame_delay"] / 1000
+        guacamole_registry.update(connection_id, quality=quality.profile["name"])
+
+    def get_sessions_stats(self) -> List[Dict[str, Any]]:
+        """
+        所有活跃连接的发送队列、旁观者及画质指标
+
+        连接与旁观者由事件循环增删，需在事件循环中调用；两者各取一次快照
+        """
+        connections = list(self.connections.items())
+        observers: Dict[str, Dict[str, Any]] = {}
+        for observer_id, observer in list(self.observers.items()):
+            observers.setdefault(observer["guacd_id"], {})[observer_id] = observer["queue"].stats()
+        return [
+            {
+                "connection_id": connection_id,
+                "student_task_id": conn_data["student_task_id"],
+                "protocol": conn_data["protocol"],
+                "hostname": conn_data["params"].get("hostname"),
+                "guacd": conn_data["backend"].address,
+                "attached": conn_data["queue"] is not None,
+                "queue": conn_data["queue"].stats() if conn_data["queue"] else None,
+                "observers": observers.get(conn_data["client"].guacd_id, {}),
+                "quality": conn_data["quality"].stats()
+            }
+            for connection_id, conn_data in connections
+        ]
+
+    def _metric_labels(self, connection_id: str, conn_data: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "connection_id": connection_id,
+            "student_task_id": conn_data["student_task_id"] or "",
+            "hostname": conn_data["params"].get("hostname") or "",
+            "guacd": conn_data["backend"].address,
+        }
+
+    def _local_metrics(self, connections: List[Tuple[str, Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        """本进程各活跃连接的性能计数器"""
+        return [
+            {
+                **self._metric_labels(connection_id, conn_data),
+                "quality": conn_data["quality"].stats(),
+                **conn_data["metrics"].stats()
+            }
+            for connection_id, conn_data in connections
+        ]
+
+    def _metrics_snapshot(self) -> Dict[str, Any]:
+        """
+        本进程的指标快照，定期写入Redis供任意进程汇总
+
+        连接由事件循环增删，需在事件循环中调用，连接列表只取一次快照
+        """
+        connections = list(self.connections.items())
+        return {
+            "node": guacamole_registry.node_id,
+            "tunnels": [
+                (self._metric_labels(connection_id, conn_data), conn_data["metrics"].snapshot())
+                for connection_id, conn_data in connections
+            ],
+            "backends": guacd_pool.stats(),
+            "closed_tunnels": self.closed_tunnels,
+            "summary": self._local_metrics(connections),
+        }
+
+    async def _publish_metrics(self):
+        """每GUACAMOLE_METRICS_PUBLISH_INTERVAL秒把本进程的指标快照写入Redis"""
+        while True:
+            await asyncio.sleep(settings.GUACAMOLE_METRICS_PUBLISH_INTERVAL)
+            try:
+                guacamole_registry.publish_metrics(self._metrics_snapshot())
+            except Exception as e:
+                logger.warning(f"发布隧道指标失败: {e}")
+
+    async def _collect_metrics(self) -> List[Dict[str, Any]]:
+        """汇总所有网关进程的指标快照，本进程使用实时数据"""
+        nodes = [
+            node for node in await guacamole_registry.collect_metrics()
+            if node["node"] != guacamole_registry.node_id
+        ]
+        if guacamole_registry.node_id:
+            nodes.append(self._metrics_snapshot())
+        return nodes
+
+    async def get_metrics(self) -> List[Dict[str, Any]]:
+        """所有网关进程上活跃连接的性能计数器"""
+        return [
+            {"node": node["node"], **tunnel}
+            for node in await self._collect_metrics() for tunnel in node["summary"]
+        ]
+
+    async def render_metrics(self) -> str:
+        """按Prometheus文本格式导出所有网关进程的隧道指标"""
+        return render_prometheus(await self._collect_metrics())
+
     async def send_instruction(self, connection_id: str, instruction: str) -> bool:
         """
         发送原始指令字符串到Guacamole服务器
@@ -177,19 +790,12 @@ class GuacamoleService:
             return False
 
         client = conn_data["client"]
-        loop = asyncio.get_event_loop()
+        sync_lags = conn_data["quality"].on_client_message(instruction)
+        conn_data["metrics"].on_client_message(instruction, sync_lags)
 
         try:
-            # 在线程池中执行发送操作
-            def send_data():
-                try:
-                    client.send(instruction)
-                    return True
-                except Exception as e:
-                    logger.error(f"发送指令时出错: {e}")
-                    return False
-
-            return await loop.run_in_executor(None, send_data)
+            await client.send(instruction)
+            return True
         except Exception as e:
             logger.error(f"发送指令时出错: {e}")
             return False
@@ -211,43 +817,46 @@ class GuacamoleService:
         conn_data = self.connections[connection_id]
         client = conn_data["client"]
 
-        # 标记连接为非活跃
+        # 标记连接为非活跃，停止读取任务并唤醒等待发送队列的任务
         conn_data["active"] = False
+        if conn_data["close_handle"]:
+            conn_data["close_handle"].cancel()
+        if conn_data["queue"] is not None:
+            conn_data["queue"].close()
+        pump_task = self.tasks.pop(connection_id, None)
+        if pump_task and pump_task is not asyncio.current_task():
+            pump_task.cancel()
+        if conn_data["quality_task"] and conn_data["quality_task"] is not asyncio.current_task():
+            conn_data["quality_task"].cancel()
 
         try:
-            # 在线程池中执行关闭操作
-            def close_connection():
-                try:
-                    # 尝试发送断开连接指令
-                    try:
-                        client.send("disconnect;")
-                    except:
-                        pass
-
-                    # 关闭连接
-                    client.close()
-                    return True
-                except Exception as e:
-                    logger.error(f"关闭连接时出错: {e}")
-                    return False
-
-            loop = asyncio.get_event_loop()
-            success = await loop.run_in_executor(None, close_connection)
-
-            # 无论关闭是否成功，都从连接字典中移除
-            if connection_id in self.connections:
-                del self.connections[connection_id]
-
+            # 发送disconnect指令并关闭连接
+            await client.close()
             logger.info(f"已关闭连接: {connection_id}")
-            return success
+            return True
         except Exception as e:
             logger.exception(f"关闭连接时出错: {e}")
-
-            # 确保连接从字典中移除
-            if connection_id in self.connections:
-                del self.connections[connection_id]
-
             return False
+        finally:
+            # 无论关闭是否成功，都从连接字典和注册表中移除
+            guacd_pool.release(conn_data["backend"])
+            self.closed_tunnels += 1
+            self.connections.pop(connection_id, None)
+            guacamole_registry.unregister(connection_id)
+            if conn_data["student_task_id"]:
+                # 预热隧道过期或学生的隧道关闭后，允许再次预热
+                guacamole_registry.release_prewarm(conn_data["student_task_id"])
+
+    async def close_all(self):
+        """关闭本进程内的所有隧道和旁观者，用于进程退出"""
+        for observer_id in list(self.observers.keys()):
+            await self.remove_observer(observer_id)
+        for connection_id in list(self.connections.keys()):
+            await self.close_tunnel(connection_id)
+        if self._metrics_task:
+            self._metrics_task.cancel()
+        guacamole_registry.stop()
+        guacd_pool.stop()
 
 
 # 单例实例
@@ -0,0 +1,206 @@
+import bisect
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from app.services.guacamole_protocol import GuacamoleFrame
+
+# 帧大小(字节)与sync往返延迟(秒)的直方图分桶
+FRAME_SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144)
+SYNC_RTT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+class Histogram:
+    """固定分桶的直方图，桶计数不累计，导出时再按Prometheus格式累计"""
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """按桶上界估算分位数，落在最后一个桶之外时返回最大的桶上界"""
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return self.buckets[min(index, len(self.buckets) - 1)]
+        return None
+
+    def snapshot(self) -> Dict[str, Any]:
+        """可序列化的原始计数，用于跨进程汇总"""
+        return {"buckets": list(self.buckets), "counts": list(self.counts), "sum": self.sum, "count": self.count}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "avg": round(self.sum / self.count, 4) if self.count else None,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+        }
+
+
+class TunnelMetrics:
+    """单个隧道的性能计数器"""
+
+    def __init__(self):
+        self.created_at = time.time()
+        self._started = time.monotonic()
+        self.handshake_seconds: Optional[float] = None
+        self.first_frame_seconds: Optional[float] = None
+        self.bytes_down = 0
+        self.bytes_up = 0
+        self.instructions_down = 0
+        self.instructions_up = 0
+        self.frames_down = 0
+        self.frame_size = Histogram(FRAME_SIZE_BUCKETS)
+        self.sync_rtt = Histogram(SYNC_RTT_BUCKETS)
+
+    def on_handshake(self):
+        self.handshake_seconds = time.monotonic() - self._started
+
+    def on_frame_sent(self, frame: GuacamoleFrame):
+        if self.first_frame_seconds is None:
+            self.first_frame_seconds = time.monotonic() - self._started
+        size = len(frame)
+        self.bytes_down += size
+        self.instructions_down += len(frame.instructions)
+        self.frames_down += 1
+        self.frame_size.observe(size)
+
+    def on_client_message(self, text: str, sync_lags: Iterable[float] = ()):
+        # 客户端每条消息由完整指令组成，键鼠和剪贴板(base64)指令中不会出现';'
+        self.bytes_up += len(text.encode("utf-8"))
+        self.instructions_up += text.count(";")
+        for lag in sync_lags:
+            self.sync_rtt.observe(lag)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """可序列化的原始计数，用于跨进程汇总"""
+        return {
+            "bytes_down": self.bytes_down,
+            "bytes_up": self.bytes_up,
+            "instructions_down": self.instructions_down,
+            "instructions_up": self.instructions_up,
+            "frames_down": self.frames_down,
+            "handshake_seconds": self.handshake_seconds,
+            "first_frame_seconds": self.first_frame_seconds,
+            "frame_size": self.frame_size.snapshot(),
+            "sync_rtt": self.sync_rtt.snapshot(),
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        elapsed = max(time.monotonic() - self._started, 1e-6)
+        return {
+            "uptime_seconds": round(elapsed, 1),
+            "handshake_seconds": round(self.handshake_seconds, 3) if self.handshake_seconds is not None else None,
+            "first_frame_seconds": round(self.first_frame_seconds, 3) if self.first_frame_seconds is not None else None,
+            "bytes_down": self.bytes_down,
+            "bytes_up": self.bytes_up,
+            "instructions_down": self.instructions_down,
+            "instructions_up": self.instructions_up,
+            "frames_down": self.frames_down,
+            "avg_instructions_per_second": round(self.instructions_down / elapsed, 1),
+            "frame_size": self.frame_size.stats(),
+            "sync_rtt": self.sync_rtt.stats(),
+        }
+
+
+def _labels(labels: Dict[str, Any]) -> str:
+    if not labels:
+        return ""
+    items = []
+    for key, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        items.append(f'{key}="{value}"')
+    return "{" + ",".join(items) + "}"
+
+
+def _histogram_lines(name: str, labels: Dict[str, Any], histogram: Dict[str, Any]) -> List[str]:
+    lines = []
+    cumulative = 0
+    for bound, count in zip(list(histogram["buckets"]) + ["+Inf"], histogram["counts"]):
+        cumulative += count
+        lines.append(f"{name}_bucket{_labels({**labels, 'le': bound})} {cumulative}")
+    lines.append(f"{name}_sum{_labels(labels)} {histogram['sum']}")
+    lines.append(f"{name}_count{_labels(labels)} {histogram['count']}")
+    return lines
+
+
+def render_prometheus(nodes: List[Dict[str, Any]]) -> str:
+    """
+    按Prometheus文本格式导出所有网关进程的隧道与guacd后端指标
+
+    Args:
+        nodes: 各进程的指标快照，包含 node(节点ID)、tunnels((标签, TunnelMetrics.snapshot()) 列表，
+            标签如连接ID、学生任务ID、实例IP、guacd地址)、backends(guacd后端状态列表)、
+            closed_tunnels(该进程已关闭的隧道数)
+    """
+    counters = (
+        ("guacamole_tunnel_bytes_down_total", "发往客户端的字节数", "bytes_down"),
+        ("guacamole_tunnel_bytes_up_total", "客户端发来的字节数", "bytes_up"),
+        ("guacamole_tunnel_instructions_down_total", "发往客户端的指令数", "instructions_down"),
+        ("guacamole_tunnel_instructions_up_total", "客户端发来的指令数", "instructions_up"),
+        ("guacamole_tunnel_frames_down_total", "发往客户端的帧数", "frames_down"),
+    )
+    gauges = (
+        ("guacamole_tunnel_handshake_seconds", "guacd握手耗时", "handshake_seconds"),
+        ("guacamole_tunnel_first_frame_seconds", "创建隧道到首帧发出的耗时", "first_frame_seconds"),
+    )
+    tunnels = [
+        ({"node": node["node"], **labels}, metrics)
+        for node in nodes for labels, metrics in node["tunnels"]
+    ]
+
+    lines = [
+        "# HELP guacamole_tunnels 各网关进程持有的隧道数",
+        "# TYPE guacamole_tunnels gauge",
+    ]
+    for node in nodes:
+        lines.append(f"guacamole_tunnels{_labels({'node': node['node']})} {len(node['tunnels'])}")
+    lines.append("# HELP guacamole_tunnels_closed_total 各网关进程已关闭的隧道数")
+    lines.append("# TYPE guacamole_tunnels_closed_total counter")
+    for node in nodes:
+        lines.append(f"guacamole_tunnels_closed_total{_labels({'node': node['node']})} {node['closed_tunnels']}")
+    for name, help_text, key in counters:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} counter")
+        for labels, metrics in tunnels:
+            lines.append(f"{name}{_labels(labels)} {metrics[key]}")
+    for name, help_text, key in gauges:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for labels, metrics in tunnels:
+            if metrics[key] is not None:
+                lines.append(f"{name}{_labels(labels)} {metrics[key]}")
+
+    for name, help_text, key in (
+            ("guacamole_tunnel_frame_size_bytes", "发往客户端的帧大小", "frame_size"),
+            ("guacamole_tunnel_sync_rtt_seconds", "sync往返延迟(发出到客户端渲染完成)", "sync_rtt"),
+    ):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        for labels, metrics in tunnels:
+            lines.extend(_histogram_lines(name, labels, metrics[key]))
+
+    lines.append("# HELP guacamole_guacd_up guacd后端是否健康(各进程各自探测)")
+    lines.append("# TYPE guacamole_guacd_up gauge")
+    for node in nodes:
+        for backend in node["backends"]:
+            labels = {"node": node["node"], "guacd": backend["address"]}
+            lines.append(f"guacamole_guacd_up{_labels(labels)} {int(backend['healthy'])}")
+    lines.append("# HELP guacamole_guacd_tunnels guacd后端上各进程的隧道数")
+    lines.append("# TYPE guacamole_guacd_tunnels gauge")
+    for node in nodes:
+        for backend in node["backends"]:
+            labels = {"node": node["node"], "guacd": backend["address"]}
+            lines.append(f"guacamole_guacd_tunnels{_labels(labels)} {backend['connections']}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,283 @@
+import re
+import time
+from typing import List, Optional, Tuple
+
+# 非ASCII字节，用于判断元素值是否需要按Unicode字符计算长度
+_NON_ASCII = re.compile(rb"[\x80-\xff]")
+
+# 长度前缀的最大位数，超过即视为协议错误
+_MAX_LENGTH_DIGITS = 10
+
+
+class GuacamoleProtocolError(Exception):
+    """Guacamole指令流格式错误"""
+    pass
+
+
+class GuacamoleFrame:
+    """
+    由若干条完整指令拼接成的发送帧
+
+    Attributes:
+        data: 帧的原始字节
+        instructions: 帧内每条指令的 (opcode, 起始偏移, 结束偏移)
+        created_at: 帧内第一条指令被解析出来的时间(monotonic)
+    """
+    __slots__ = ("data", "instructions", "created_at")
+
+    def __init__(self, data: bytes, instructions: List[Tuple[bytes, int, int]], created_at: float):
+        self.data = data
+        self.instructions = instructions
+        self.created_at = created_at
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    @property
+    def opcodes(self) -> List[bytes]:
+        return [opcode for opcode, _, _ in self.instructions]
+
+    def text(self) -> str:
+        """WebSocket文本帧内容"""
+        return self.data.decode("utf-8")
+
+    def arguments(self, index: int, count: int) -> List[bytes]:
+        """读取第index条指令opcode之后的前count个参数"""
+        _, start, _ = self.instructions[index]
+        return read_arguments(self.data, start, count)
+
+    def filter(self, keep: List[bool]) -> Optional["GuacamoleFrame"]:
+        """
+        按keep保留帧内的指令，返回新帧
+        全部被过滤时返回None
+        """
+        parts = []
+        instructions = []
+        offset = 0
+        for (opcode, start, end), kept in zip(self.instructions, keep):
+            if not kept:
+                continue
+            parts.append(self.data[start:end])
+            instructions.append((opcode, offset, offset + end - start))
+            offset += end - start
+        if not instructions:
+            return None
+        return GuacamoleFrame(b"".join(parts), instructions, self.created_at)
+
+    @classmethod
+    def from_instructions(cls, instructions: List[Tuple[bytes, bytes]], created_at: float) -> "GuacamoleFrame":
+        """由 (opcode, 指令原始字节) 列表构造帧"""
+        spans = []
+        offset = 0
+        for opcode, data in instructions:
+            spans.append((opcode, offset, offset + len(data)))
+            offset += len(data)
+        return cls(b"".join(data for _, data in instructions), spans, created_at)
+
+    @classmethod
+    def merge(cls, frames: List["GuacamoleFrame"]) -> "GuacamoleFrame":
+        """把多个帧按顺序合并为一个帧"""
+        if len(frames) == 1:
+            return frames[0]
+        instructions = []
+        offset = 0
+        for frame in frames:
+            instructions.extend((opcode, start + offset, end + offset) for opcode, start, end in frame.instructions)
+            offset += len(frame.data)
+        return cls(b"".join(frame.data for frame in frames), instructions, frames[0].created_at)
+
+
+def read_arguments(data: bytes, start: int, count: int) -> List[bytes]:
+    """
+    从start处的指令中读取opcode之后的前count个参数
+    仅用于图层、流编号、坐标等短的ASCII参数，不会扫描后续的大参数
+    """
+    values = []
+    position = start
+    for index in range(count + 1):
+        dot = data.index(b".", position)
+        value_end = dot + 1 + int(data[position:dot])
+        if index:
+            values.append(data[dot + 1:value_end])
+        if data[value_end] == 0x3B:  # ';'
+            break
+        position = value_end + 1
+    return values
+
+
+class InstructionParser:
+    """
+    增量式Guacamole指令解析器
+
+    在bytearray上按 LENGTH.VALUE,...; 的格式定位完整指令的边界，
+    元素值只做偏移跳转，不构造中间字符串。数据分片到达时保留解析进度，
+    不会重复扫描已解析的元素。
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        # 已解析出的完整指令: (opcode, start, end)，偏移相对于buffer起点
+        self.instructions: List[Tuple[bytes, int, int]] = []
+        # 第一条未取走的完整指令的解析时间
+        self.first_parsed_at: Optional[float] = None
+        # 当前未完成指令的起点、下一个待解析元素的起点及其opcode
+        self._instruction_start = 0
+        self._cursor = 0
+        self._opcode: Optional[bytes] = None
+
+    def feed(self, data: bytes):
+        self.buffer += data
+
+    @property
+    def complete_bytes(self) -> int:
+        """已解析出的完整指令占用的字节数"""
+        return self.instructions[-1][2] if self.instructions else 0
+
+    def _value_end(self, start: int, length: int) -> int:
+        """
+        计算长度为length个Unicode字符的元素值的结束偏移
+        数据不足时返回-1
+        """
+        buffer = self.buffer
+        end = start + length
+        if end > len(buffer):
+            return -1
+        if not _NON_ASCII.search(buffer, start, end):
+            return end
+
+        # 含多字节字符，逐字符按UTF-8首字节确定宽度
+        position = start
+        for _ in range(length):
+            if position >= len(buffer):
+                return -1
+            lead = buffer[position]
+            if lead < 0x80:
+                position += 1
+            elif lead >= 0xF0:
+                position += 4
+            elif lead >= 0xE0:
+                position += 3
+            else:
+                position += 2
+        return position if position <= len(buffer) else -1
+
+    def parse(self) -> int:
+        """
+        解析缓冲区中新到达的数据
+
+        Returns:
+            int: 本次新解析出的完整指令数量
+        """
+        buffer = self.buffer
+        parsed = 0
+        while True:
+            cursor = self._cursor
+            dot = buffer.find(b".", cursor, cursor + _MAX_LENGTH_DIGITS + 1)
+            if dot < 0:
+                if len(buffer) - cursor > _MAX_LENGTH_DIGITS:
+                    raise GuacamoleProtocolError("元素长度前缀非法")
+                return parsed
+
+            try:
+                length = int(buffer[cursor:dot])
+            except ValueError:
+                raise GuacamoleProtocolError(f"元素长度前缀非法: {bytes(buffer[cursor:dot])!r}")
+
+            value_end = self._value_end(dot + 1, length)
+            # 还需要读到元素后的分隔符
+            if value_end < 0 or value_end >= len(buffer):
+                return parsed
+
+            if self._opcode is None:
+                self._opcode = bytes(buffer[dot + 1:value_end])
+
+            terminator = buffer[value_end]
+            self._cursor = value_end + 1
+            if terminator == 0x2C:  # ','
+                continue
+            if terminator != 0x3B:  # ';'
+                raise GuacamoleProtocolError(f"非法的指令分隔符: {chr(terminator)!r}")
+
+            if not self.instructions:
+                self.first_parsed_at = time.monotonic()
+            self.instructions.append((self._opcode, self._instruction_start, self._cursor))
+            self._instruction_start = self._cursor
+            self._opcode = None
+            parsed += 1
+
+    def take(self, count: int = None) -> Optional[GuacamoleFrame]:
+        """
+        取走前count条完整指令(默认全部)，组成一个帧
+
+        Returns:
+            Optional[GuacamoleFrame]: 没有完整指令时返回None
+        """
+        if not self.instructions:
+            return None
+        if count is None or count > len(self.instructions):
+            count = len(self.instructions)
+
+        taken = self.instructions[:count]
+        end = taken[-1][2]
+        frame = GuacamoleFrame(bytes(self.buffer[:end]), taken, self.first_parsed_at)
+
+        del self.buffer[:end]
+        self.instructions = [
+            (opcode, start - end, stop - end) for opcode, start, stop in self.instructions[count:]
+        ]
+        # 剩余指令沿用原有等待起点，避免被额外延迟
+        if not self.instructions:
+            self.first_parsed_at = None
+        self._instruction_start -= end
+        self._cursor -= end
+        return frame
+
+
+class FrameCoalescer:
+    """
+    按大小和时间上限把完整指令合并成WebSocket帧
+
+    遇到sync(guacd的一帧画面结束)立即发送；否则在累计字节数达到max_bytes
+    或第一条待发送指令等待超过max_delay秒时发送。
+    """
+
+    def __init__(self, parser: InstructionParser, max_bytes: int = 65536, max_delay: float = 0.005):
+        self.parser = parser
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+
+    def ready_count(self) -> int:
+        """
+        返回当前应立即发送的指令数量，0表示继续等待
+        """
+        instructions = self.parser.instructions
+        if not instructions:
+            return 0
+
+        # 超过大小上限时在上限内的最后一个指令边界切分，单条超限指令独立成帧
+        if instructions[-1][2] >= self.max_bytes:
+            for index, (_, _, end) in enumerate(instructions):
+                if end > self.max_bytes:
+                    return max(index, 1)
+            return len(instructions)
+
+        for index in range(len(instructions) - 1, -1, -1):
+            if instructions[index][0] == b"sync":
+                return index + 1
+
+        if self.timeout() <= 0:
+            return len(instructions)
+        return 0
+
+    def timeout(self) -> Optional[float]:
+        """距离必须发送的剩余秒数，没有待发送指令时返回None"""
+        if self.parser.first_parsed_at is None:
+            return None
+        return self.parser.first_parsed_at + self.max_delay - time.monotonic()
+
+    def next_frame(self, flush: bool = False) -> Optional[GuacamoleFrame]:
+        """取出一个可发送的帧，flush为True时取走全部完整指令"""
+        count = len(self.parser.instructions) if flush else self.ready_count()
+        if not count:
+            return None
+        return self.parser.take(count)
@@ -0,0 +1,204 @@
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from app.services.guacamole_protocol import GuacamoleFrame
+
+# 画质档位，从高到低排列
+# color_depth 为RDP连接参数，只在新建隧道时生效；image 为客户端支持的图片格式，
+# 在新建或加入(接管)guacd连接时随握手发送，guacd只在所有用户都支持WebP时使用WebP，
+# 不声明PNG时尽量以有损格式编码；frame_delay 为帧合并等待毫秒数，frame_interval 为
+# 相邻两帧(sync)之间的最小毫秒数，两者在本进程内即时生效: 推迟读取guacd使sync回复变慢，
+# guacd据此降低出帧频率并合并更新，不需要重新连接
+QUALITY_PROFILES: List[Dict[str, Any]] = [
+    {
+        "name": "high",
+        "color_depth": 24,
+        "image": ["image/png", "image/jpeg", "image/webp"],
+        "frame_delay": 5,
+        "frame_interval": 0,
+    },
+    {
+        "name": "medium",
+        "color_depth": 16,
+        "image": ["image/png", "image/jpeg", "image/webp"],
+        "frame_delay": 5,
+        "frame_interval": 40,
+    },
+    {
+        "name": "low",
+        "color_depth": 16,
+        "image": ["image/jpeg", "image/webp"],
+        "frame_delay": 20,
+        "frame_interval": 100,
+    },
+    {
+        "name": "minimal",
+        "color_depth": 8,
+        "image": ["image/jpeg", "image/webp"],
+        "frame_delay": 40,
+        "frame_interval": 200,
+    },
+]
+
+HANDSHAKE_KEYS = ("color_depth", "image")
+
+# 客户端回复的sync指令
+_CLIENT_SYNC = re.compile(r"4\.sync,\d+\.(\d+)")
+
+
+def profile_index(name: str) -> int:
+    """按名称查找画质档位，未知名称返回默认的medium"""
+    for index, profile in enumerate(QUALITY_PROFILES):
+        if profile["name"] == name:
+            return index
+    return 1
+
+
+def handshake_params(index: int) -> Dict[str, Any]:
+    """画质档位对应的guacd握手参数"""
+    return {key: QUALITY_PROFILES[index][key] for key in HANDSHAKE_KEYS}
+
+
+class QualityController:
+    """
+    会话画质控制器
+
+    统计发往客户端的字节速率、指令速率，以及客户端回复sync的延迟(从帧发出到客户端
+    渲染完毕)。延迟持续偏高或发送队列出现拥塞时降低一档，长时间顺畅后再升高一档，
+    使同一出口带宽上的大量会话逐步降级而不是一起卡死。
+    """
+
+    def __init__(
+            self, level: int = 1, lag_high: float = 0.5, lag_low: float = 0.15,
+            upgrade_after: int = 15, alpha: float = 0.3
+    ):
+        self.level = level
+        self.lag_high = lag_high
+        self.lag_low = lag_low
+        # 连续多少个顺畅的采样周期后升档
+        self.upgrade_after = upgrade_after
+        self.alpha = alpha
+
+        # 已发出、等待客户端回复的sync: 时间戳 -> 发送时刻
+        self.pending_syncs: "OrderedDict[bytes, float]" = OrderedDict()
+        self.lag: Optional[float] = None
+        self.last_lag: Optional[float] = None
+
+        self.total_bytes = 0
+        self.total_instructions = 0
+        self.bytes_per_second = 0.0
+        self.instructions_per_second = 0.0
+        self.level_changes = 0
+        self._window_bytes = 0
+        self._window_instructions = 0
+        self._window_started = time.monotonic()
+        self._congestion_events = 0
+        self._smooth_samples = 0
+
+    @property
+    def profile(self) -> Dict[str, Any]:
+        return QUALITY_PROFILES[self.level]
+
+    def on_frame_sent(self, frame: GuacamoleFrame):
+        """记录一个已发送给客户端的帧"""
+        self._window_bytes += len(frame)
+        self._window_instructions += len(frame.instructions)
+        now = time.monotonic()
+        for index, opcode in enumerate(frame.opcodes):
+            if opcode == b"sync":
+                self.pending_syncs[frame.arguments(index, 1)[0]] = now
+        # 客户端长时间不回复时避免无限增长
+        while len(self.pending_syncs) > 256:
+            self.pending_syncs.popitem(last=False)
+
+    def on_client_message(self, text: str) -> List[float]:
+        """
+        从客户端发来的消息中提取sync回复，计算渲染延迟
+
+        Returns:
+            List[float]: 本条消息中测得的各个sync延迟(秒)
+        """
+        if "sync" not in text:
+            return []
+        now = time.monotonic()
+        lags = []
+        for timestamp in _CLIENT_SYNC.findall(text):
+            sent_at = self.pending_syncs.pop(timestamp.encode(), None)
+            if sent_at is None:
+                continue
+            self.last_lag = now - sent_at
+            self.lag = self.last_lag if self.lag is None else \
+                self.alpha * self.last_lag + (1 - self.alpha) * self.lag
+            lags.append(self.last_lag)
+        return lags
+
+    def sample(self, congestion_events: int = 0) -> Optional[int]:
+        """
+        结束一个采样周期并评估画质档位
+
+        Args:
+            congestion_events: 发送队列累计的拥塞次数
+
+        Returns:
+            Optional[int]: 需要切换到的档位，不需要切换时返回None
+        """
+        now = time.monotonic()
+        elapsed = max(now - self._window_started, 1e-6)
+        self.bytes_per_second = self._window_bytes / elapsed
+        self.instructions_per_second = self._window_instructions / elapsed
+        self.total_bytes += self._window_bytes
+        self.total_instructions += self._window_instructions
+        self._window_bytes = 0
+        self._window_instructions = 0
+        self._window_started = now
+
+        congested = congestion_events > self._congestion_events
+        self._congestion_events = congestion_events
+
+        # 最早一个未回复的sync已等待很久，说明客户端已跟不上，不必等回复到达
+        waiting = now - next(iter(self.pending_syncs.values())) if self.pending_syncs else 0
+        lag = max(self.lag or 0, waiting)
+
+        if congested or lag > self.lag_high:
+            self._smooth_samples = 0
+            if self.level < len(QUALITY_PROFILES) - 1:
+                return self.level + 1
+            return None
+
+        if lag < self.lag_low:
+            self._smooth_samples += 1
+            if self._smooth_samples >= self.upgrade_after and self.level > 0:
+                self._smooth_samples = 0
+                return self.level - 1
+        else:
+            self._smooth_samples = 0
+        return None
+
+    def reset(self):
+        """新的WebSocket接入时重新开始统计"""
+        self.pending_syncs.clear()
+        self.lag = None
+        self._window_bytes = 0
+        self._window_instructions = 0
+        self._window_started = time.monotonic()
+        self._congestion_events = 0
+        self._smooth_samples = 0
+
+    def set_level(self, level: int):
+        """切换档位，重置延迟统计以免旧档位的数据立即触发再次切换"""
+        self.level = level
+        self.level_changes += 1
+        self.lag = None
+        self.pending_syncs.clear()
+        self._smooth_samples = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "level": self.profile["name"],
+            "bytes_per_second": round(self.bytes_per_second),
+            "instructions_per_second": round(self.instructions_per_second, 1),
+            "sync_lag_ms": round(self.lag * 1000) if self.lag is not None else None,
+            "level_changes": self.level_changes,
+        }
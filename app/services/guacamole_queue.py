@@ -0,0 +1,318 @@
+import asyncio
+import base64
+import binascii
+import logging
+import struct
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from app.services.guacamole_protocol import GuacamoleFrame
+
+logger = logging.getLogger(__name__)
+
+# 队列超限时的处理策略
+POLICY_DROP = "drop"  # 丢弃已被后续图片完整覆盖的图片流，仍超限时退化为限速
+POLICY_THROTTLE = "throttle"  # 暂停读取guacd，由TCP背压使guacd降低帧率
+POLICY_DISCONNECT = "disconnect"  # 直接断开慢客户端
+
+BACKPRESSURE_POLICIES = (POLICY_DROP, POLICY_THROTTLE, POLICY_DISCONNECT)
+
+
+# 读取图层内容(或改变图层尺寸、销毁图层)的指令及其图层参数的位置，
+# 两次img之间出现这些指令时较早的img不能丢弃
+_LAYER_BARRIERS = {
+    b"copy": (0, 6),
+    b"transfer": (0, 6),
+    b"cursor": (2,),
+    b"lfill": (2,),
+    b"lstroke": (5,),
+    b"size": (0,),
+    b"dispose": (0,),
+}
+
+# 不透明覆盖的合成方式: SRC(0xC)直接替换；OVER(0xE)仅在图片本身不透明(JPEG)时等价于替换
+_MASK_SRC = b"12"
+_MASK_OVER = b"14"
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def image_size(mimetype: bytes, data: bytes) -> Optional[Tuple[int, int]]:
+    """
+    从图片开头的字节中读取宽高，仅支持PNG和JPEG，无法确定时返回None
+    """
+    if mimetype == b"image/png":
+        if data[:8] == _PNG_SIGNATURE and len(data) >= 24:
+            return struct.unpack(">II", data[16:24])
+        return None
+
+    if mimetype == b"image/jpeg" and data[:2] == b"\xff\xd8":
+        position = 2
+        while position + 9 <= len(data):
+            if data[position] != 0xFF:
+                return None
+            marker = data[position + 1]
+            if marker == 0xFF:
+                position += 1
+                continue
+            if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+                position += 2
+                continue
+            # SOFn(除DHT/JPG/DAC外)中记录了图片的高和宽
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height, width = struct.unpack(">HH", data[position + 5:position + 9])
+                return width, height
+            position += 2 + int.from_bytes(data[position + 2:position + 4], "big")
+    return None
+
+
+class _ImageStream:
+    """队列中的一个img流"""
+    __slots__ = ("layer", "x", "y", "opaque", "mimetype", "size", "positions", "complete")
+
+    def __init__(self, layer: bytes, x: int, y: int, mask: bytes, mimetype: bytes, position: int):
+        self.layer = layer
+        self.x = x
+        self.y = y
+        self.opaque = mask == _MASK_SRC or (mask == _MASK_OVER and mimetype == b"image/jpeg")
+        self.mimetype = mimetype
+        self.size: Optional[Tuple[int, int]] = None
+        # 流内指令(img/blob/end)在队列中的序号
+        self.positions = [position]
+        self.complete = False
+
+    def covers(self, other: "_ImageStream") -> bool:
+        """本图片是否不透明地完整覆盖other的区域"""
+        if not (self.opaque and self.size and other.size):
+            return False
+        width, height = self.size
+        other_width, other_height = other.size
+        return (self.x <= other.x and self.y <= other.y
+                and other.x + other_width <= self.x + width
+                and other.y + other_height <= self.y + height)
+
+
+def drop_stale_images(frames: List[GuacamoleFrame]) -> Tuple[List[GuacamoleFrame], int, int]:
+    """
+    丢弃队列中已被后续图片完整覆盖的img流
+
+    只有同时满足以下条件时才丢弃较早的img流(img及其blob/end)，否则保留:
+    - 两个流都已完整在队列中，且都能从图片头部读出宽高(PNG/JPEG)；
+    - 较晚的图片位于同一图层，区域完整包含较早的图片，且以不透明方式绘制；
+    - 两者之间没有读取该图层(copy/transfer/cursor等)或改变其尺寸的指令。
+    其他指令(含sync)全部保留。
+
+    Returns:
+        (过滤后的帧列表, 丢弃的指令数, 丢弃的字节数)
+    """
+    images = []
+    open_streams: Dict[bytes, _ImageStream] = {}
+    # 每个图层上读取/重置指令的序号
+    barriers: Dict[bytes, List[int]] = {}
+    position = 0
+    for frame in frames:
+        for index, opcode in enumerate(frame.opcodes):
+            if opcode == b"img":
+                stream, mask, layer, mimetype, x, y = frame.arguments(index, 6)
+                try:
+                    image = _ImageStream(layer, int(x), int(y), mask, mimetype, position)
+                except ValueError:
+                    image = None
+                if image is not None:
+                    images.append(image)
+                    open_streams[stream] = image
+                else:
+                    open_streams.pop(stream, None)
+            elif opcode in (b"blob", b"end"):
+                stream = frame.arguments(index, 1)[0]
+                image = open_streams.get(stream)
+                if image is not None:
+                    image.positions.append(position)
+                    if opcode == b"end":
+                        image.complete = True
+                        del open_streams[stream]
+                    elif len(image.positions) == 2:
+                        # 第一个blob包含图片头部
+                        try:
+                            data = base64.b64decode(frame.arguments(index, 2)[1])
+                        except (binascii.Error, ValueError):
+                            data = b""
+                        image.size = image_size(image.mimetype, data)
+            elif opcode in _LAYER_BARRIERS:
+                arguments = frame.arguments(index, max(_LAYER_BARRIERS[opcode]) + 1)
+                for argument in _LAYER_BARRIERS[opcode]:
+                    if argument < len(arguments):
+                        barriers.setdefault(arguments[argument], []).append(position)
+            position += 1
+
+    # 较早的图片从img起、较晚的图片到end止之间没有屏障指令时才能丢弃
+    dropped_positions = set()
+    for earlier_index, earlier in enumerate(images):
+        if not (earlier.complete and earlier.size):
+            continue
+        layer_barriers = barriers.get(earlier.layer, ())
+        for later in images[earlier_index + 1:]:
+            if later.layer != earlier.layer:
+                continue
+            if not later.complete:
+                continue
+            if any(earlier.positions[0] < barrier < later.positions[-1] for barrier in layer_barriers):
+                break
+            if later.covers(earlier):
+                dropped_positions.update(earlier.positions)
+                break
+
+    if not dropped_positions:
+        return frames, 0, 0
+
+    result = []
+    dropped_instructions = 0
+    dropped_bytes = 0
+    position = 0
+    for frame in frames:
+        keep = []
+        for _, start, end in frame.instructions:
+            kept = position not in dropped_positions
+            if not kept:
+                dropped_instructions += 1
+                dropped_bytes += end - start
+            keep.append(kept)
+            position += 1
+
+        if all(keep):
+            result.append(frame)
+        else:
+            filtered = frame.filter(keep)
+            if filtered:
+                result.append(filtered)
+    return result, dropped_instructions, dropped_bytes
+
+
+class FrameQueue:
+    """
+    guacd读取与WebSocket发送之间的有界帧队列
+
+    队列按字节数和帧数限定上限，超限时按policy处理，
+    并记录深度、丢弃量、限速时长等指标供监控使用。
+    """
+
+    def __init__(self, max_bytes: int, max_frames: int, policy: str = POLICY_DROP):
+        if policy not in BACKPRESSURE_POLICIES:
+            raise ValueError(f"未知的背压策略: {policy}")
+        self.max_bytes = max_bytes
+        self.max_frames = max_frames
+        self.policy = policy
+        self.frames: Deque[GuacamoleFrame] = deque()
+        self.bytes = 0
+        self.closed = False
+        # 是否因disconnect策略超限而关闭
+        self.overflowed = False
+        self._readable = asyncio.Event()
+        self._writable = asyncio.Event()
+
+        # 监控指标
+        self.peak_frames = 0
+        self.peak_bytes = 0
+        self.enqueued_frames = 0
+        self.enqueued_bytes = 0
+        self.dropped_instructions = 0
+        self.dropped_bytes = 0
+        self.congestion_events = 0
+        self.throttled_seconds = 0.0
+
+    def _over_limit(self) -> bool:
+        return self.bytes > self.max_bytes or len(self.frames) > self.max_frames
+
+    async def put(self, frame: GuacamoleFrame) -> bool:
+        """
+        放入一帧，队列超限时按策略处理
+
+        Returns:
+            bool: False表示队列已关闭或按disconnect策略需要断开连接
+        """
+        if self.closed:
+            return False
+
+        self.frames.append(frame)
+        self.bytes += len(frame)
+        self.enqueued_frames += 1
+        self.enqueued_bytes += len(frame)
+        self.peak_frames = max(self.peak_frames, len(self.frames))
+        self.peak_bytes = max(self.peak_bytes, self.bytes)
+        self._readable.set()
+
+        if not self._over_limit():
+            return True
+
+        self.congestion_events += 1
+        if self.policy == POLICY_DISCONNECT:
+            logger.warning(f"发送队列超限({len(self.frames)}帧/{self.bytes}字节)，断开慢客户端")
+            self.overflowed = True
+            self.close()
+            return False
+
+        if self.policy == POLICY_DROP:
+            frames, dropped_instructions, dropped_bytes = drop_stale_images(list(self.frames))
+            self.frames = deque(frames)
+            self.bytes -= dropped_bytes
+            self.dropped_instructions += dropped_instructions
+            self.dropped_bytes += dropped_bytes
+            if not self._over_limit():
+                return True
+
+        # 仍然超限时暂停读取，直到发送端消费到上限的一半以下，避免频繁抖动
+        started = time.monotonic()
+        while (self.bytes > self.max_bytes // 2 or len(self.frames) > self.max_frames // 2) \
+                and not self.closed:
+            self._writable.clear()
+            await self._writable.wait()
+        self.throttled_seconds += time.monotonic() - started
+        return not self.closed
+
+    async def get(self, max_bytes: int = None) -> Optional[GuacamoleFrame]:
+        """
+        取出队首帧；发送端落后时把积压的多帧合并为一帧(不超过max_bytes)
+
+        Returns:
+            Optional[GuacamoleFrame]: 队列关闭且为空时返回None
+        """
+        while not self.frames:
+            if self.closed:
+                return None
+            self._readable.clear()
+            await self._readable.wait()
+
+        frames = [self.frames.popleft()]
+        size = len(frames[0])
+        while self.frames and max_bytes and size + len(self.frames[0]) <= max_bytes:
+            frame = self.frames.popleft()
+            frames.append(frame)
+            size += len(frame)
+
+        self.bytes -= size
+        self._writable.set()
+        return GuacamoleFrame.merge(frames)
+
+    def close(self):
+        """关闭队列，唤醒等待中的读写方"""
+        self.closed = True
+        self._readable.set()
+        self._writable.set()
+
+    def stats(self) -> Dict[str, Any]:
+        """队列监控指标"""
+        return {
+            "policy": self.policy,
+            "overflowed": self.overflowed,
+            "depth_frames": len(self.frames),
+            "depth_bytes": self.bytes,
+            "peak_frames": self.peak_frames,
+            "peak_bytes": self.peak_bytes,
+            "enqueued_frames": self.enqueued_frames,
+            "enqueued_bytes": self.enqueued_bytes,
+            "dropped_instructions": self.dropped_instructions,
+            "dropped_bytes": self.dropped_bytes,
+            "congestion_events": self.congestion_events,
+            "throttled_seconds": round(self.throttled_seconds, 3),
+        }
@@ -0,0 +1,316 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from app.core.config import settings
+from app.core.redis_client import redis_client
+
+logger = logging.getLogger(__name__)
+
+TUNNEL_KEY = "guac:tunnel:{}"  # 隧道信息 (hash)
+NODE_KEY = "guac:node:{}"  # 节点上的隧道ID集合 (set)
+TASK_KEY = "guac:task:{}"  # 学生任务当前的隧道ID (string)
+CLOSE_CHANNEL = "guac:tunnel:close"  # 跨节点关闭隧道的广播频道
+PREWARM_CHANNEL = "guac:tunnel:prewarm"  # 实例就绪后预先建立隧道的广播频道
+PREWARM_CLAIM_KEY = "guac:prewarm:{}"  # 预热认领标记，保证只有一个节点执行 (string)
+METRICS_KEY = "guac:metrics:{}"  # 节点的隧道指标快照 (string, JSON)
+
+
+class TunnelRegistry:
+    """
+    Guacamole隧道注册表
+
+    每个网关进程把自己持有的隧道登记到Redis(带TTL，由心跳续期)，
+    任何节点都可以查询全部隧道，并通过Redis广播要求持有者关闭隧道。
+    redis-py是同步客户端，事件循环中的读写都交给单线程执行器，既不阻塞事件循环，
+    又保证同一进程内的登记、更新、注销按调用顺序写入。
+    """
+
+    def __init__(self):
+        self.node_id: Optional[str] = None
+        self.ttl = settings.GUACAMOLE_REGISTRY_TTL
+        self.local: Dict[str, Dict[str, Any]] = {}  # 本进程持有的隧道
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._close_callback: Optional[Callable[[str], Awaitable[Any]]] = None
+        self._prewarm_callback: Optional[Callable[[int], Awaitable[Any]]] = None
+        self._pubsub_thread = None
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="guac-registry")
+
+    def _submit(self, fn: Callable, *args):
+        """执行Redis写操作: 在事件循环中交给注册表线程异步执行，否则直接执行"""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            fn(*args)
+            return
+        self._executor.submit(fn, *args)
+
+    async def _call(self, fn: Callable, *args):
+        """在注册表线程中执行Redis读操作并等待结果，排在此前提交的写操作之后"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def start(
+            self, close_callback: Callable[[str], Awaitable[Any]],
+            prewarm_callback: Optional[Callable[[int], Awaitable[Any]]] = None
+    ):
+        """
+        在事件循环中启动关闭/预热广播订阅与心跳，可重复调用
+
+        Args:
+            close_callback: 关闭本地隧道的协程函数，参数为连接ID
+            prewarm_callback: 预先建立隧道的协程函数，参数为学生任务ID
+        """
+        if self._loop is not None:
+            return
+        # 在worker进程内确定节点ID，兼容gunicorn先加载后fork的情况
+        self.node_id = settings.GUACAMOLE_GATEWAY_NODE_ID or f"{socket.gethostname()}:{os.getpid()}"
+        self._loop = asyncio.get_running_loop()
+        self._close_callback = close_callback
+        self._prewarm_callback = prewarm_callback
+        self._heartbeat_task = self._loop.create_task(self._heartbeat())
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            channels = {CLOSE_CHANNEL: self._on_close_message}
+            if prewarm_callback is not None:
+                channels[PREWARM_CHANNEL] = self._on_prewarm_message
+            pubsub.subscribe(**channels)
+            self._pubsub_thread = pubsub.run_in_thread(sleep_time=1, daemon=True)
+        except Exception as e:
+            logger.warning(f"订阅隧道关闭广播失败: {e}")
+        logger.info(f"隧道注册表已启动，节点: {self.node_id}")
+
+    def stop(self):
+        if self._heartbeat_task:
+            self._heartbeat_task.cancel()
+        if self._pubsub_thread:
+            self._pubsub_thread.stop()
+        # 等待已提交的注销写入完成
+        self._executor.shutdown(wait=True)
+
+    def _on_close_message(self, message: Dict[str, Any]):
+        """在订阅线程中收到关闭广播，转交事件循环处理"""
+        try:
+            connection_id = json.loads(message["data"]).get("connection_id")
+        except (TypeError, ValueError):
+            return
+        if connection_id in self.local:
+            self._loop.call_soon_threadsafe(self._schedule_close, connection_id)
+
+    def _schedule_close(self, connection_id: str):
+        self._loop.create_task(self._close_callback(connection_id))
+
+    def _on_prewarm_message(self, message: Dict[str, Any]):
+        """在订阅线程中收到预热广播，认领成功的节点转交事件循环处理"""
+        try:
+            student_task_id = int(json.loads(message["data"]).get("student_task_id"))
+        except (TypeError, ValueError):
+            return
+        try:
+            claimed = redis_client.set(
+                PREWARM_CLAIM_KEY.format(student_task_id), self.node_id,
+                nx=True, ex=settings.GUACAMOLE_PREWARM_TTL
+            )
+        except Exception as e:
+            logger.warning(f"认领预热任务失败: {student_task_id}, {e}")
+            return
+        if claimed:
+            self._loop.call_soon_threadsafe(self._schedule_prewarm, student_task_id)
+
+    def _schedule_prewarm(self, student_task_id: int):
+        self._loop.create_task(self._prewarm_callback(student_task_id))
+
+    async def _heartbeat(self):
+        """定期为本地隧道续期，节点异常退出后其登记会随TTL过期"""
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            if not self.local:
+                continue
+            await self._call(self._renew, list(self.local.values()))
+
+    def _renew(self, records: List[Dict[str, Any]]):
+        try:
+            pipe = redis_client.pipeline()
+            for record in records:
+                pipe.expire(TUNNEL_KEY.format(record["connection_id"]), self.ttl)
+                if record.get("student_task_id"):
+                    pipe.expire(TASK_KEY.format(record["student_task_id"]), self.ttl)
+            pipe.expire(NODE_KEY.format(self.node_id), self.ttl)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"隧道注册表心跳失败: {e}")
+
+    def register(self, connection_id: str, student_task_id: int = None, **info):
+        """登记本地隧道"""
+        record = {
+            "connection_id": connection_id,
+            "node": self.node_id,
+            "student_task_id": student_task_id or "",
+            "created_at": int(time.time()),
+        }
+        record.update({key: "" if value is None else value for key, value in info.items()})
+        self.local[connection_id] = record
+        self._submit(self._write_record, dict(record))
+
+    def _write_record(self, record: Dict[str, Any]):
+        connection_id = record["connection_id"]
+        student_task_id = record["student_task_id"]
+        try:
+            pipe = redis_client.pipeline()
+            pipe.hset(TUNNEL_KEY.format(connection_id), mapping=record)
+            pipe.expire(TUNNEL_KEY.format(connection_id), self.ttl)
+            pipe.sadd(NODE_KEY.format(self.node_id), connection_id)
+            pipe.expire(NODE_KEY.format(self.node_id), self.ttl)
+            if student_task_id:
+                pipe.set(TASK_KEY.format(student_task_id), connection_id, ex=self.ttl)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"登记隧道失败: {connection_id}, {e}")
+
+    def update(self, connection_id: str, **info):
+        """更新本地隧道的登记信息"""
+        record = self.local.get(connection_id)
+        if record is None:
+            return
+        info = {key: "" if value is None else value for key, value in info.items()}
+        record.update(info)
+        self._submit(self._update_record, connection_id, info)
+
+    @staticmethod
+    def _update_record(connection_id: str, info: Dict[str, Any]):
+        try:
+            redis_client.hset(TUNNEL_KEY.format(connection_id), mapping=info)
+        except Exception as e:
+            logger.warning(f"更新隧道登记失败: {connection_id}, {e}")
+
+    def unregister(self, connection_id: str):
+        """注销本地隧道"""
+        record = self.local.pop(connection_id, None)
+        student_task_id = record.get("student_task_id") if record else None
+        self._submit(self._delete_record, connection_id, student_task_id)
+
+    def _delete_record(self, connection_id: str, student_task_id: Optional[int]):
+        try:
+            pipe = redis_client.pipeline()
+            pipe.delete(TUNNEL_KEY.format(connection_id))
+            pipe.srem(NODE_KEY.format(self.node_id), connection_id)
+            pipe.execute()
+            if student_task_id and redis_client.get(TASK_KEY.format(student_task_id)) == connection_id:
+                redis_client.delete(TASK_KEY.format(student_task_id))
+        except Exception as e:
+            logger.warning(f"注销隧道失败: {connection_id}, {e}")
+
+    def get_tunnel(self, connection_id: str) -> Optional[Dict[str, Any]]:
+        """查询任意节点上的隧道"""
+        if connection_id in self.local:
+            return self.local[connection_id]
+        try:
+            return redis_client.hgetall(TUNNEL_KEY.format(connection_id)) or None
+        except Exception as e:
+            logger.warning(f"查询隧道失败: {connection_id}, {e}")
+            return None
+
+    async def find_tunnel(self, connection_id: str) -> Optional[Dict[str, Any]]:
+        """在事件循环中查询任意节点上的隧道"""
+        return await self._call(self.get_tunnel, connection_id)
+
+    async def find_by_student_task(self, student_task_id: int) -> Optional[Dict[str, Any]]:
+        """查询学生任务当前的隧道"""
+        return await self._call(self._find_by_student_task, student_task_id)
+
+    def _find_by_student_task(self, student_task_id: int) -> Optional[Dict[str, Any]]:
+        try:
+            connection_id = redis_client.get(TASK_KEY.format(student_task_id))
+        except Exception as e:
+            logger.warning(f"查询学生任务隧道失败: {student_task_id}, {e}")
+            return None
+        return self.get_tunnel(connection_id) if connection_id else None
+
+    def list_tunnels(self) -> List[Dict[str, Any]]:
+        """列出所有节点上的隧道"""
+        try:
+            keys = list(redis_client.scan_iter(match=TUNNEL_KEY.format("*"), count=500))
+            pipe = redis_client.pipeline()
+            for key in keys:
+                pipe.hgetall(key)
+            return [record for record in pipe.execute() if record]
+        except Exception as e:
+            logger.warning(f"列出隧道失败: {e}")
+            return list(self.local.values())
+
+    def publish_metrics(self, snapshot: Dict[str, Any]):
+        """写入本节点的指标快照，保留三个发布周期，节点退出后自动过期"""
+        self._submit(self._write_metrics, json.dumps(snapshot))
+
+    def _write_metrics(self, data: str):
+        try:
+            redis_client.set(
+                METRICS_KEY.format(self.node_id), data, ex=settings.GUACAMOLE_METRICS_PUBLISH_INTERVAL * 3
+            )
+        except Exception as e:
+            logger.warning(f"写入隧道指标快照失败: {e}")
+
+    async def collect_metrics(self) -> List[Dict[str, Any]]:
+        """读取所有节点的指标快照，Redis不可用时返回空列表"""
+        return await self._call(self._collect_metrics)
+
+    @staticmethod
+    def _collect_metrics() -> List[Dict[str, Any]]:
+        try:
+            keys = list(redis_client.scan_iter(match=METRICS_KEY.format("*"), count=500))
+            values = redis_client.mget(keys) if keys else []
+        except Exception as e:
+            logger.warning(f"读取隧道指标快照失败: {e}")
+            return []
+        return [json.loads(value) for value in values if value]
+
+    def request_prewarm(self, student_task_id: int):
+        """
+        通知网关节点为学生任务预先建立隧道，可在Celery等非网关进程中调用
+        """
+        try:
+            redis_client.publish(PREWARM_CHANNEL, json.dumps({"student_task_id": student_task_id}))
+        except Exception as e:
+            logger.warning(f"广播预热隧道失败: {student_task_id}, {e}")
+
+    def release_prewarm(self, student_task_id: int):
+        """删除预热认领标记，预热隧道关闭或未能建立时调用"""
+        self._submit(self._delete_prewarm_claim, student_task_id)
+
+    @staticmethod
+    def _delete_prewarm_claim(student_task_id: int):
+        try:
+            redis_client.delete(PREWARM_CLAIM_KEY.format(student_task_id))
+        except Exception as e:
+            logger.warning(f"删除预热认领标记失败: {student_task_id}, {e}")
+
+    async def request_close(self, connection_id: str) -> bool:
+        """
+        关闭任意节点上的隧道，本地隧道直接关闭，其他节点通过广播通知
+
+        Returns:
+            bool: 是否找到该隧道
+        """
+        if connection_id in self.local:
+            await self._close_callback(connection_id)
+            return True
+        return await self._call(self._publish_close, connection_id)
+
+    def _publish_close(self, connection_id: str) -> bool:
+        if not self.get_tunnel(connection_id):
+            return False
+        try:
+            redis_client.publish(CLOSE_CHANNEL, json.dumps({"connection_id": connection_id}))
+            return True
+        except Exception as e:
+            logger.warning(f"广播关闭隧道失败: {connection_id}, {e}")
+            return False
+
+
+# 单例实例
+guacamole_registry = TunnelRegistry()
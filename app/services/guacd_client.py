@@ -0,0 +1,203 @@
+import asyncio
+import logging
+from typing import List, Optional
+
+from app.services.guacamole_protocol import (
+    FrameCoalescer, GuacamoleFrame, GuacamoleProtocolError, InstructionParser
+)
+
+logger = logging.getLogger(__name__)
+
+# 客户端支持的协议版本，在guacd的args指令要求版本协商时回复
+GUACAMOLE_PROTOCOL_VERSION = "VERSION_1_1_0"
+
+
+class GuacdProtocolError(GuacamoleProtocolError):
+    """guacd协议交互异常"""
+    pass
+
+
+def encode_instruction(opcode: str, *args) -> str:
+    """
+    按Guacamole协议编码指令: LENGTH.VALUE,LENGTH.VALUE,...;
+    长度按Unicode字符数计算
+    """
+    elements = [str(opcode)] + [str(arg) for arg in args]
+    return ",".join(f"{len(element)}.{element}" for element in elements) + ";"
+
+
+class GuacdClient:
+    """
+    基于asyncio的guacd协议客户端
+    连接、握手、收发全部在事件循环内完成，不占用线程池
+    """
+
+    def __init__(self, host: str, port: int, timeout: float = 10):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.guacd_id: Optional[str] = None
+        self.connected = False
+        self.parser = InstructionParser()
+        self.read_size = 65536
+
+    async def connect(self):
+        """建立到guacd的TCP连接"""
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port),
+            timeout=self.timeout
+        )
+        self.connected = True
+
+    async def handshake(
+            self, protocol: str, width: int = 1024, height: int = 768, dpi: int = 96,
+            audio: List[str] = None, video: List[str] = None, image: List[str] = None,
+            timezone: str = None, **kwargs
+    ) -> str:
+        """
+        完成guacd握手
+
+        Args:
+            protocol: 远程桌面协议 (rdp, vnc, ssh)
+            width: 屏幕宽度
+            height: 屏幕高度
+            dpi: 屏幕DPI
+            audio: 支持的音频mimetype
+            video: 支持的视频mimetype
+            image: 支持的图片mimetype
+            timezone: 客户端时区
+            **kwargs: 协议参数，参数名中的'-'以'_'表示
+
+        Returns:
+            str: guacd返回的连接ID
+        """
+        if not self.connected:
+            await self.connect()
+
+        return await asyncio.wait_for(
+            self._handshake(protocol, width, height, dpi, audio, video, image, timezone, kwargs),
+            timeout=self.timeout
+        )
+
+    async def _handshake(self, protocol, width, height, dpi, audio, video, image, timezone, params) -> str:
+        await self.send(encode_instruction("select", protocol))
+
+        instruction = await self.read_instruction()
+        if not instruction or instruction[0] != "args":
+            raise GuacdProtocolError(f"期望args指令，实际收到: {instruction}")
+
+        await self.send(encode_instruction("size", width, height, dpi))
+        await self.send(encode_instruction("audio", *(audio or [])))
+        await self.send(encode_instruction("video", *(video or [])))
+        await self.send(encode_instruction("image", *(image or [])))
+        if timezone:
+            await self.send(encode_instruction("timezone", timezone))
+
+        # 按guacd要求的参数顺序回复参数值
+        values = []
+        for arg in instruction[1:]:
+            if arg.startswith("VERSION_"):
+                values.append(GUACAMOLE_PROTOCOL_VERSION)
+            else:
+                value = params.get(arg.replace("-", "_"), "")
+                values.append("" if value is None else value)
+        await self.send(encode_instruction("connect", *values))
+
+        instruction = await self.read_instruction()
+        if not instruction or instruction[0] != "ready":
+            raise GuacdProtocolError(f"期望ready指令，实际收到: {instruction}")
+
+        self.guacd_id = instruction[1] if len(instruction) > 1 else None
+        return self.guacd_id
+
+    async def _read_chunk(self) -> bool:
+        """从guacd读取一批数据送入解析器，连接关闭时返回False"""
+        try:
+            data = await self.reader.read(self.read_size)
+        except ConnectionError:
+            data = b""
+        if not data:
+            self.connected = False
+            return False
+        self.parser.feed(data)
+        self.parser.parse()
+        return True
+
+    async def read_instruction(self) -> Optional[List[str]]:
+        """读取一条完整指令并解析为元素列表，连接关闭时返回None"""
+        raw = await self.receive()
+        if raw is None:
+            return None
+        elements = []
+        position = 0
+        while position < len(raw):
+            dot = raw.index(".", position)
+            length = int(raw[position:dot])
+            elements.append(raw[dot + 1:dot + 1 + length])
+            position = dot + 2 + length
+        return elements
+
+    async def receive(self) -> Optional[str]:
+        """
+        读取一条完整的原始指令字符串
+
+        Returns:
+            Optional[str]: 原始指令字符串，连接关闭时返回None
+        """
+        while not self.parser.instructions:
+            if not self.connected or not await self._read_chunk():
+                return None
+        return self.parser.take(1).text()
+
+    async def receive_frame(self, coalescer: FrameCoalescer) -> Optional[GuacamoleFrame]:
+        """
+        读取由多条完整指令合并而成的帧，帧的大小和等待时间由coalescer限定
+
+        Returns:
+            Optional[GuacamoleFrame]: 待发送的帧，连接关闭且无剩余数据时返回None
+        """
+        while True:
+            frame = coalescer.next_frame()
+            if frame:
+                return frame
+            if not self.connected:
+                return coalescer.next_frame(flush=True)
+
+            timeout = coalescer.timeout()
+            try:
+                if timeout is None:
+                    alive = await self._read_chunk()
+                else:
+                    alive = await asyncio.wait_for(self._read_chunk(), timeout=max(timeout, 0))
+            except asyncio.TimeoutError:
+                # 等待超时，下一轮由coalescer按时间上限出帧
+                continue
+            if not alive:
+                return coalescer.next_frame(flush=True)
+
+    async def send(self, instruction: str):
+        """发送原始指令字符串"""
+        if not self.connected:
+            raise GuacdProtocolError("连接未建立或已关闭")
+        self.writer.write(instruction.encode("utf-8"))
+        await self.writer.drain()
+
+    async def close(self):
+        """发送disconnect并关闭连接"""
+        if self.writer is None:
+            return
+        try:
+            if self.connected:
+                self.writer.write(encode_instruction("disconnect").encode("utf-8"))
+                await asyncio.wait_for(self.writer.drain(), timeout=1)
+        except Exception:
+            pass
+        finally:
+            self.connected = False
+            self.writer.close()
+            try:
+                await asyncio.wait_for(self.writer.wait_closed(), timeout=1)
+            except Exception:
+                pass
@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import time
+from typing import Any, Dict, List, Optional
+
+from app.core.config import settings
+from app.services.guacd_client import GuacdClient, encode_instruction
+
+logger = logging.getLogger(__name__)
+
+
+class GuacdBackend:
+    """一个guacd守护进程及其健康状态与连接计数"""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.healthy = True
+        # 连续失败次数(健康检查或建立隧道)
+        self.failures = 0
+        self.connections = 0
+        self.total_connections = 0
+        self.last_checked_at: Optional[float] = None
+        self.last_error: Optional[str] = None
+
+    @property
+    def address(self) -> str:
+        return f"{self.host}:{self.port}"
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "address": self.address,
+            "healthy": self.healthy,
+            "failures": self.failures,
+            "connections": self.connections,
+            "total_connections": self.total_connections,
+            "last_checked_at": self.last_checked_at,
+            "last_error": self.last_error,
+        }
+
+
+def parse_backends(addresses: List[str], default_host: str, default_port: int) -> List[GuacdBackend]:
+    """解析 host[:port] 形式的guacd地址列表，为空时使用GUACAMOLE_HOST/GUACAMOLE_PORT"""
+    backends = []
+    for address in addresses:
+        address = address.strip()
+        if not address:
+            continue
+        host, _, port = address.rpartition(":")
+        if not host or not port.isdigit():
+            host, port = address, default_port
+        backends.append(GuacdBackend(host, int(port)))
+    return backends or [GuacdBackend(default_host, default_port)]
+
+
+class GuacdPool:
+    """
+    guacd后端池
+
+    按本进程内的隧道数选择连接最少的健康guacd，定期探测各后端(完成select/args交互)，
+    连续失败达到阈值的后端不再分配新隧道，恢复后自动重新加入。
+    """
+
+    def __init__(self):
+        self.backends = parse_backends(
+            settings.GUACAMOLE_BACKENDS, settings.GUACAMOLE_HOST, settings.GUACAMOLE_PORT
+        )
+        self.max_failures = settings.GUACAMOLE_HEALTH_CHECK_FAILURES
+        self._health_task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """在事件循环中启动健康检查，可重复调用"""
+        if self._health_task is None and len(self.backends) > 1:
+            self._health_task = asyncio.get_running_loop().create_task(self._health_check())
+
+    def stop(self):
+        if self._health_task:
+            self._health_task.cancel()
+            self._health_task = None
+
+    def choose(self, exclude: List[GuacdBackend] = ()) -> Optional[GuacdBackend]:
+        """
+        选择连接数最少的健康后端
+
+        全部后端都不健康时仍返回连接最少的一个，由实际连接结果决定成败，
+        避免健康检查误判时整个平台不可用
+        """
+        candidates = [backend for backend in self.backends if backend not in exclude]
+        if not candidates:
+            return None
+        healthy = [backend for backend in candidates if backend.healthy]
+        return min(healthy or candidates, key=lambda backend: backend.connections)
+
+    def find(self, address: str) -> Optional[GuacdBackend]:
+        """按地址查找后端，用于加入其他节点登记的guacd连接"""
+        for backend in self.backends:
+            if backend.address == address:
+                return backend
+        return None
+
+    def acquire(self, backend: GuacdBackend):
+        backend.connections += 1
+        backend.total_connections += 1
+
+    def release(self, backend: GuacdBackend):
+        backend.connections = max(0, backend.connections - 1)
+
+    def mark_success(self, backend: GuacdBackend):
+        if not backend.healthy:
+            logger.info(f"guacd后端已恢复: {backend.address}")
+        backend.healthy = True
+        backend.failures = 0
+        backend.last_error = None
+
+    def mark_failure(self, backend: GuacdBackend, error: str):
+        backend.failures += 1
+        backend.last_error = error
+        if backend.healthy and backend.failures >= self.max_failures:
+            backend.healthy = False
+            logger.warning(f"guacd后端不可用，停止分配新隧道: {backend.address}, {error}")
+
+    async def probe(self, backend: GuacdBackend) -> bool:
+        """探测后端: 建立连接并完成select/args交互"""
+        client = GuacdClient(backend.host, backend.port, timeout=settings.GUACAMOLE_HEALTH_CHECK_TIMEOUT)
+        backend.last_checked_at = time.time()
+        try:
+            await client.connect()
+            await client.send(encode_instruction("select", "rdp"))
+            instruction = await asyncio.wait_for(client.read_instruction(), timeout=client.timeout)
+            if not instruction or instruction[0] != "args":
+                raise ConnectionError(f"期望args指令，实际收到: {instruction}")
+            self.mark_success(backend)
+            return True
+        except Exception as e:
+            self.mark_failure(backend, str(e) or type(e).__name__)
+            return False
+        finally:
+            await client.close()
+
+    async def _health_check(self):
+        while True:
+            await asyncio.gather(*(self.probe(backend) for backend in self.backends))
+            await asyncio.sleep(settings.GUACAMOLE_HEALTH_CHECK_INTERVAL)
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [backend.stats() for backend in self.backends]
+
+
+# 单例实例
+guacd_pool = GuacdPool()
@@ -0,0 +1,52 @@
+import asyncio
+import logging
+from typing import Iterable, Set
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Guacamole连接ECS实例使用的RDP端口，见 app/services/guacamole.py
+RDP_PORT = 3389
+
+
+async def _probe(address: str, port: int, timeout: float, semaphore: asyncio.Semaphore) -> bool:
+    async with semaphore:
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(address, port), timeout)
+        except (OSError, asyncio.TimeoutError):
+            return False
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+        return True
+
+
+async def _probe_all(addresses: Set[str], port: int, timeout: float, concurrency: int) -> Set[str]:
+    semaphore = asyncio.Semaphore(concurrency)
+    ordered = list(addresses)
+    results = await asyncio.gather(*[_probe(address, port, timeout, semaphore) for address in ordered])
+    return {address for address, ok in zip(ordered, results) if ok}
+
+
+def probe_reachable(addresses: Iterable[str], port: int = RDP_PORT) -> Set[str]:
+    """
+    并发探测哪些地址的端口已可以建立TCP连接
+
+    所有地址在一次事件循环中同时发起非阻塞连接(同时打开的连接数不超过 ECS_RDP_PROBE_CONCURRENCY)，
+    每个连接最多等待 ECS_RDP_PROBE_TIMEOUT 秒，整轮耗时约为一个超时时间，与地址数量无关。
+    连接成功即关闭，不发送任何数据。
+
+    Returns:
+        可以连接的地址
+    """
+    addresses = {address for address in addresses if address}
+    if not addresses:
+        return set()
+    reachable = asyncio.run(_probe_all(
+        addresses, port, settings.ECS_RDP_PROBE_TIMEOUT, settings.ECS_RDP_PROBE_CONCURRENCY
+    ))
+    logger.debug(f"RDP probe: {len(reachable)}/{len(addresses)} reachable")
+    return reachable
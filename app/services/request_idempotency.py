@@ -0,0 +1,62 @@
+import json
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+from app.core.config import settings
+from app.core.redis_client import redis_client
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "idempotency:"  # 幂等键 -> 第一次请求的结果(JSON)，处理中为空字符串 (string)
+
+
+class RequestIdempotency:
+    """
+    按客户端提供的幂等键(请求头 Idempotency-Key)记录请求结果
+
+    同一幂等键的重复请求(重复点击、超时重试)不再执行，直接返回第一次的结果；
+    第一次请求仍在处理时返回处理中。记录保留 IDEMPOTENCY_TTL_SECONDS 秒。
+    Redis不可用时不做幂等处理，由调用方的数据库锁兜底
+    """
+
+    @staticmethod
+    def _key(scope: str, key: str) -> str:
+        return f"{KEY_PREFIX}{scope}:{key}"
+
+    def begin(self, scope: str, key: str) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        """
+        开始处理请求
+
+        Returns:
+            (是否需要处理, 第一次请求的结果)；不需要处理且结果为None表示第一次请求还在处理中
+        """
+        try:
+            if redis_client.set(self._key(scope, key), "", nx=True, ex=settings.IDEMPOTENCY_TTL_SECONDS):
+                return True, None
+            value = redis_client.get(self._key(scope, key))
+        except Exception as e:
+            logger.warning(f"读取幂等键失败，按新请求处理: {e}")
+            return True, None
+        if value is None:
+            # 记录恰好过期
+            return True, None
+        if isinstance(value, bytes):
+            value = value.decode()
+        return False, json.loads(value) if value else None
+
+    def finish(self, scope: str, key: str, result: Dict[str, Any]):
+        try:
+            redis_client.set(self._key(scope, key), json.dumps(result), ex=settings.IDEMPOTENCY_TTL_SECONDS)
+        except Exception as e:
+            logger.warning(f"保存幂等键结果失败: {e}")
+
+    def abort(self, scope: str, key: str):
+        """请求失败，删除记录，允许使用同一幂等键重试"""
+        try:
+            redis_client.delete(self._key(scope, key))
+        except Exception as e:
+            logger.warning(f"删除幂等键失败: {e}")
+
+
+# 单例实例
+request_idempotency = RequestIdempotency()
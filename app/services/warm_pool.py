@@ -0,0 +1,118 @@
+import datetime
+import logging
+from typing import Any, Dict, List, Optional
+
+import pytz
+
+logger = logging.getLogger(__name__)
+
+# 排课时间按北京时间配置
+SCHEDULE_TIMEZONE = pytz.timezone("Asia/Shanghai")
+
+
+class PoolWindow:
+    """一个上课时段: 每周的哪几天、起止时间(北京时间)及期间的池大小"""
+
+    def __init__(self, weekdays: List[int], start: datetime.time, end: datetime.time, size: int):
+        self.weekdays = weekdays
+        self.start = start
+        self.end = end
+        self.size = size
+
+    def contains(self, local_now: datetime.datetime, lead: datetime.timedelta) -> bool:
+        """local_now是否落在本时段内(开始时间提前lead，留出开机时间)"""
+        for day_offset in (0, 1):
+            # 提前量可能跨过零点，因此同时检查次日的时段
+            day = local_now.date() + datetime.timedelta(days=day_offset)
+            if day.isoweekday() not in self.weekdays:
+                continue
+            start = datetime.datetime.combine(day, self.start) - lead
+            end = datetime.datetime.combine(day, self.end)
+            if start <= local_now.replace(tzinfo=None) < end:
+                return True
+        return False
+
+
+class WarmPoolConfig:
+    """
+    环境模板的预热池配置，来自 resource_config["warm_pool"]:
+
+        {
+            "min": 2,               # 任何时候保持的就绪实例数
+            "max": 60,              # 池(创建中+就绪)的上限
+            "idle_minutes": 30,     # 超出目标大小的就绪实例空闲多久后释放
+            "lead_minutes": 15,     # 上课前提前多久开始扩容
+            "recycle": true,        # 学生停止实验后重置系统盘放回池中复用，而不是释放(池未满时)
+            "schedule": [           # 上课时段，期间目标大小为size
+                {"weekdays": [1, 3], "start": "08:00", "end": "09:40", "size": 40}
+            ]
+        }
+    """
+
+    def __init__(
+            self, min_size: int = 0, max_size: int = 0, idle_minutes: int = 30,
+            lead_minutes: int = 15, schedule: List[PoolWindow] = None, recycle: bool = False
+    ):
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size)
+        self.idle_minutes = idle_minutes
+        self.lead_minutes = lead_minutes
+        self.schedule = schedule or []
+        self.recycle = recycle
+
+    @classmethod
+    def from_resource_config(cls, resource_config: Optional[Dict[str, Any]]) -> Optional["WarmPoolConfig"]:
+        """解析配置，未配置预热池或配置有误时返回None"""
+        pool = (resource_config or {}).get("warm_pool")
+        if not pool:
+            return None
+        try:
+            schedule = [
+                PoolWindow(
+                    weekdays=[int(day) for day in window.get("weekdays", range(1, 8))],
+                    start=datetime.datetime.strptime(window["start"], "%H:%M").time(),
+                    end=datetime.datetime.strptime(window["end"], "%H:%M").time(),
+                    size=int(window["size"])
+                )
+                for window in pool.get("schedule", [])
+            ]
+            min_size = int(pool.get("min", 0))
+            return cls(
+                min_size=min_size,
+                max_size=int(pool.get("max", max([min_size] + [window.size for window in schedule]))),
+                idle_minutes=int(pool.get("idle_minutes", 30)),
+                lead_minutes=int(pool.get("lead_minutes", 15)),
+                schedule=schedule,
+                recycle=bool(pool.get("recycle", False))
+            )
+        except (KeyError, TypeError, ValueError) as e:
+            logger.error(f"预热池配置有误: {pool}, {e}")
+            return None
+
+    def target_size(self, now: datetime.datetime = None) -> int:
+        """当前应保持的池大小: 上课时段取时段大小，否则为min，并限制在[min, max]内"""
+        now = now or datetime.datetime.utcnow()
+        local_now = pytz.utc.localize(now).astimezone(SCHEDULE_TIMEZONE)
+        lead = datetime.timedelta(minutes=self.lead_minutes)
+        size = self.min_size
+        for window in self.schedule:
+            if window.contains(local_now, lead):
+                size = max(size, window.size)
+        return min(max(size, self.min_size), self.max_size)
+
+
+def pool_refill_plan(config: Optional[WarmPoolConfig], pending: int, ready: int, now: datetime.datetime = None) -> int:
+    """
+    计算需要补充(正数)或可以释放(负数)的实例数
+
+    创建中的实例也计入池大小，避免开机期间重复补充；释放只针对就绪实例，
+    是否真正释放还取决于空闲时间
+    """
+    target = config.target_size(now) if config else 0
+    max_size = config.max_size if config else 0
+    total = pending + ready
+    if total < target:
+        return min(target, max_size) - total
+    if total > target:
+        return -min(total - target, ready)
+    return 0
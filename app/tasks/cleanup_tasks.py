@@ -6,6 +6,7 @@ from sqlalchemy import text
 
 from app.db.base import SessionLocal
 from app.models.task import StudentTask
+from app.services.ecs_teardown import teardown_queue
 from app.tasks.ecs_tasks import stop_ecs_instance_task
 from app.tasks.jupyter_tasks import stop_jupyter_container_task
 
@@ -46,6 +47,8 @@ def cleanup_expired_tasks():
                 return
 
             logger.info(f"Found {len(result)} expired tasks to clean up")
+            # ECS实例统一加入释放队列，由flush_ecs_teardown_task批量释放
+            expired_instance_ids = []
 
             # 处理每个过期任务
             for row in result:
@@ -65,9 +68,8 @@ def cleanup_expired_tasks():
                         logger.info(f"Initiated Jupyter container cleanup for task {student_task_id}")
 
                     elif task_type == "guacamole" and instance_id:
-                        # 启动ECS实例停止任务
-                        stop_ecs_instance_task.delay(instance_id)
-                        logger.info(f"Initiated ECS instance cleanup for task {student_task_id}")
+                        expired_instance_ids.append(instance_id)
+                        logger.info(f"Queued ECS instance cleanup for task {student_task_id}")
 
                     else:
                         logger.warning(
@@ -86,6 +88,15 @@ def cleanup_expired_tasks():
 
             # 提交数据库更改
             db.commit()
+
+            if expired_instance_ids:
+                try:
+                    teardown_queue.enqueue(expired_instance_ids)
+                except Exception as e:
+                    # Redis不可用时退回逐个释放
+                    logger.warning(f"ECS实例加入释放队列失败，改为逐个释放: {e}")
+                    for instance_id in expired_instance_ids:
+                        stop_ecs_instance_task.delay(instance_id)
             logger.info(f"Successfully processed {len(result)} expired tasks")
 
         except Exception as e:
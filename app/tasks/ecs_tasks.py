@@ -1,6 +1,6 @@
-import random
+import hashlib
 import uuid
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Set, Tuple
 
 import pytz
 import json
@@ -9,14 +9,25 @@ import logging
 from sqlalchemy.orm import Session
 
 from app.celery_worker import celery_app
+from app.core.config import settings
+from app.core.redis_client import redis_client
 from app.db.session import SessionLocal
-from app.models.ecs import ECSInstance
+from app.models.ecs import ECSInstance, ECSPoolInstance
 from app.models.environment import EnvironmentTemplate
 from app.services.ali_cloud import ali_cloud_service
+from app.services.ecs_batch import provision_coalescer
+from app.services.ecs_events import RELEASED_STATES, event_instance_info
+from app.services.ecs_placement import launch_candidates, placement_engine
+from app.services.ecs_poll_schedule import poll_scheduler
+from app.services.ecs_reconciler import InstanceRow, ReconcileResult, private_ip_of, reconcile, started_at
+from app.services.ecs_teardown import teardown_queue
+from app.services.rdp_probe import probe_reachable
 from app.crud.task import student_task as crud_student_task, student_task
 from app.crud.task import celery_task_log as crud_celery_log
 from app.models.task import Task, StudentTask
-from app.crud.ecs import ecs_instance
+from app.crud.ecs import ecs_instance, ecs_pool_instance
+from app.services.guacamole_registry import guacamole_registry
+from app.services.warm_pool import WarmPoolConfig
 
 logger = logging.getLogger(__name__)
 
@@ -65,13 +76,7 @@ def create_ecs_instance(student_task_id: int, task_id: int, instance_name: str)
             return {"success": False, "error": error_msg}
 
         # 计算自动释放时间
-        now = datetime.datetime.utcnow()
-        if task_obj.max_duration:
-            # 预留10分钟冗余量
-            auto_release_time = now + datetime.timedelta(minutes=task_obj.max_duration + 10)
-        else:
-            # 默认24小时后释放
-            auto_release_time = now + datetime.timedelta(hours=24)
+        auto_release_time = compute_auto_release_time(task_obj)
 
         # 更新数据库中的自动释放时间
         student_task_obj.auto_release_time = auto_release_time.astimezone(pytz.timezone('Asia/Shanghai'))
@@ -91,16 +96,8 @@ def create_ecs_instance(student_task_id: int, task_id: int, instance_name: str)
             student_task.update_status(db, student_task_id=student_task_id, status="Error")
             ecs_instance.update_status_by_instance_name(db=db, instance_name=instance_name, status="Error")
             return {"success": False, "error": error_msg}
-        # 如果提供了多组实例类型、安全组、VSwitch，则随机选择一组
-        # 必须要一一对应
         resource_config = env_template.resource_config
-        min_index = 99999
-
-        instance_types=resource_config.get("instance_type", None)
-        security_group_ids=resource_config.get("security_group_id", None)
-        vswitch_ids=resource_config.get("vswitch_id", None)
-
-        if not instance_types or not security_group_ids or not vswitch_ids:
+        if not launch_candidates(resource_config):
             error_msg = f"Environment template with id {task_obj.environment_id} resource_config error"
             crud_celery_log.update_status(
                 db=db,
@@ -112,47 +109,36 @@ def create_ecs_instance(student_task_id: int, task_id: int, instance_name: str)
             ecs_instance.update_status_by_instance_name(db=db, instance_name=instance_name, status="Error")
             return {"success": False, "error": error_msg}
 
-        if ',' in instance_types:
-            instance_types = instance_types.split(',')
-            if len(instance_types)<min_index:
-                min_index = len(instance_types)
-        if ',' in security_group_ids:
-            security_group_ids = security_group_ids.split(',')
-            if len(security_group_ids)<min_index:
-                min_index = len(security_group_ids)
-        if ',' in vswitch_ids:
-            vswitch_ids = vswitch_ids.split(',')
-            if len(vswitch_ids)<min_index:
-                min_index = len(vswitch_ids)
-
-        if min_index != 99999:
-            random_index=random.Random().randint(0,min_index-1)
-            c_instance_type=instance_types[random_index]
-            c_security_group_id=security_group_ids[random_index]
-            c_vswitch_id=vswitch_ids[random_index]
-        else:
-            c_instance_type=instance_types
-            c_security_group_id=security_group_ids
-            c_vswitch_id=vswitch_ids
-
-        # 检查密码，如果为空则随机生成
-        password = resource_config.get("password", None)
-        if not password or password.strip() == '':
-            password = f"R2p{uuid.uuid4().hex[:10]}!"
-
-
-        # 调用阿里云SDK创建ECS实例
-        result = ali_cloud_service.create_ecs_instance(
-            region_id=resource_config.get("region_id", "cn-hangzhou"),
-            image_id=env_template.image,
-            instance_type=c_instance_type,
-            security_group_id=c_security_group_id,
-            vswitch_id=c_vswitch_id,
-            internet_max_bandwidth_out=resource_config.get("internet_max_bandwidth_out",0),
-            spot_strategy=resource_config.get("spot_strategy", None),
-            password=password,
-            auto_release_time=auto_release_time,
-            custom_params=resource_config.get("custom_params",None)
+        # 同一实例名称的任务重复执行(如worker重启后重新投递)时，已创建的实例不再创建
+        ecs_record = db.query(ECSInstance).filter(ECSInstance.instance_name == instance_name).first()
+        if ecs_record and ecs_record.instance_id:
+            logger.info(f"ECS instance {instance_name} already created: {ecs_record.instance_id}")
+            crud_celery_log.update_status(
+                db=db,
+                celery_task_id=task_id,
+                status="SUCCESS",
+                result=json.dumps({"instance_id": ecs_record.instance_id, "duplicate": True})
+            )
+            return {"success": True, "instance_id": ecs_record.instance_id}
+
+        # 配置了固定密码的环境模板，创建请求合并为一次RunInstances，由provision_ecs_batch_task完成创建；
+        # 未配置时每台实例使用各自的随机密码，单独创建
+        entry = {
+            "student_task_id": student_task_id,
+            "task_id": task_id,
+            "instance_name": instance_name,
+            "auto_release_time": auto_release_time.isoformat(),
+        }
+        if settings.ECS_BATCH_WINDOW_SECONDS > 0 and _template_password(resource_config) \
+                and _enqueue_provision(env_template.id, entry):
+            return {"success": True, "queued": True}
+
+        password = _instance_password(db, resource_config, instance_name)
+
+        # 调用阿里云SDK创建ECS实例，按库存与成功率选择规格和可用区，库存不足时换下一组；
+        # ClientToken由实例名称确定，超时重试或任务重复执行不会创建第二台实例
+        result = launch_instances(
+            resource_config, env_template.image, password, auto_release_time, client_token=instance_name
         )
 
         if not result["success"]:
@@ -199,6 +185,256 @@ def create_ecs_instance(student_task_id: int, task_id: int, instance_name: str)
         db.close()
 
 
+def compute_auto_release_time(task_obj: Task) -> datetime.datetime:
+    """实例的自动释放时间(UTC)"""
+    now = datetime.datetime.utcnow()
+    if task_obj.max_duration:
+        # 预留10分钟冗余量
+        return now + datetime.timedelta(minutes=task_obj.max_duration + 10)
+    # 默认24小时后释放
+    return now + datetime.timedelta(hours=24)
+
+
+def launch_instances(
+        resource_config: Dict[str, Any], image_id: str, password: str, auto_release_time: datetime.datetime,
+        amount: int = 1, client_token: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    按环境模板的候选规格/VSwitch创建实例
+
+    client_token由要创建的实例名称确定，重复执行同一创建请求时不会重复创建实例
+
+    Returns:
+        在 placement_engine.run_instances 的结果上增加 instance_ids(全部创建的实例ID，按创建顺序)
+    """
+    result = placement_engine.run_instances(
+        region_id=resource_config.get("region_id", "cn-hangzhou"),
+        candidates=launch_candidates(resource_config),
+        amount=amount,
+        spot_strategy=resource_config.get("spot_strategy", None),
+        client_token=client_token,
+        image_id=image_id,
+        internet_max_bandwidth_out=resource_config.get("internet_max_bandwidth_out", 0),
+        password=password,
+        auto_release_time=auto_release_time,
+        custom_params=resource_config.get("custom_params", None)
+    )
+    result["instance_ids"] = [instance_id for _, instance_ids in result["launches"] for instance_id in instance_ids]
+    return result
+
+
+def _template_password(resource_config: Dict[str, Any]) -> Optional[str]:
+    """环境模板配置的固定登录密码，未配置时返回None"""
+    password = resource_config.get("password", None)
+    if not password or password.strip() == '':
+        return None
+    return password
+
+
+def generate_instance_password(resource_config: Dict[str, Any]) -> str:
+    """检查密码，如果为空则随机生成"""
+    return _template_password(resource_config) or f"R2p{uuid.uuid4().hex[:10]}!"
+
+
+def _instance_password(db: Session, resource_config: Dict[str, Any], instance_name: str) -> str:
+    """
+    创建实例使用的登录密码
+
+    使用模板配置的固定密码，未配置时随机生成；在调用RunInstances之前保存到实例记录上，
+    重复执行时沿用保存的密码，与相同ClientToken返回的实例一致
+    """
+    ecs_record = db.query(ECSInstance).filter(ECSInstance.instance_name == instance_name).first()
+    if ecs_record and ecs_record.password:
+        return ecs_record.password
+    password = generate_instance_password(resource_config)
+    if ecs_record:
+        ecs_record.password = password
+        db.commit()
+    return password
+
+
+def _enqueue_provision(environment_id: int, entry: Dict[str, Any]) -> bool:
+    """加入合并创建队列，Redis不可用时返回False由调用方直接创建"""
+    try:
+        scheduled = provision_coalescer.enqueue(environment_id, entry)
+    except Exception as e:
+        logger.warning(f"ECS创建请求合并入队失败，改为直接创建: {e}")
+        return False
+    if scheduled:
+        try:
+            provision_ecs_batch_task.apply_async(
+                args=[environment_id], countdown=settings.ECS_BATCH_WINDOW_SECONDS
+            )
+        except Exception as e:
+            # 请求已在队列中，清除标记让下一个请求重新安排合并创建任务
+            logger.error(f"安排ECS合并创建任务失败: {e}")
+            provision_coalescer.release(environment_id)
+    return True
+
+
+def _fail_provision(db: Session, entry: Dict[str, Any], error: str):
+    """合并创建失败时更新单个请求的任务日志、学生任务与实例记录"""
+    crud_celery_log.update_status(
+        db=db,
+        celery_task_id=entry["task_id"],
+        status="FAILURE",
+        result=json.dumps({"error": error})
+    )
+    student_task.update_status(db, student_task_id=entry["student_task_id"], status="Error")
+    ecs_instance.update_status_by_instance_name(db=db, instance_name=entry["instance_name"], status="Error")
+
+
+def _batch_client_token(entries: List[Dict[str, Any]]) -> str:
+    """批次的ClientToken，单台实例与直接创建时相同(实例名称)"""
+    if len(entries) == 1:
+        return entries[0]["instance_name"]
+    return "batch-" + hashlib.sha1(
+        ",".join(sorted(entry["instance_name"] for entry in entries)).encode()
+    ).hexdigest()[:32]
+
+
+def _run_instances(db: Session, env_template: EnvironmentTemplate, entries: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    创建一批实例，并把返回的实例ID依次分配给等待的记录
+
+    环境模板配置了固定登录密码时用一次RunInstances(Amount=N)创建，批内实例共用该密码；
+    未配置时每台实例单独创建，各自使用随机生成的密码。
+    之前已提交过的实例按原批次重新提交，相同的ClientToken返回已创建的实例
+    """
+    # 同一实例名称重复入队(创建任务重复执行)时只创建一次
+    entries = list({entry["instance_name"]: entry for entry in entries}.values())
+    resource_config = env_template.resource_config
+    if not launch_candidates(resource_config):
+        error_msg = f"Environment template with id {env_template.id} resource_config error"
+        for entry in entries:
+            _fail_provision(db, entry, error_msg)
+        return {"success": False, "error": error_msg}
+
+    # 已写入实例ID的记录不再创建
+    created_names = {
+        name for name, in db.query(ECSInstance.instance_name).filter(
+            ECSInstance.instance_name.in_([entry["instance_name"] for entry in entries]),
+            ECSInstance.instance_id.isnot(None),
+            ECSInstance.instance_id != "",
+        )
+    }
+    batches: Dict[str, List[Dict[str, Any]]] = {}
+    fresh = []
+    for entry in entries:
+        if entry["instance_name"] in created_names:
+            continue
+        recorded = provision_coalescer.find_batch(entry["instance_name"])
+        if recorded:
+            batches.setdefault(*recorded)
+        else:
+            fresh.append(entry)
+    groups = [fresh] if _template_password(resource_config) else [[entry] for entry in fresh]
+    for group in groups:
+        if group:
+            client_token = _batch_client_token(group)
+            provision_coalescer.record_batch(client_token, group)
+            batches[client_token] = group
+
+    results = [_launch_batch(db, env_template, group, client_token) for client_token, group in batches.items()]
+    return {
+        "success": all(result["success"] for result in results),
+        "requested": sum(result.get("requested", 0) for result in results),
+        "created": sum(result.get("created", 0) for result in results),
+    }
+
+
+def _launch_batch(
+        db: Session, env_template: EnvironmentTemplate, entries: List[Dict[str, Any]], client_token: str
+) -> Dict[str, Any]:
+    """用一次RunInstances创建一个批次，批内取最晚的自动释放时间"""
+    resource_config = env_template.resource_config
+    # 多台实例的批次只在模板配置了固定密码时形成，批内共用该密码
+    if len(entries) > 1:
+        password = generate_instance_password(resource_config)
+    else:
+        password = _instance_password(db, resource_config, entries[0]["instance_name"])
+    auto_release_time = max(datetime.datetime.fromisoformat(entry["auto_release_time"]) for entry in entries)
+    logger.info(f"Creating {len(entries)} ECS instances for environment {env_template.id} in one request")
+
+    # 一组规格/可用区库存不足时，剩余的实例换下一组创建
+    result = launch_instances(
+        resource_config, env_template.image, password, auto_release_time, amount=len(entries),
+        client_token=client_token
+    )
+    if not result["success"]:
+        for entry in entries:
+            _fail_provision(db, entry, result["error"])
+        return {"success": False, "error": result["error"]}
+
+    instance_ids = result["instance_ids"]
+    created, missing = entries[:len(instance_ids)], entries[len(instance_ids):]
+    rows = dict(db.query(ECSInstance.instance_name, ECSInstance.instance_id).filter(
+        ECSInstance.instance_name.in_([entry["instance_name"] for entry in created])
+    ).all())
+    assignments = {}
+    for entry, instance_id in zip(created, instance_ids):
+        name = entry["instance_name"]
+        if name in rows and not rows[name]:
+            assignments[name] = instance_id
+        elif rows.get(name) != instance_id:
+            # 记录已被删除(如学生在排队期间停止了实验)或已由另一次创建写入，释放多出的实例
+            logger.warning(f"No pending ECS record for {name}, releasing instance {instance_id}")
+            ali_cloud_service.delete_instance(
+                region_id=resource_config.get("region_id", "cn-hangzhou"), instance_id=instance_id, force=True
+            )
+    assigned = set(ecs_instance.assign_instance_ids(
+        db=db, assignments=assignments, status="Pending", password=password
+    ))
+    crud_student_task.update_status_many(
+        db=db,
+        student_task_ids=[entry["student_task_id"] for entry in created if entry["instance_name"] in assigned],
+        status="Starting"
+    )
+    for entry in created:
+        if entry["instance_name"] in assigned:
+            crud_celery_log.update_status(
+                db=db,
+                celery_task_id=entry["task_id"],
+                status="SUCCESS",
+                result=json.dumps({"success": True, "instance_ids": [assignments[entry["instance_name"]]]})
+            )
+    # 所有候选配置的库存都不足时只创建了部分实例
+    for entry in missing:
+        _fail_provision(db, entry, f"Only {len(instance_ids)} of {len(entries)} instances were created")
+
+    return {"success": True, "requested": len(entries), "created": len(instance_ids)}
+
+
+def provision_ecs_batch(environment_id: int) -> Dict[str, Any]:
+    """合并创建任务: 取出该环境模板等待中的全部创建请求，每批一次RunInstances"""
+    provision_coalescer.release(environment_id)
+    db = SessionLocal()
+    try:
+        env_template = db.query(EnvironmentTemplate).filter(EnvironmentTemplate.id == environment_id).first()
+        batches = []
+        while True:
+            entries = provision_coalescer.take(environment_id, settings.ECS_BATCH_MAX_AMOUNT)
+            if not entries:
+                break
+            if not env_template:
+                error_msg = f"Environment template with id {environment_id} not found"
+                for entry in entries:
+                    _fail_provision(db, entry, error_msg)
+                batches.append({"success": False, "error": error_msg})
+                continue
+            try:
+                batches.append(_run_instances(db, env_template, entries))
+            except Exception as e:
+                logger.exception("Error creating ECS instances in batch")
+                db.rollback()
+                for entry in entries:
+                    _fail_provision(db, entry, str(e))
+                batches.append({"success": False, "error": str(e)})
+        return {"success": True, "batches": batches}
+    finally:
+        db.close()
+
+
 def delete_instance(student_task_id: int,task_id: int,ecs_instance_model:ECSInstance) -> Dict[str, Any]:
     """删除ECS实例任务"""
     db = SessionLocal()
@@ -241,12 +477,16 @@ def delete_instance(student_task_id: int,task_id: int,ecs_instance_model:ECSInst
 
 
 
-        # 调用阿里云SDK删除ECS实例
-        result = ali_cloud_service.delete_instance(
-            region_id=ecs_instance_model.region_id,
-            instance_id=ecs_instance_model.instance_id,
-            force=True
-        )
+        # 环境模板开启了回收时，实例重置后放回预热池，不释放
+        if recycle_instances(db, [ecs_instance_model.instance_id]):
+            result = {"success": True, "recycled": True}
+        else:
+            # 调用阿里云SDK删除ECS实例
+            result = ali_cloud_service.delete_instance(
+                region_id=ecs_instance_model.region_id,
+                instance_id=ecs_instance_model.instance_id,
+                force=True
+            )
 
         # 无论删除成功与否，都更新任务状态
         student_task_obj.status = "Stopped"
@@ -286,85 +526,287 @@ def delete_instance(student_task_id: int,task_id: int,ecs_instance_model:ECSInst
         db.close()
 
 
-@celery_app.task(name="app.tasks.ecs_tasks.check_instance_status")
-def check_instance_status() -> Dict[str, Any]:
-    """检查实例状态任务"""
-    db = SessionLocal()
-    try:
-        # 获取所有活跃的实例
-        active_instances = ecs_instance.get_active_instances(db=db)
-        if not active_instances:
-            return {"success": True, "message": "No active instances found"}
-
-        # 按region分组处理，每次最多处理100个实例
-        region_instances = {}
-        for instance in active_instances:
-            # 还未生成instance_id，或是创建时间是在近30秒的都不检查
-            if not instance.instance_id or instance.created_at > datetime.datetime.utcnow() - datetime.timedelta(seconds=30):
-                continue
-
-
-            region_id = instance.region_id
-            if region_id not in region_instances:
-                region_instances[region_id] = []
+def recycle_instances(db: Session, instance_ids: List[str]) -> List[str]:
+    """
+    把学生已停止使用的实例放回预热池(环境模板开启了 warm_pool.recycle 且池未满时)
+
+    实例先延长自动释放时间并停机，停机完成后由预热池维护任务把系统盘重置为镜像并开机，
+    就绪后可被镜像、规格、安全组与VSwitch相同的请求领取。
+    返回已回收的实例ID，其余实例由调用方照常释放
+    """
+    if not instance_ids:
+        return []
+    # 回收过的实例每次被领取都有一条实例记录，按最新的记录(本次停止的学生任务)确定环境模板
+    latest = {}
+    for instance, environment_id in db.query(ECSInstance, Task.environment_id).join(
+        StudentTask, StudentTask.id == ECSInstance.student_task_id
+    ).join(
+        Task, Task.id == StudentTask.task_id
+    ).filter(ECSInstance.instance_id.in_(instance_ids)).order_by(ECSInstance.id.desc()):
+        latest.setdefault(instance.instance_id, (instance, environment_id))
+    rows = sorted(latest.values(), key=lambda row: row[0].id)
+    templates = {
+        template.id: template
+        for template in db.query(EnvironmentTemplate).filter(
+            EnvironmentTemplate.id.in_({environment_id for _, environment_id in rows})
+        )
+    }
+
+    auto_release_time = datetime.datetime.utcnow() + datetime.timedelta(hours=settings.ECS_POOL_INSTANCE_MAX_HOURS)
+    room: Dict[int, int] = {}
+    recycled = []
+    for instance, environment_id in rows:
+        template = templates.get(environment_id)
+        config = WarmPoolConfig.from_resource_config(template.resource_config) if template else None
+        if not config or not config.recycle:
+            continue
+        if environment_id not in room:
+            counts = ecs_pool_instance.count_by_status(db, environment_id=environment_id)
+            room[environment_id] = config.max_size - sum(counts.values())
+        if room[environment_id] <= 0:
+            continue
+
+        region_id = instance.region_id or settings.ALIYUN_REGION_ID
+        result = ali_cloud_service.modify_auto_release_time(
+            instance_id=instance.instance_id, auto_release_time=auto_release_time, region_id=region_id
+        )
+        if result["success"]:
+            result = ali_cloud_service.stop_instance(region_id=region_id, instance_id=instance.instance_id)
+        if not result["success"]:
+            logger.warning(f"回收实例 {instance.instance_id} 失败，改为释放: {result['error']}")
+            continue
+
+        # 实例记录上的规格/安全组/VSwitch可能是模板的候选列表，只复制确定的值，其余在开机后按实例信息补齐
+        placement = {
+            key: getattr(instance, key)
+            for key in ("instance_type", "security_group_id", "vswitch_id")
+            if getattr(instance, key) and "," not in getattr(instance, key)
+        }
+        db.add(ECSPoolInstance(
+            environment_id=environment_id,
+            instance_id=instance.instance_id,
+            instance_name=f"pool-{environment_id}-{str(uuid.uuid4())[:8]}",
+            image_id=template.image,
+            region_id=region_id,
+            spot_strategy=instance.spot_strategy,
+            **placement,
+            # 重置系统盘时设置新密码，下一个学生不会拿到上一个学生的密码
+            password=generate_instance_password(template.resource_config),
+            status="Stopping",
+            auto_release_time=auto_release_time
+        ))
+        room[environment_id] -= 1
+        recycled.append(instance.instance_id)
+    db.commit()
+    if recycled:
+        logger.info(f"Recycling {len(recycled)} ECS instances into warm pools")
+    return recycled
+
+
+# DeleteInstances单次最多释放的实例数
+DELETE_BATCH_SIZE = 100
+# 释放任务每次从队列取出的实例数
+TEARDOWN_TAKE_SIZE = 1000
+# 释放任务的互斥锁，上一轮调用阿里云较慢时避免并发执行
+TEARDOWN_LOCK_KEY = "ecs:teardown:lock"
+
+
+def _delete_batch(region_id: str, instance_ids: List[str]) -> List[str]:
+    """释放同一region的一批实例，返回已释放(或已不存在)的实例ID"""
+    result = ali_cloud_service.delete_instances(region_id=region_id, instance_ids=instance_ids, force=True)
+    if result["success"]:
+        return instance_ids
+    # 批内有实例已不存在等情况整批会失败，改为逐个释放
+    logger.warning(f"批量释放 {len(instance_ids)} 个实例失败，改为逐个释放: {result['error']}")
+    released = []
+    for instance_id in instance_ids:
+        single = ali_cloud_service.delete_instance(region_id=region_id, instance_id=instance_id, force=True)
+        if single["success"] or single.get("error_code") == "InvalidInstanceId.NotFound":
+            released.append(instance_id)
+        else:
+            logger.error(f"Error deleting ECS instance {instance_id}: {single['error']}")
+    return released
 
-            region_instances[region_id].append({
-                "instance_id": instance.instance_id,
-                "id": instance.id
-            })
 
-        # 处理每个区域的实例
+def flush_ecs_teardown() -> Dict[str, Any]:
+    """
+    释放队列中的实例
 
-        for region_id, instances in region_instances.items():
-            # 每组最多处理100个实例
-            for i in range(0, len(instances), 100):
-                batch = instances[i:i + 100]
-                instance_ids = [inst["instance_id"] for inst in batch]
-                logger.info(f"Checking {len(instance_ids)} instances in region {region_id}")
-                # 调用阿里云SDK检查实例状态
-                result = ali_cloud_service.describe_instance(
-                    instance_ids=instance_ids
-                )
+    开启回收的环境模板的实例放回预热池；其余按region分组，每组每次DeleteInstances最多100个。
+    每批处理后批量把实例与学生任务改为Stopped，并移出状态检查调度。
+    释放失败的实例不再重试，由阿里云按自动释放时间兜底
+    """
+    if not redis_client.set(TEARDOWN_LOCK_KEY, 1, nx=True, ex=300):
+        return {"success": True, "message": "Teardown already running"}
+    db = SessionLocal()
+    released = recycled_total = failed = 0
+    instance_ids: List[str] = []
+    done = set()
+    try:
+        while True:
+            instance_ids = teardown_queue.take(TEARDOWN_TAKE_SIZE)
+            if not instance_ids:
+                break
+            done = set()
+            # 开启回收的环境模板的实例放回预热池，其余释放
+            recycled = recycle_instances(db, instance_ids)
+            poll_scheduler.reschedule(gone=ecs_instance.mark_released(db, instance_ids=recycled))
+            done.update(recycled)
+            recycled_total += len(recycled)
+
+            regions = ecs_instance.get_regions(db, instance_ids=instance_ids)
+            region_instances: Dict[str, List[str]] = {}
+            for instance_id in instance_ids:
+                if instance_id in done:
+                    continue
+                region_id = regions.get(instance_id) or settings.ALIYUN_REGION_ID
+                region_instances.setdefault(region_id, []).append(instance_id)
+
+            for region_id, ids in region_instances.items():
+                for i in range(0, len(ids), DELETE_BATCH_SIZE):
+                    batch = ids[i:i + DELETE_BATCH_SIZE]
+                    deleted = _delete_batch(region_id, batch)
+                    done.update(batch)
+                    released += len(deleted)
+                    failed += len(batch) - len(deleted)
+                    poll_scheduler.reschedule(gone=ecs_instance.mark_released(db, instance_ids=deleted))
+        return {"success": True, "released": released, "recycled": recycled_total, "failed": failed}
 
-                if not result["success"]:
-                    logger.error(f"Error checking instances in region {region_id}: {result['error']}")
+    except Exception as e:
+        logger.exception("Error flushing ECS teardown queue")
+        # 未处理的实例放回队列，下一轮继续
+        teardown_queue.enqueue([instance_id for instance_id in instance_ids if instance_id not in done])
+        return {"success": False, "error": str(e), "released": released, "failed": failed}
+    finally:
+        db.close()
+        redis_client.delete(TEARDOWN_LOCK_KEY)
+
+
+def _describe_batches(batches: List[Tuple[str, List[InstanceRow]]]) -> List[Tuple[List[InstanceRow], Dict[str, Any]]]:
+    """各region的批次并发调用DescribeInstances，返回 (批次, 调用结果) 列表"""
+    for region_id, rows in batches:
+        logger.info(f"Checking {len(rows)} instances in region {region_id}")
+    responses = ali_cloud_service.describe_instances_concurrently(
+        [(region_id, [row.instance_id for row in rows]) for region_id, rows in batches]
+    )
+    return [(rows, response) for (_, rows), response in zip(batches, responses)]
+
+
+def _rdp_ready(rows: List[InstanceRow], cloud_instances: Dict[str, Dict[str, Any]]) -> Optional[Set[str]]:
+    """
+    探测已运行、学生任务还未Running的实例的RDP端口，一轮探测同时发起全部连接
+
+    Returns:
+        可以改为Running的实例ID；未开启探测时返回None。
+        开机超过 ECS_RDP_PROBE_MAX_WAIT 秒仍连不上的实例也放行，避免学生一直等待
+    """
+    if not settings.ECS_RDP_PROBE_ENABLED:
+        return None
+    waiting = {}
+    for row in rows:
+        info = cloud_instances.get(row.instance_id)
+        if not info or info["Status"] != "Running" or row.student_task_status == "Running":
+            continue
+        private_ip = private_ip_of(info)
+        if private_ip:
+            waiting[row.instance_id] = (private_ip, info)
+    if not waiting:
+        return set()
+
+    reachable = probe_reachable(private_ip for private_ip, _ in waiting.values())
+    deadline = datetime.datetime.utcnow() - datetime.timedelta(seconds=settings.ECS_RDP_PROBE_MAX_WAIT)
+    ready = set()
+    for instance_id, (private_ip, info) in waiting.items():
+        if private_ip in reachable:
+            ready.add(instance_id)
+            continue
+        started = started_at(info)
+        if started is not None and started <= deadline:
+            logger.warning(f"RDP port of instance {instance_id} ({private_ip}) still unreachable, marking task Running")
+            ready.add(instance_id)
+    return ready
+
+
+def check_instance_status_shard(shard: int = 0, shards: int = 1) -> Dict[str, Any]:
+    """
+    检查一个分片内的实例状态
+
+    按主键键集分页遍历全部活跃实例，只对调度表中已到期的实例按region每100个一批并发调用
+    DescribeInstances，与数据库状态比较后只写入有变化的行，每页的变更在一个事务中批量提交。
+    每页查询完成后对刚运行的实例做一轮RDP端口探测，可连接后学生任务才改为Running
+    """
+    db = SessionLocal()
+    try:
+        # 还未生成instance_id，或是创建时间是在近30秒的都不检查
+        created_before = datetime.datetime.utcnow() - datetime.timedelta(seconds=30)
+        total = ReconcileResult()
+        became_running = []
+        after_id = 0
+        while True:
+            rows = ecs_instance.get_reconcile_rows(
+                db=db, created_before=created_before, after_id=after_id,
+                limit=settings.ECS_STATUS_PAGE_SIZE, shard=shard, shards=shards
+            )
+            if not rows:
+                break
+            after_id = rows[-1].id
+            page_full = len(rows) >= settings.ECS_STATUS_PAGE_SIZE
+            due = poll_scheduler.filter_due([row.id for row in rows])
+            rows = [row for row in rows if row.id in due]
+
+            # 按region分组处理，每次最多处理100个实例
+            region_rows: Dict[str, List[InstanceRow]] = {}
+            for row in rows:
+                region_rows.setdefault(row.region_id, []).append(row)
+            batches = [
+                (region_id, instances[i:i + 100])
+                for region_id, instances in region_rows.items()
+                for i in range(0, len(instances), 100)
+            ]
+
+            result = ReconcileResult()
+            described = []
+            for batch, response in _describe_batches(batches):
+                if not response["success"]:
+                    # 查询失败的批次本轮不做任何修改，避免把实例误判为已释放，下一轮重试
+                    logger.error(f"Error checking instances in region {batch[0].region_id}: {response['error']}")
+                    result.active.extend(row.id for row in batch)
                     continue
+                described.append((batch, {inst["InstanceId"]: inst for inst in response["instances"]}))
+            rdp_ready = _rdp_ready(
+                [row for batch, _ in described for row in batch],
+                {instance_id: info for _, instances in described for instance_id, info in instances.items()}
+            )
+            for batch, instances in described:
+                reconcile(batch, instances, result=result, rdp_ready=rdp_ready)
+
+            # 更新数据库中的状态
+            ecs_instance.apply_reconcile(db=db, result=result)
+            poll_scheduler.reschedule(stable=result.stable, active=result.active, gone=result.gone)
+            # RDP还连不上的实例下一轮立即再次探测
+            poll_scheduler.poke(result.awaiting_rdp)
+            total.checked += result.checked
+            total.missing += result.missing
+            total.instance_updates.extend(result.instance_updates)
+            became_running.extend(result.became_running)
+
+            if not page_full:
+                break
+
+        if shard == 0:
+            poll_scheduler.trim()
+        if total.checked:
+            logger.info(
+                f"Shard {shard}/{shards}: checked {total.checked} instances, {total.missing} missing, "
+                f"{len(total.instance_updates)} instances updated"
+            )
+
+        # 实例刚变为Running时通知网关预先建立RDP隧道，学生打开页面时无需等待Windows登录
+        if settings.GUACAMOLE_PREWARM_ENABLED:
+            for student_task_id in became_running:
+                guacamole_registry.request_prewarm(student_task_id)
 
-                # 处理返回的信息
-                instance_info = {
-                    inst["InstanceId"]: inst
-                    for inst in result["instances"]
-                }
-                logger.info(f"Instance info in region {region_id}: {instance_info}")
-
-                # 更新数据库中的状态
-                for instance in batch:
-                    instance_id = instance["instance_id"]
-                    #id = instance["id"]
-
-                    if instance_id in instance_info.keys():
-                        info = instance_info[instance_id]
-                        ecs_instance.update_status(db=db,instance_id=instance_id, status=info["Status"],
-                            private_ip=info["VpcAttributes"]["PrivateIpAddress"]["IpAddress"][0] if len(info["VpcAttributes"]["PrivateIpAddress"]["IpAddress"])>0 else None,
-                            public_ip=info["PublicIpAddress"]["IpAddress"][0] if len(info["PublicIpAddress"]["IpAddress"])>0 else None)
-                        crud_student_task.update_status(
-                            db=db,
-                            student_task_id=next((inst.student_task_id for inst in active_instances if inst.instance_id == instance_id), None),
-                            status="Running",
-
-                        )
-                    else:
-                        if next((inst.status for inst in active_instances if
-                                                  inst.instance_id == instance_id), None) == "Running":
-                            ecs_instance.update_status(db=db,instance_id=instance_id,status="Stopped")
-                        crud_student_task.update_status(
-                            db=db,
-                            student_task_id=next((inst.student_task_id for inst in active_instances if
-                                                  inst.instance_id == instance_id), None),
-                            status="Stopped"
-                        )
-
-        return {"success": True}
+        return {"success": True, "shard": shard, "checked": total.checked, "updated": len(total.instance_updates)}
 
     except Exception as e:
         logger.exception("Error checking instance status")
@@ -373,6 +815,94 @@ def check_instance_status() -> Dict[str, Any]:
         db.close()
 
 
+def apply_instance_events(states: Dict[str, str]) -> Dict[str, Any]:
+    """
+    应用推送的实例状态变更事件
+
+    与定时检查使用相同的对账规则写入ECSInstance与StudentTask。事件不包含IP，
+    刚变为Running而数据库中还没有IP的实例立即调用DescribeInstances补齐，查询失败的交给下一轮定时检查；
+    RDP端口还连不上的实例交给下一轮定时检查继续探测。处理过的实例按结果重新安排下次兜底检查
+
+    Args:
+        states: 实例ID -> 事件中的状态
+    """
+    if not states:
+        return {"success": True, "received": 0, "applied": 0}
+    db = SessionLocal()
+    try:
+        rows = ecs_instance.get_reconcile_rows(db=db, instance_ids=list(states))
+        cloud_instances = {}
+        for row in rows:
+            info = event_instance_info(row, states[row.instance_id])
+            if info is not None:
+                cloud_instances[row.instance_id] = info
+
+        region_rows: Dict[str, List[InstanceRow]] = {}
+        for row in rows:
+            if states[row.instance_id] == "Running" and not row.private_ip:
+                region_rows.setdefault(row.region_id, []).append(row)
+        batches = [
+            (region_id, instances[i:i + 100])
+            for region_id, instances in region_rows.items()
+            for i in range(0, len(instances), 100)
+        ]
+        deferred = set()
+        for batch, response in _describe_batches(batches):
+            if not response["success"]:
+                logger.error(f"Error checking instances in region {batch[0].region_id}: {response['error']}")
+                deferred.update(row.id for row in batch)
+                continue
+            cloud_instances.update({inst["InstanceId"]: inst for inst in response["instances"]})
+
+        now = datetime.datetime.utcnow()
+        rows = [row for row in rows if row.id not in deferred]
+        result = reconcile(rows, cloud_instances, now=now, rdp_ready=_rdp_ready(rows, cloud_instances))
+        # 定时检查查不到实例时只处理原为Running的(新建的实例可能暂时查不到)，释放事件则是确定的
+        released = {row.id for row in rows if states[row.instance_id] in RELEASED_STATES and row.status != "Running"}
+        if released:
+            result.instance_updates.extend({"id": pk, "status": "Stopped", "updated_at": now} for pk in released)
+            result.stable = [pk for pk in result.stable if pk not in released]
+            result.active = [pk for pk in result.active if pk not in released]
+            result.gone.extend(released)
+        ecs_instance.apply_reconcile(db=db, result=result)
+        poll_scheduler.reschedule(stable=result.stable, active=result.active, gone=result.gone)
+        poll_scheduler.poke(deferred)
+        poll_scheduler.poke(result.awaiting_rdp)
+
+        if settings.GUACAMOLE_PREWARM_ENABLED:
+            for student_task_id in result.became_running:
+                guacamole_registry.request_prewarm(student_task_id)
+
+        return {
+            "success": True, "received": len(states), "applied": result.checked,
+            "updated": len(result.instance_updates)
+        }
+    finally:
+        db.close()
+
+
+@celery_app.task(name="app.tasks.ecs_tasks.check_instance_status")
+def check_instance_status() -> Dict[str, Any]:
+    """
+    检查实例状态任务
+
+    ECS_STATUS_SHARDS > 1 时按实例ID取模分发给多个Celery任务并行检查，否则在本任务中完成
+    """
+    shards = settings.ECS_STATUS_SHARDS
+    if shards <= 1:
+        return check_instance_status_shard()
+    for shard in range(shards):
+        # 分片任务超过一个周期未执行则丢弃，由下一轮覆盖
+        check_instance_status_shard_task.apply_async(args=[shard, shards], expires=settings.ECS_POLL_FAST_SECONDS)
+    return {"success": True, "shards": shards}
+
+
+@celery_app.task(name="app.tasks.ecs_tasks.check_instance_status_shard_task")
+def check_instance_status_shard_task(shard: int, shards: int) -> Dict[str, Any]:
+    """Celery任务：检查一个分片内的实例状态"""
+    return check_instance_status_shard(shard=shard, shards=shards)
+
+
 @celery_app.task(name="app.tasks.ecs_tasks.create_ecs_instance_task")
 def create_ecs_instance_task(
         student_task_id: int,
@@ -395,6 +925,18 @@ def create_ecs_instance_task(
     return create_ecs_instance(student_task_id=student_task_id, task_id=task_id, instance_name=instance_name)
 
 
+@celery_app.task(name="app.tasks.ecs_tasks.provision_ecs_batch_task")
+def provision_ecs_batch_task(environment_id: int):
+    """Celery任务：合并创建同一环境模板的ECS实例"""
+    return provision_ecs_batch(environment_id=environment_id)
+
+
+@celery_app.task(name="app.tasks.ecs_tasks.flush_ecs_teardown_task")
+def flush_ecs_teardown_task() -> Dict[str, Any]:
+    """定时任务：批量释放队列中的ECS实例"""
+    return flush_ecs_teardown()
+
+
 @celery_app.task(name="app.tasks.ecs_tasks.stop_ecs_instance_task")
 def stop_ecs_instance_task(instance_id: str):
     """Celery任务：停止并释放ECS实例"""
@@ -0,0 +1,268 @@
+import datetime
+import logging
+import uuid
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import pytz
+from sqlalchemy.orm import Session
+
+from app.celery_worker import celery_app
+from app.core.config import settings
+from app.core.redis_client import redis_client
+from app.crud.ecs import ecs_pool_instance
+from app.db.session import SessionLocal
+from app.models.ecs import ECSPoolInstance
+from app.models.environment import EnvironmentTemplate
+from app.models.task import StudentTask, Task
+from app.services.ali_cloud import ali_cloud_service
+from app.services.ecs_placement import launch_candidates
+from app.services.warm_pool import WarmPoolConfig, pool_refill_plan
+from app.tasks.ecs_tasks import compute_auto_release_time, generate_instance_password, launch_instances
+
+logger = logging.getLogger(__name__)
+
+# 创建后超过该时间仍未查询到实例，视为创建失败
+POOL_PENDING_TIMEOUT = datetime.timedelta(minutes=10)
+# 距自动释放不足该时间的就绪实例不再分配，直接释放
+POOL_RELEASE_MARGIN_MINUTES = 30
+# 回收的实例超过该时间仍未停机，直接释放
+POOL_RECYCLE_TIMEOUT = datetime.timedelta(minutes=15)
+# 补充任务的互斥锁，上一轮调用阿里云较慢时避免重复创建
+REFILL_LOCK_KEY = "ecs:pool:refill:lock"
+
+
+def _describe_pool_instances(
+        pool_instances: List[ECSPoolInstance]
+) -> Iterator[Tuple[ECSPoolInstance, Optional[Dict[str, Any]]]]:
+    """按region分批查询池实例，返回(池实例, 实例信息)，查不到的实例信息为None，查询失败的批次跳过"""
+    region_instances: Dict[str, List[ECSPoolInstance]] = {}
+    for pool_instance in pool_instances:
+        region_instances.setdefault(pool_instance.region_id, []).append(pool_instance)
+    batches = [
+        instances[i:i + 100]
+        for instances in region_instances.values()
+        for i in range(0, len(instances), 100)
+    ]
+    responses = ali_cloud_service.describe_instances_concurrently(
+        [(batch[0].region_id, [inst.instance_id for inst in batch]) for batch in batches]
+    )
+    for batch, result in zip(batches, responses):
+        if not result["success"]:
+            logger.error(f"Error checking pool instances: {result['error']}")
+            continue
+
+        instance_info = {inst["InstanceId"]: inst for inst in result["instances"]}
+        for pool_instance in batch:
+            yield pool_instance, instance_info.get(pool_instance.instance_id)
+
+
+def _sync_pending_instances(db: Session):
+    """查询创建中的池实例，已运行的标记为就绪"""
+    pending = ecs_pool_instance.get_by_status(db, statuses=["Pending"])
+    now = datetime.datetime.utcnow()
+    for pool_instance, info in _describe_pool_instances(pending):
+        if info is None:
+            if pool_instance.created_at < now - POOL_PENDING_TIMEOUT:
+                ecs_pool_instance.update_status(db, pool_instance=pool_instance, status="Error")
+            continue
+        private_ips = info["VpcAttributes"]["PrivateIpAddress"]["IpAddress"]
+        public_ips = info["PublicIpAddress"]["IpAddress"]
+        if info["Status"] == "Running" and private_ips:
+            ecs_pool_instance.update_status(
+                db, pool_instance=pool_instance, status="Ready", ready_at=now,
+                private_ip=private_ips[0], public_ip=public_ips[0] if public_ips else None
+            )
+
+
+def _reset_stopped_instances(db: Session):
+    """
+    回收的实例停机后把系统盘重置为镜像并自动开机，之后与新建实例一样等待就绪
+
+    同时按实际配置记录规格、安全组与VSwitch，作为其他环境模板领取时的匹配条件
+    """
+    stopping = ecs_pool_instance.get_by_status(db, statuses=["Stopping"])
+    now = datetime.datetime.utcnow()
+    for pool_instance, info in _describe_pool_instances(stopping):
+        if info is None:
+            ecs_pool_instance.update_status(db, pool_instance=pool_instance, status="Released")
+            continue
+        if info["Status"] != "Stopped":
+            if pool_instance.created_at < now - POOL_RECYCLE_TIMEOUT:
+                logger.error(f"Recycled instance {pool_instance.instance_id} did not stop in time, releasing")
+                ali_cloud_service.delete_instance(
+                    region_id=pool_instance.region_id, instance_id=pool_instance.instance_id, force=True
+                )
+                ecs_pool_instance.update_status(db, pool_instance=pool_instance, status="Released")
+            continue
+
+        result = ali_cloud_service.reinit_system_disk(
+            region_id=pool_instance.region_id, instance_id=pool_instance.instance_id,
+            password=pool_instance.password
+        )
+        if not result["success"]:
+            logger.error(f"Error resetting recycled instance {pool_instance.instance_id}: {result['error']}")
+            continue
+        security_group_ids = info.get("SecurityGroupIds", {}).get("SecurityGroupId", [])
+        ecs_pool_instance.update_status(
+            db, pool_instance=pool_instance, status="Pending",
+            image_id=info.get("ImageId", pool_instance.image_id),
+            instance_type=info.get("InstanceType") or pool_instance.instance_type,
+            security_group_id=security_group_ids[0] if security_group_ids else pool_instance.security_group_id,
+            vswitch_id=info.get("VpcAttributes", {}).get("VSwitchId") or pool_instance.vswitch_id,
+            private_ip=None, public_ip=None
+        )
+
+
+def _release(db: Session, pool_instance: ECSPoolInstance) -> bool:
+    """释放就绪实例，先改为Releasing，避免释放过程中被学生领取"""
+    if not ecs_pool_instance.transition(
+            db, pool_instance_id=pool_instance.id, from_status="Ready", to_status="Releasing"
+    ):
+        return False
+    db.refresh(pool_instance)
+    result = ali_cloud_service.delete_instance(
+        region_id=pool_instance.region_id, instance_id=pool_instance.instance_id, force=True
+    )
+    if not result["success"]:
+        logger.error(f"Error releasing pool instance {pool_instance.instance_id}: {result['error']}")
+        ecs_pool_instance.update_status(db, pool_instance=pool_instance, status="Ready")
+        return False
+    ecs_pool_instance.update_status(db, pool_instance=pool_instance, status="Released")
+    return True
+
+
+def _create_pool_instances(db: Session, env_template: EnvironmentTemplate, amount: int) -> Dict[str, Any]:
+    """用一次RunInstances为预热池创建amount台实例"""
+    resource_config = env_template.resource_config
+    if not launch_candidates(resource_config):
+        return {"success": False, "error": f"Environment template with id {env_template.id} resource_config error"}
+    password = generate_instance_password(resource_config)
+    region_id = resource_config.get("region_id", "cn-hangzhou")
+    auto_release_time = datetime.datetime.utcnow() + datetime.timedelta(hours=settings.ECS_POOL_INSTANCE_MAX_HOURS)
+
+    logger.info(f"Creating {amount} warm pool instances for environment {env_template.id}")
+    result = launch_instances(resource_config, env_template.image, password, auto_release_time, amount=amount)
+    if not result["success"]:
+        logger.error(f"Error creating warm pool instances for environment {env_template.id}: {result['error']}")
+        return result
+
+    for candidate, instance_ids in result["launches"]:
+        for instance_id in instance_ids:
+            db.add(ECSPoolInstance(
+                environment_id=env_template.id,
+                instance_id=instance_id,
+                instance_name=f"pool-{env_template.id}-{str(uuid.uuid4())[:8]}",
+                image_id=env_template.image,
+                instance_type=candidate.instance_type,
+                region_id=region_id,
+                security_group_id=candidate.security_group_id,
+                vswitch_id=candidate.vswitch_id,
+                spot_strategy=resource_config.get("spot_strategy", None),
+                password=password,
+                status="Pending",
+                auto_release_time=auto_release_time
+            ))
+    db.commit()
+    return {"success": True, "created": len(result["instance_ids"])}
+
+
+def _evict_instances(db: Session, environment_id: int, count: int, idle_minutes: int) -> int:
+    """释放空闲超过idle_minutes的就绪实例，最多count台，先释放空闲最久的"""
+    idle_before = datetime.datetime.utcnow() - datetime.timedelta(minutes=idle_minutes)
+    released = 0
+    for pool_instance in ecs_pool_instance.get_by_status(db, statuses=["Ready"], environment_id=environment_id):
+        if released >= count:
+            break
+        if pool_instance.ready_at and pool_instance.ready_at < idle_before and _release(db, pool_instance):
+            released += 1
+    return released
+
+
+def _release_expiring(db: Session) -> int:
+    """释放即将被阿里云自动释放、已不能分配的就绪实例"""
+    expire_before = datetime.datetime.utcnow() + datetime.timedelta(minutes=POOL_RELEASE_MARGIN_MINUTES)
+    released = 0
+    for pool_instance in ecs_pool_instance.get_by_status(db, statuses=["Ready"]):
+        if pool_instance.auto_release_time and pool_instance.auto_release_time <= expire_before:
+            released += int(_release(db, pool_instance))
+    return released
+
+
+@celery_app.task(name="app.tasks.pool_tasks.refill_warm_pools")
+def refill_warm_pools() -> Dict[str, Any]:
+    """
+    定时任务：维护各环境模板的预热池
+
+    按排课时段计算目标大小，不足时批量创建，超出时释放空闲过久的就绪实例；
+    取消预热池配置的模板，其池中实例空闲过久后全部释放；回收的实例停机后重置系统盘
+    """
+    if not redis_client.set(REFILL_LOCK_KEY, 1, nx=True, ex=settings.ECS_POOL_REFILL_INTERVAL * 10):
+        return {"success": True, "message": "Refill already running"}
+    db = SessionLocal()
+    try:
+        _reset_stopped_instances(db)
+        _sync_pending_instances(db)
+        expired = _release_expiring(db)
+
+        templates = db.query(EnvironmentTemplate).all()
+        configs = {
+            template.id: WarmPoolConfig.from_resource_config(template.resource_config)
+            for template in templates
+        }
+        environment_ids = {env_id for env_id, config in configs.items() if config}
+        environment_ids.update(ecs_pool_instance.environment_ids(db))
+        templates = {template.id: template for template in templates}
+
+        summary = {}
+        for environment_id in environment_ids:
+            template = templates.get(environment_id)
+            config = configs.get(environment_id)
+            counts = ecs_pool_instance.count_by_status(db, environment_id=environment_id)
+            # 回收中的实例重置后即可就绪，与创建中的实例一起计入
+            pending = counts.get("Pending", 0) + counts.get("Stopping", 0)
+            delta = pool_refill_plan(config, pending, counts.get("Ready", 0))
+            if delta > 0 and template:
+                result = _create_pool_instances(db, template, min(delta, settings.ECS_BATCH_MAX_AMOUNT))
+                summary[environment_id] = {"created": result.get("created", 0)}
+            elif delta < 0:
+                idle_minutes = config.idle_minutes if config else 0
+                summary[environment_id] = {"released": _evict_instances(db, environment_id, -delta, idle_minutes)}
+        return {"success": True, "expired": expired, "pools": summary}
+
+    except Exception as e:
+        logger.exception("Error refilling warm pools")
+        return {"success": False, "error": str(e)}
+    finally:
+        db.close()
+        redis_client.delete(REFILL_LOCK_KEY)
+
+
+@celery_app.task(name="app.tasks.pool_tasks.adopt_pool_instance_task")
+def adopt_pool_instance_task(pool_instance_id: int, student_task_id: int) -> Dict[str, Any]:
+    """Celery任务：池实例分配给学生任务后，把学生任务与实例的自动释放时间改为按任务时长计算"""
+    db = SessionLocal()
+    try:
+        pool_instance = ecs_pool_instance.get(db, id=pool_instance_id)
+        student_task = db.query(StudentTask).filter(StudentTask.id == student_task_id).first()
+        if not pool_instance or not student_task:
+            return {"success": False, "error": "Pool instance or student task not found"}
+        task_obj = db.query(Task).filter(Task.id == student_task.task_id).first()
+
+        auto_release_time = compute_auto_release_time(task_obj)
+        # 与直接创建的实例相同，学生任务记录自动释放时间
+        student_task.auto_release_time = auto_release_time.astimezone(pytz.timezone('Asia/Shanghai'))
+        db.add(student_task)
+        db.commit()
+        result = ali_cloud_service.modify_auto_release_time(
+            instance_id=pool_instance.instance_id, auto_release_time=auto_release_time,
+            region_id=pool_instance.region_id
+        )
+        if not result["success"]:
+            logger.error(f"Error modifying auto release time of {pool_instance.instance_id}: {result['error']}")
+            return result
+        ecs_pool_instance.update_status(
+            db, pool_instance=pool_instance, status="Assigned", auto_release_time=auto_release_time
+        )
+        return {"success": True, "auto_release_time": auto_release_time.isoformat()}
+    finally:
+        db.close()
@@ -0,0 +1,315 @@
+"""
+ECS创建/检查/释放流程压测
+
+使用进程内的模拟阿里云(ALIYUN_FAKE，见 app/services/fake_aliyun.py)，不产生费用。
+同时让N个学生开始实验(与 POST /student-tasks/start-experiment 走相同的代码)，本进程内模拟
+Celery worker与定时任务(状态检查、批量释放)，统计:
+
+- 启动阶段: 学生任务从开始实验到Running的耗时分位数，每个学生的API调用次数(按API)与数据库查询次数
+- 释放阶段: 到期清理(cleanup_expired_tasks)到实例全部释放的耗时，每个学生的API调用次数与数据库查询次数
+
+需要可用的MySQL(使用 .env 中的数据库，请使用开发/测试库)与Redis。运行时创建一个环境模板、
+任务与N个学生，结束后删除(--keep 保留)；数据库中需要至少有一个管理员账号:
+    python -m benchmarks.ecs_provision_load --students 200 --boot-seconds 20
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from celery.app.task import Task as CeleryTask
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from app.core.config import settings
+from app.db.base import engine
+from app.models.admin import Administrator
+from app.models.ecs import ECSInstance
+from app.models.environment import EnvironmentTemplate
+from app.models.student import Student
+from app.models.task import CeleryTaskLog, StudentTask, Task
+from app.services.fake_aliyun import fake_aliyun
+
+logger = logging.getLogger(__name__)
+
+
+def percentile(values: List[float], q: float, digits: int = 1) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(q * len(values)))], digits)
+
+
+class QueryCounter:
+    """统计应用连接池(app.db.base.engine)执行的SQL语句数，压测脚本自己的查询使用单独的连接池，不计入"""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, *args, **kwargs):
+        with self._lock:
+            self.count += 1
+
+    def reset(self) -> int:
+        with self._lock:
+            count, self.count = self.count, 0
+        return count
+
+
+def run_celery_inline(workers: int) -> ThreadPoolExecutor:
+    """没有Celery worker: .delay()/.apply_async() 交给本进程的线程池执行，countdown用定时器模拟"""
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="celery")
+
+    def run(task, args, kwargs):
+        try:
+            task(*args, **kwargs)
+        except Exception:
+            logger.exception(f"Task {task.name} failed")
+
+    def apply_async(self, args=None, kwargs=None, countdown=None, **options):
+        args, kwargs = tuple(args or ()), dict(kwargs or {})
+        if countdown:
+            timer = threading.Timer(countdown, executor.submit, args=(run, self, args, kwargs))
+            timer.daemon = True
+            timer.start()
+        else:
+            executor.submit(run, self, args, kwargs)
+
+    CeleryTask.apply_async = apply_async
+    return executor
+
+
+def run_beat(stop: threading.Event):
+    """模拟Celery beat中与ECS相关的定时任务"""
+    from app.tasks.ecs_tasks import check_instance_status, flush_ecs_teardown
+
+    next_check = next_flush = 0.0
+    while not stop.is_set():
+        now = time.monotonic()
+        if now >= next_check:
+            check_instance_status()
+            next_check = now + settings.ECS_POLL_FAST_SECONDS
+        if now >= next_flush:
+            flush_ecs_teardown()
+            next_flush = now + settings.ECS_TEARDOWN_FLUSH_SECONDS
+        stop.wait(0.2)
+
+
+def create_fixture(session, args) -> Dict[str, Any]:
+    admin = session.query(Administrator).order_by(Administrator.id).first()
+    if not admin:
+        raise SystemExit("数据库中没有管理员账号，无法创建压测任务")
+    run_id = uuid.uuid4().hex[:8]
+    env = EnvironmentTemplate(
+        name=f"bench-{run_id}", type="guacamole", image=args.image, created_by=admin.id,
+        resource_config=json.loads(args.resource_config)
+    )
+    session.add(env)
+    session.flush()
+    task = Task(
+        title=f"bench-{run_id}", max_duration=args.max_duration, max_attempts=1, created_by=admin.id,
+        task_type="guacamole", environment_id=env.id
+    )
+    students = [Student(student_id=f"bench-{run_id}-{i}", name=f"bench-{i}") for i in range(args.students)]
+    session.add(task)
+    session.add_all(students)
+    session.commit()
+    return {"environment_id": env.id, "task_id": task.id, "student_ids": [student.id for student in students]}
+
+
+def drop_fixture(session, fixture: Dict[str, Any]):
+    student_task_ids = [row.id for row in session.query(StudentTask.id).filter(
+        StudentTask.task_id == fixture["task_id"]
+    )]
+    if student_task_ids:
+        session.query(CeleryTaskLog).filter(
+            CeleryTaskLog.student_task_id.in_(student_task_ids)
+        ).delete(synchronize_session=False)
+        session.query(ECSInstance).filter(
+            ECSInstance.student_task_id.in_(student_task_ids)
+        ).delete(synchronize_session=False)
+        session.query(StudentTask).filter(StudentTask.id.in_(student_task_ids)).delete(synchronize_session=False)
+    session.query(Student).filter(Student.id.in_(fixture["student_ids"])).delete(synchronize_session=False)
+    session.query(Task).filter(Task.id == fixture["task_id"]).delete(synchronize_session=False)
+    session.query(EnvironmentTemplate).filter(
+        EnvironmentTemplate.id == fixture["environment_id"]
+    ).delete(synchronize_session=False)
+    session.commit()
+
+
+def start_student(task_id: int, student_id: int) -> float:
+    """与学生点击开始实验相同，返回请求耗时秒数"""
+    from app.api.endpoints.student_tasks import start_experiment
+    from app.db.base import SessionLocal
+
+    started = time.monotonic()
+    db = SessionLocal()
+    try:
+        asyncio.run(start_experiment(
+            db=db, current_student={"id": student_id}, task_id=task_id, idempotency_key=uuid.uuid4().hex
+        ))
+    finally:
+        db.close()
+    return time.monotonic() - started
+
+
+def phase_report(name: str, students: int, api_calls: Dict[str, int], queries: int, **fields) -> Dict[str, Any]:
+    throttled = api_calls.pop("Throttling", 0)
+    return dict(
+        phase=name,
+        api_calls_per_student={action: round(count / students, 2) for action, count in sorted(api_calls.items())},
+        api_calls_total=sum(api_calls.values()),
+        throttled=throttled,
+        db_queries_per_student=round(queries / students, 1),
+        **fields
+    )
+
+
+def print_report(results: List[Dict[str, Any]]):
+    for result in results:
+        print(f"\n[{result['phase']}]")
+        for key, value in result.items():
+            if key == "phase":
+                continue
+            if isinstance(value, dict):
+                print(f"  {key}:")
+                for sub_key, sub_value in value.items():
+                    print(f"    {sub_key:>32}: {sub_value}")
+            else:
+                print(f"  {key:>34}: {'-' if value is None else value}")
+
+
+def run_benchmark(args):
+    settings.ALIYUN_FAKE = True
+    settings.ALIYUN_FAKE_PROFILE = dict(settings.ALIYUN_FAKE_PROFILE, **{
+        key: value for key, value in {
+            "latency_ms": args.latency_ms, "qps": args.qps, "no_stock_rate": args.no_stock_rate,
+            "boot_seconds": args.boot_seconds,
+        }.items() if value is not None
+    })
+    # 模拟实例的内网IP不可连接，也没有guacd
+    settings.ECS_RDP_PROBE_ENABLED = False
+    settings.GUACAMOLE_PREWARM_ENABLED = False
+    if args.batch_window is not None:
+        settings.ECS_BATCH_WINDOW_SECONDS = args.batch_window
+
+    bench_engine = create_engine(settings.SQLALCHEMY_DATABASE_URI, pool_pre_ping=True)
+    session = sessionmaker(bind=bench_engine)()
+    fixture = create_fixture(session, args)
+    counter = QueryCounter()
+    executor = run_celery_inline(args.workers)
+    stop = threading.Event()
+    beat = threading.Thread(target=run_beat, args=(stop,), daemon=True)
+    results = []
+    try:
+        beat.start()
+        fake_aliyun.reset_stats()
+        counter.reset()
+
+        # 启动阶段
+        print(f"{args.students} 个学生同时开始实验...", flush=True)
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as students:
+            request_seconds = list(students.map(
+                lambda student_id: start_student(fixture["task_id"], student_id), fixture["student_ids"]
+            ))
+
+        running_at: Dict[int, float] = {}
+        errors = set()
+        deadline = started + args.timeout
+        while time.monotonic() < deadline and len(running_at) + len(errors) < args.students:
+            rows = session.query(StudentTask.id, StudentTask.status).filter(
+                StudentTask.task_id == fixture["task_id"]
+            ).all()
+            session.commit()
+            now = time.monotonic()
+            for student_task_id, status in rows:
+                if status == "Running" and student_task_id not in running_at:
+                    running_at[student_task_id] = now - started
+                elif status == "Error":
+                    errors.add(student_task_id)
+            time.sleep(0.5)
+        seconds = list(running_at.values())
+        results.append(phase_report(
+            "启动", args.students, dict(fake_aliyun.stats), counter.reset(),
+            running=len(running_at), errors=len(errors), timeout=args.students - len(running_at) - len(errors),
+            start_request_p50_s=percentile(request_seconds, 0.5, 3),
+            start_request_p99_s=percentile(request_seconds, 0.99, 3),
+            running_p50_s=percentile(seconds, 0.5), running_p90_s=percentile(seconds, 0.9),
+            running_p99_s=percentile(seconds, 0.99), running_max_s=percentile(seconds, 1.0),
+        ))
+
+        # 释放阶段: 把开始时间提前到超过最长时长，由到期清理加入释放队列
+        from app.tasks.cleanup_tasks import cleanup_expired_tasks
+
+        fake_aliyun.reset_stats()
+        remaining_before = fake_aliyun.instance_count()
+        session.query(StudentTask).filter(StudentTask.task_id == fixture["task_id"]).update({
+            StudentTask.start_at: datetime.datetime.utcnow() - datetime.timedelta(minutes=args.max_duration + 1)
+        }, synchronize_session=False)
+        session.commit()
+        print(f"释放 {remaining_before} 个实例...", flush=True)
+        started = time.monotonic()
+        cleanup_expired_tasks()
+        deadline = started + args.timeout
+        while time.monotonic() < deadline and fake_aliyun.instance_count():
+            time.sleep(0.5)
+        results.append(phase_report(
+            "释放", args.students, dict(fake_aliyun.stats), counter.reset(),
+            released=remaining_before - fake_aliyun.instance_count(), remaining=fake_aliyun.instance_count(),
+            seconds=round(time.monotonic() - started, 1),
+        ))
+
+        print_report(results)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump({"args": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+    finally:
+        stop.set()
+        beat.join(timeout=30)
+        executor.shutdown(wait=False)
+        if not args.keep:
+            drop_fixture(session, fixture)
+        session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ECS创建/检查/释放流程压测(模拟阿里云)")
+    parser.add_argument("--students", type=int, default=100, help="同时开始实验的学生数")
+    parser.add_argument("--concurrency", type=int, default=50, help="同时发起开始实验请求的线程数")
+    parser.add_argument("--workers", type=int, default=16, help="模拟的Celery worker线程数")
+    parser.add_argument("--timeout", type=float, default=600, help="每个阶段的最长等待秒数")
+    parser.add_argument("--image", default="m-bench", help="环境模板的镜像ID")
+    parser.add_argument(
+        "--resource-config",
+        default=json.dumps({
+            "region_id": settings.ALIYUN_REGION_ID, "instance_type": "ecs.g7.large,ecs.g6.large",
+            "security_group_id": "sg-bench", "vswitch_id": "vsw-bench-a,vsw-bench-b", "internet_max_bandwidth_out": 1,
+            "password": "Bench@2024!",
+        }),
+        help="环境模板的resource_config(JSON)，配置了固定密码(password)时创建请求才会合并"
+    )
+    parser.add_argument("--max-duration", type=int, default=60, help="任务的最长时长(分钟)")
+    parser.add_argument("--batch-window", type=float, help="覆盖 ECS_BATCH_WINDOW_SECONDS")
+    parser.add_argument("--latency-ms", type=float, help="覆盖模拟参数 latency_ms")
+    parser.add_argument("--qps", type=float, help="覆盖模拟参数 qps")
+    parser.add_argument("--no-stock-rate", type=float, help="覆盖模拟参数 no_stock_rate")
+    parser.add_argument("--boot-seconds", type=float, help="覆盖模拟参数 boot_seconds")
+    parser.add_argument("--keep", action="store_true", help="保留压测创建的数据")
+    parser.add_argument("--output", help="结果JSON文件")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+    run_benchmark(args)
+
+
+if __name__ == "__main__":
+    main()
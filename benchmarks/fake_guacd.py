@@ -0,0 +1,185 @@
+"""
+用于压测的伪guacd
+
+完成与真实guacd相同的握手(select/args/size/audio/video/image/connect/ready)，
+之后按设定的速率回放指令流，不需要RDP主机:
+
+- 指定 --recording 时回放录制的指令流。guacd的会话录像(连接参数 recording-path)
+  就是原始的Guacamole指令流，可直接使用。每个sync指令结束一帧，
+  按原始sync时间间隔(除以 --speed)或固定的 --fps 回放。
+- 否则生成合成画面: 每帧 --tiles 个 --tile-bytes 大小的图片块，加一个sync。
+
+回放时sync的时间戳改写为当前毫秒时间，客户端据此计算经过隧道的延迟。
+
+启动方式:
+    python -m benchmarks.fake_guacd --port 4823 --fps 15
+"""
+import argparse
+import asyncio
+import base64
+import logging
+import os
+import time
+from typing import List, Tuple
+
+from app.services.guacamole_protocol import InstructionParser
+from app.services.guacd_client import GUACAMOLE_PROTOCOL_VERSION, encode_instruction
+
+logger = logging.getLogger(__name__)
+
+# 回复select的参数列表，与guacd的RDP插件保持相同的形式
+ARGS = (GUACAMOLE_PROTOCOL_VERSION, "hostname", "port", "username", "password", "width", "height", "dpi")
+
+# 帧: (不含sync的指令字节, 距上一帧的原始间隔秒数)
+Frame = Tuple[bytes, float]
+
+
+def load_recording(path: str) -> List[Frame]:
+    """读取录制的指令流，按sync指令切分为帧"""
+    parser = InstructionParser()
+    with open(path, "rb") as f:
+        parser.feed(f.read())
+    parser.parse()
+    stream = parser.take()
+    if stream is None:
+        raise ValueError(f"录制文件中没有完整的指令: {path}")
+
+    frames = []
+    parts = []
+    last_timestamp = None
+    for index, (opcode, start, end) in enumerate(stream.instructions):
+        if opcode != b"sync":
+            parts.append(stream.data[start:end])
+            continue
+        timestamp = int(stream.arguments(index, 1)[0])
+        interval = (timestamp - last_timestamp) / 1000 if last_timestamp is not None else 0
+        last_timestamp = timestamp
+        frames.append((b"".join(parts), max(interval, 0)))
+        parts = []
+    if parts:
+        frames.append((b"".join(parts), 0))
+    return frames
+
+
+def synthetic_frames(tiles: int, tile_bytes: int, count: int = 16) -> List[Frame]:
+    """生成合成画面，每帧在不同位置绘制若干图片块"""
+    frames = []
+    for frame_index in range(count):
+        parts = []
+        for tile in range(tiles):
+            stream = str(tile + 1)
+            x, y = (tile * 64) % 1280, ((tile * 64) // 1280 * 64 + frame_index * 8) % 720
+            payload = base64.b64encode(os.urandom(tile_bytes * 3 // 4)).decode()
+            parts.append(encode_instruction("img", stream, 14, 0, "image/jpeg", x, y))
+            parts.append(encode_instruction("blob", stream, payload))
+            parts.append(encode_instruction("end", stream))
+        frames.append(("".join(parts).encode(), 0))
+    return frames
+
+
+class FakeGuacd:
+    """伪guacd服务器"""
+
+    def __init__(self, frames: List[Frame], fps: float = 0, speed: float = 1.0):
+        self.frames = frames
+        self.fps = fps
+        self.speed = speed
+        self.connections = 0
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        parser = InstructionParser()
+        try:
+            if not await self._handshake(reader, writer, parser):
+                return
+            send_task = asyncio.create_task(self._replay(writer))
+            try:
+                # 读取客户端发来的指令(sync回复、键鼠)直到disconnect或断开
+                while True:
+                    data = await reader.read(65536)
+                    if not data:
+                        break
+                    parser.feed(data)
+                    parser.parse()
+                    frame = parser.take()
+                    if frame and b"disconnect" in frame.opcodes:
+                        break
+            finally:
+                send_task.cancel()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def _read_instruction(self, reader, parser: InstructionParser) -> bytes:
+        while not parser.instructions:
+            data = await reader.read(65536)
+            if not data:
+                raise ConnectionError("客户端已断开")
+            parser.feed(data)
+            parser.parse()
+        return parser.take(1).opcodes[0]
+
+    async def _handshake(self, reader, writer, parser: InstructionParser) -> bool:
+        if await self._read_instruction(reader, parser) != b"select":
+            return False
+        writer.write(encode_instruction("args", *ARGS).encode())
+        await writer.drain()
+        while True:
+            opcode = await self._read_instruction(reader, parser)
+            if opcode == b"connect":
+                break
+        writer.write(encode_instruction("ready", f"$fake-{id(writer)}").encode())
+        await writer.drain()
+        return True
+
+    async def _replay(self, writer: asyncio.StreamWriter):
+        """循环回放帧，每帧末尾追加以当前时间为时间戳的sync"""
+        index = 0
+        next_at = time.monotonic()
+        try:
+            while True:
+                body, interval = self.frames[index % len(self.frames)]
+                index += 1
+                next_at += 1 / self.fps if self.fps else interval / self.speed
+                delay = next_at - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                else:
+                    # 落后太多时不追赶，避免瞬间积压
+                    next_at = time.monotonic()
+                writer.write(body + encode_instruction("sync", int(time.time() * 1000)).encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+
+
+async def serve(host: str, port: int, guacd: FakeGuacd):
+    server = await asyncio.start_server(guacd.handle, host, port)
+    logger.info(f"伪guacd已启动: {host}:{port}, 每连接 {guacd.fps or '录制速率'} fps")
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="压测用的伪guacd")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=4823)
+    parser.add_argument("--recording", help="回放的guacd会话录像或指令流文件")
+    parser.add_argument("--fps", type=float, default=15, help="每连接每秒帧数，0表示按录制的时间间隔")
+    parser.add_argument("--speed", type=float, default=1.0, help="按录制间隔回放时的倍速")
+    parser.add_argument("--tiles", type=int, default=4, help="合成画面每帧的图片块数")
+    parser.add_argument("--tile-bytes", type=int, default=8192, help="合成画面每个图片块的字节数")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    if args.recording:
+        frames = load_recording(args.recording)
+    else:
+        frames = synthetic_frames(args.tiles, args.tile_bytes)
+    asyncio.run(serve(args.host, args.port, FakeGuacd(frames, fps=args.fps, speed=args.speed)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+回放ECS实例状态变更事件
+
+本地开发或压测时代替阿里云事件总线: 从文件逐行读取事件(JSON Lines)，
+按事件中的 "at" 字段(相对开始的秒数，可省略)的节奏推送到 POST /api/v1/ecs/events。
+事件格式与事件总线相同，也可以使用简化格式:
+
+    {"at": 0.5, "instance_id": "i-bp1xxx", "state": "Starting"}
+    {"at": 30, "instance_id": "i-bp1xxx", "state": "Running"}
+    {"at": 95, "data": {"resourceId": "acs:ecs:cn-hangzhou:123:instance/i-bp1xxx", "state": "Deleted"}}
+
+同一时刻的事件合并为一个请求发送:
+    python -m benchmarks.replay_ecs_events events.jsonl --url http://127.0.0.1:8000 --token $ECS_EVENT_TOKEN
+"""
+import argparse
+import json
+import sys
+import time
+from typing import Any, Dict, List
+
+import requests
+
+
+def load_events(path: str) -> List[Dict[str, Any]]:
+    events = []
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                events.append(json.loads(line))
+            except ValueError as e:
+                print(f"第 {number} 行不是有效的JSON，已跳过: {e}", file=sys.stderr)
+    events.sort(key=lambda event: float(event.get("at", 0)))
+    return events
+
+
+def replay(events: List[Dict[str, Any]], url: str, token: str, speed: float = 1.0) -> int:
+    """按节奏推送事件，返回推送失败的请求数"""
+    endpoint = url.rstrip("/") + "/api/v1/ecs/events"
+    session = requests.Session()
+    session.headers["X-ECS-Event-Token"] = token
+    started = time.monotonic()
+    failures = 0
+    i = 0
+    while i < len(events):
+        at = float(events[i].get("at", 0))
+        batch = []
+        while i < len(events) and float(events[i].get("at", 0)) == at:
+            batch.append({key: value for key, value in events[i].items() if key != "at"})
+            i += 1
+
+        delay = at / speed - (time.monotonic() - started)
+        if delay > 0:
+            time.sleep(delay)
+        sent = time.monotonic()
+        try:
+            response = session.post(endpoint, json=batch, timeout=10)
+            response.raise_for_status()
+            print(f"[{at:8.2f}s] {len(batch)} 个事件 -> {response.json()} ({(time.monotonic() - sent) * 1000:.0f} ms)")
+        except requests.RequestException as e:
+            failures += 1
+            print(f"[{at:8.2f}s] 推送失败: {e}", file=sys.stderr)
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="回放ECS实例状态变更事件")
+    parser.add_argument("file", help="事件文件(JSON Lines)")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="后端服务地址")
+    parser.add_argument("--token", required=True, help="与后端 ECS_EVENT_TOKEN 一致的令牌")
+    parser.add_argument("--speed", type=float, default=1.0, help="回放速度倍数")
+    args = parser.parse_args()
+
+    failures = replay(load_events(args.file), args.url, args.token, args.speed)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+"""
+Guacamole隧道离线压测
+
+启动伪guacd和隧道服务两个子进程，按各并发级别用脚本化的WebSocket客户端驱动
+guacamole_ws(行为与浏览器中的guacamole-common-js相同: 使用guacamole子协议、
+逐条回复sync)，统计每个级别的:
+
+- 吞吐: 客户端收到的MB/s、帧/s
+- 延迟: sync从伪guacd发出到客户端收到的耗时分位数(同一台机器，时钟一致)
+- 隧道服务进程的CPU占用与RSS(读取/proc，仅Linux)；同时给出压测客户端自身的CPU占用，
+  接近100%时说明瓶颈在客户端，应减少单轮并发或降低帧率
+
+不需要RDP主机、MySQL或阿里云账号，客户端依赖 websockets 库:
+    pip install websockets
+    python -m benchmarks.tunnel_load --levels 1,10,50,100 --duration 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import websockets
+
+# 客户端收到的sync指令
+_SYNC = re.compile(r"4\.sync,(\d+)\.(\d+);")
+
+_CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def process_cpu_seconds(pid: int) -> Optional[float]:
+    """进程累计的用户态+内核态CPU秒数"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / _CLOCK_TICKS
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def process_rss_mb(pid: int) -> Optional[float]:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def percentile(values: List[float], q: float, digits: int = 1) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(q * len(values)))], digits)
+
+
+class ClientStats:
+    def __init__(self):
+        self.bytes = 0
+        self.messages = 0
+        self.latencies: List[float] = []
+        self.connected_at: Optional[float] = None
+        self.first_sync_at: Optional[float] = None
+        self.error: Optional[str] = None
+
+
+async def run_client(url: str, stats: ClientStats, stop: asyncio.Event):
+    """模拟浏览器客户端: 接收画面并回复每个sync"""
+    started = time.monotonic()
+    try:
+        async with websockets.connect(url, subprotocols=["guacamole"], max_size=None) as ws:
+            stats.connected_at = time.monotonic() - started
+            while not stop.is_set():
+                try:
+                    message = await asyncio.wait_for(ws.recv(), timeout=0.5)
+                except asyncio.TimeoutError:
+                    continue
+                now_ms = time.time() * 1000
+                stats.bytes += len(message)
+                stats.messages += 1
+                acks = []
+                for length, timestamp in _SYNC.findall(message):
+                    stats.latencies.append(now_ms - int(timestamp))
+                    acks.append(f"4.sync,{length}.{timestamp};")
+                    if stats.first_sync_at is None:
+                        stats.first_sync_at = time.monotonic() - started
+                if acks:
+                    await ws.send("".join(acks))
+            await ws.send("10.disconnect;")
+    except Exception as e:
+        stats.error = str(e) or type(e).__name__
+
+
+async def run_level(base_url: str, concurrency: int, duration: float, server_pid: int, offset: int) -> Dict[str, Any]:
+    """以指定并发运行一轮压测"""
+    stop = asyncio.Event()
+    clients = [ClientStats() for _ in range(concurrency)]
+    cpu_before = process_cpu_seconds(server_pid)
+    client_cpu_before = process_cpu_seconds(os.getpid())
+    started = time.monotonic()
+
+    tasks = [
+        asyncio.create_task(run_client(f"{base_url}/ws/{offset + i}/1280/720", stats, stop))
+        for i, stats in enumerate(clients)
+    ]
+    await asyncio.sleep(duration)
+    rss = process_rss_mb(server_pid)
+    stop.set()
+    await asyncio.gather(*tasks)
+    elapsed = time.monotonic() - started
+    cpu_after = process_cpu_seconds(server_pid)
+    client_cpu_after = process_cpu_seconds(os.getpid())
+
+    latencies = [latency for stats in clients for latency in stats.latencies]
+    first_frames = [stats.first_sync_at for stats in clients if stats.first_sync_at is not None]
+    total_bytes = sum(stats.bytes for stats in clients)
+    return {
+        "concurrency": concurrency,
+        "errors": sum(1 for stats in clients if stats.error),
+        "mb_per_second": round(total_bytes / elapsed / 1024 / 1024, 2),
+        "messages_per_second": round(sum(stats.messages for stats in clients) / elapsed, 1),
+        "latency_p50_ms": percentile(latencies, 0.5),
+        "latency_p95_ms": percentile(latencies, 0.95),
+        "latency_p99_ms": percentile(latencies, 0.99),
+        "first_frame_p95_s": percentile(first_frames, 0.95, digits=3),
+        "cpu_percent": round((cpu_after - cpu_before) / elapsed * 100, 1)
+        if cpu_before is not None and cpu_after is not None else None,
+        "rss_mb": round(rss, 1) if rss is not None else None,
+        "client_cpu_percent": round((client_cpu_after - client_cpu_before) / elapsed * 100, 1)
+        if client_cpu_before is not None and client_cpu_after is not None else None,
+        "sample_errors": [stats.error for stats in clients if stats.error][:3],
+    }
+
+
+async def wait_for_port(port: int, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"端口 {port} 未在 {timeout} 秒内就绪")
+
+
+def print_report(results: List[Dict[str, Any]]):
+    columns = (
+        ("concurrency", "并发"), ("errors", "失败"), ("mb_per_second", "MB/s"),
+        ("messages_per_second", "消息/s"), ("latency_p50_ms", "p50ms"), ("latency_p95_ms", "p95ms"),
+        ("latency_p99_ms", "p99ms"), ("first_frame_p95_s", "首帧p95s"), ("cpu_percent", "CPU%"), ("rss_mb", "RSS MB"),
+        ("client_cpu_percent", "客户端CPU%"),
+    )
+    print(" ".join(f"{title:>10}" for _, title in columns))
+    for result in results:
+        print(" ".join(f"{'-' if result[key] is None else result[key]:>10}" for key, _ in columns))
+
+
+async def main_async(args):
+    guacd_port = args.guacd_port or free_port()
+    server_port = args.server_port or free_port()
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    guacd_cmd = [
+        sys.executable, "-m", "benchmarks.fake_guacd", "--port", str(guacd_port),
+        "--fps", str(args.fps), "--tiles", str(args.tiles), "--tile-bytes", str(args.tile_bytes),
+    ]
+    if args.recording:
+        guacd_cmd += ["--recording", args.recording, "--speed", str(args.speed)]
+    server_cmd = [
+        sys.executable, "-m", "benchmarks.tunnel_server",
+        "--port", str(server_port), "--guacd-port", str(guacd_port),
+    ]
+
+    processes = [subprocess.Popen(guacd_cmd, cwd=root)]
+    try:
+        await wait_for_port(guacd_port)
+        server = subprocess.Popen(server_cmd, cwd=root)
+        processes.append(server)
+        await wait_for_port(server_port)
+
+        base_url = f"ws://127.0.0.1:{server_port}/api/v1/guacamole"
+        results = []
+        offset = 0
+        for concurrency in args.levels:
+            print(f"并发 {concurrency}，持续 {args.duration} 秒...", flush=True)
+            results.append(await run_level(base_url, concurrency, args.duration, server.pid, offset))
+            offset += concurrency
+            # 等待隧道全部关闭后再进入下一级别
+            await asyncio.sleep(args.cooldown)
+
+        print_report(results)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump({"args": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Guacamole隧道离线压测")
+    parser.add_argument("--levels", default="1,10,50,100", help="逗号分隔的并发级别")
+    parser.add_argument("--duration", type=float, default=20, help="每个级别的持续秒数")
+    parser.add_argument("--cooldown", type=float, default=3, help="级别之间的间隔秒数")
+    parser.add_argument("--fps", type=float, default=15, help="伪guacd每连接每秒帧数，0表示按录制间隔")
+    parser.add_argument("--tiles", type=int, default=4)
+    parser.add_argument("--tile-bytes", type=int, default=8192)
+    parser.add_argument("--recording", help="伪guacd回放的录制文件")
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument("--guacd-port", type=int, default=0)
+    parser.add_argument("--server-port", type=int, default=0)
+    parser.add_argument("--output", help="结果JSON文件")
+    args = parser.parse_args()
+    args.levels = [int(level) for level in args.levels.split(",") if level.strip()]
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
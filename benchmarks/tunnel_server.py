@@ -0,0 +1,83 @@
+"""
+压测用的隧道服务进程
+
+与gateway.py相同，只挂载Guacamole路由，但不访问数据库: 所有学生任务都解析为
+同一台"实例"，由伪guacd提供画面。其余隧道代码(握手、帧合并、发送队列、画质控制等)
+与生产环境完全一致。
+
+启动方式(通常由 benchmarks.tunnel_load 自动启动):
+    python -m benchmarks.tunnel_server --port 8002 --guacd-port 4823
+"""
+import argparse
+import os
+import sys
+
+
+def configure_environment(guacd_host: str, guacd_port: int):
+    """设置压测所需的配置，已在环境变量中指定的保持不变"""
+    defaults = {
+        # Settings的必填项，压测不会连接MySQL和阿里云
+        "MYSQL_SERVER": "localhost",
+        "MYSQL_USER": "benchmark",
+        "MYSQL_PASSWORD": "benchmark",
+        "ALIYUN_ACCESS_KEY_ID": "benchmark",
+        "ALIYUN_ACCESS_KEY_SECRET": "benchmark",
+        "GUACAMOLE_HOST": guacd_host,
+        "GUACAMOLE_PORT": str(guacd_port),
+        # 每个并发级别结束后立即释放隧道，不跨级别累积
+        "GUACAMOLE_RESUME_GRACE_SECONDS": "0",
+        "GUACAMOLE_PREWARM_ENABLED": "false",
+    }
+    for key, value in defaults.items():
+        os.environ.setdefault(key, value)
+
+
+class BenchmarkInstance:
+    """代替数据库中的ECS实例记录"""
+    private_ip = "127.0.0.1"
+    password = "benchmark"
+    status = "Running"
+
+
+def create_app():
+    from fastapi import FastAPI
+
+    from app.api.endpoints import guacamole
+    from app.core.config import settings
+    from app.services.guacamole import guacamole_service
+
+    # 不查询数据库，所有学生任务都指向伪guacd
+    guacamole.crud_ecs_instance.get_by_student_task_id = lambda db, student_task_id: BenchmarkInstance()
+
+    app = FastAPI(title="Guacamole隧道压测服务")
+    app.include_router(guacamole.router, prefix=f"{settings.API_V1_STR}/guacamole")
+    app.dependency_overrides[guacamole.get_db] = lambda: None
+
+    @app.get("/health")
+    def health():
+        return {"status": "ok", "tunnels": len(guacamole_service.connections)}
+
+    @app.on_event("shutdown")
+    async def shutdown():
+        await guacamole_service.close_all()
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="压测用的隧道服务进程")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8002)
+    parser.add_argument("--guacd-host", default="127.0.0.1")
+    parser.add_argument("--guacd-port", type=int, default=4823)
+    args = parser.parse_args()
+
+    configure_environment(args.guacd_host, args.guacd_port)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    import uvicorn
+    uvicorn.run(create_app(), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""
+Guacamole隧道网关
+
+只承载Guacamole WebSocket隧道的独立入口，与REST API进程分开部署和扩容，
+避免长连接的远程桌面数据流与短请求争用同一批事件循环。
+各网关进程把持有的隧道登记到Redis，任何节点都可以查询或关闭。
+
+启动方式:
+    gunicorn gateway:app -w 4 -k uvicorn.workers.UvicornWorker -b 0.0.0.0:8001
+"""
+import logging
+
+import uvicorn
+from fastapi import FastAPI
+
+from app.api.endpoints import guacamole
+from app.core.config import settings
+from app.services.guacamole import guacamole_service
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+app = FastAPI(
+    title="实验环境管理平台Guacamole隧道网关",
+    description="Guacamole WebSocket隧道网关",
+    version="1.0.0",
+)
+
+# 与API进程使用相同的路由前缀，Nginx按路径转发即可
+app.include_router(guacamole.router, prefix=f"{settings.API_V1_STR}/guacamole", tags=["guacamole"])
+
+
+@app.get("/health")
+def health():
+    return {"status": "ok", "tunnels": len(guacamole_service.connections)}
+
+
+@app.on_event("startup")
+async def startup():
+    # 订阅隧道关闭与预热广播
+    guacamole_service.start(gateway=True)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    # 进程退出前关闭本地隧道并从注册表注销
+    await guacamole_service.close_all()
+
+
+if __name__ == "__main__":
+    uvicorn.run("gateway:app", host="0.0.0.0", port=8001)
@@ -13,6 +13,7 @@ import time
 
 from app.api.api import api_router
 from app.core.config import settings
+from app.services.guacamole import guacamole_service
 
 # 配置日志
 logging.basicConfig(
@@ -61,6 +62,20 @@ app.include_router(api_router, prefix=settings.API_V1_STR)
 def root():
     return {"message": "欢迎使用实验环境管理平台API"}
 
+
+@app.on_event("startup")
+async def startup():
+    # 已部署独立隧道网关时由网关处理隧道预热，API进程不订阅
+    if not settings.GUACAMOLE_STANDALONE_GATEWAY:
+        guacamole_service.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    # 未部署独立隧道网关时，本进程也会持有隧道，退出前关闭并注销
+    await guacamole_service.close_all()
+
+
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
     logger.error(f"未捕获的异常: {exc}", exc_info=True)